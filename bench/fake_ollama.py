@@ -0,0 +1,288 @@
+# bench/fake_ollama.py
+"""
+Symulator floty telefonów z Ollamą – wiele instancji na kolejnych portach w jednym procesie.
+
+    python -m bench.fake_ollama --count 6 --base-port 21434 --tps 8
+    python -m bench.fake_ollama --fleet fleet.json
+
+fleet.json: {"host": "127.0.0.1", "base_port": 21434, "count": 6, "seed": 1,
+             "profile": {...pola Profile...}, "overrides": {"0": {"tps": 3, "thermal": 0.5}}}
+
+Obsługiwane: /api/tags, /api/ps, /api/chat (stream i non-stream), /api/embeddings, /api/embed.
+Odpowiedzi w formacie Ollamy (czasy w ns), treść deterministyczna względem (seed, port, prompt).
+"""
+from __future__ import annotations
+import argparse, asyncio, hashlib, json, math, random, time
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("the of and to in is was for on that with as by at from this be are or an it not which "
+         "have one had all but were we when there can more if out so said what up its about into "
+         "than them only some time could new these two may first then do any like my now over").split()
+
+@dataclass
+class Profile:
+    """Parametry jednej instancji (telefonu)."""
+    models: List[str] = field(default_factory=lambda: ["tinyllama:latest"])
+    tps: float = 8.0              # generacja: tokeny/s
+    prompt_tps: float = 60.0      # prompt eval: tokeny/s (koszt promptu, ~4 znaki na token)
+    load_s: float = 2.0           # ładowanie modelu spoza /api/ps
+    max_loaded: int = 1           # ile modeli mieści się naraz w pamięci (LRU)
+    parallel: int = 1             # równoległe generacje (OLLAMA_NUM_PARALLEL), reszta czeka
+    jitter: float = 0.1           # ± ułamek czasu na token
+    thermal: float = 0.0          # maks. spowolnienie pod ciągłym obciążeniem (0.5 = 50% wolniej)
+    thermal_tau_s: float = 60.0   # stała czasowa nagrzewania / stygnięcia
+    fail_rate: float = 0.0        # P(HTTP 500 zanim cokolwiek wyjdzie)
+    error_rate: float = 0.0       # P({"error": ...} w połowie strumienia)
+    hang_rate: float = 0.0        # P(zawieszenia w połowie generacji – bez kolejnych linii)
+    default_tokens: int = 64      # gdy brak options.num_predict
+    embed_dim: int = 384
+
+    @classmethod
+    def from_dict(cls, d: Optional[Dict[str, Any]]) -> "Profile":
+        known = {f.name for f in fields(cls)}
+        unknown = set(d or {}) - known
+        if unknown:
+            raise ValueError(f"unknown profile field(s): {', '.join(sorted(unknown))}")
+        return cls(**(d or {}))
+
+def _tokens(text: str) -> int:
+    return max(1, math.ceil(len(text) / 4))
+
+def _model(name: Optional[str]) -> str:
+    if not name: return ""
+    return name if ":" in name else f"{name}:latest"
+
+class FakePhone:
+    """Stan jednej instancji: załadowane modele, nagrzanie, sloty generacji."""
+    def __init__(self, port: int, profile: Profile, seed: int = 0):
+        self.port = port
+        self.profile = profile
+        self.seed = seed
+        self.rng = random.Random(f"{seed}:{port}")
+        self.resident: "OrderedDict[str, None]" = OrderedDict()
+        self.slots = asyncio.Semaphore(max(1, profile.parallel))
+        self.busy = 0
+        self.heat = 0.0               # 0..1
+        self._heat_t = time.monotonic()
+        self._load_lock = asyncio.Lock()
+
+    # --- model fizyczny ---
+    def _update_heat(self):
+        now = time.monotonic()
+        dt, self._heat_t = now - self._heat_t, now
+        target = 1.0 if self.busy else 0.0
+        self.heat = target + (self.heat - target) * math.exp(-dt / max(1e-3, self.profile.thermal_tau_s))
+
+    def _slowdown(self) -> float:
+        self._update_heat()
+        return 1.0 + self.profile.thermal * self.heat
+
+    def _token_s(self) -> float:
+        p = self.profile
+        j = 1.0 + self.rng.uniform(-p.jitter, p.jitter) if p.jitter else 1.0
+        return max(0.0, j) * self._slowdown() / p.tps
+
+    async def _ensure_loaded(self, model: str) -> float:
+        """Czas ładowania (s); 0 gdy model już w pamięci."""
+        async with self._load_lock:
+            if model in self.resident:
+                self.resident.move_to_end(model)
+                return 0.0
+            t = self.profile.load_s * self._slowdown()
+            await asyncio.sleep(t)
+            self.resident[model] = None
+            while len(self.resident) > max(1, self.profile.max_loaded):
+                self.resident.popitem(last=False)
+            return t
+
+    def _text(self, key: str, n: int) -> List[str]:
+        rng = random.Random(f"{self.seed}:{key}")
+        return [(" " if i else "") + rng.choice(WORDS) for i in range(n)]
+
+    # --- /api/chat ---
+    async def chat(self, body: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """Zdarzenia strumienia /api/chat (ostatnie z done=true i statystykami jak w Ollamie)."""
+        p = self.profile
+        model = _model(body.get("model"))
+        messages = body.get("messages") or []
+        opts = body.get("options") or {}
+        prompt = "\n".join(str(m.get("content") or "") for m in messages)
+        # wznowienie: częściowa odpowiedź assistant na końcu -> generujemy tylko resztę
+        partial = (messages[-1].get("content") or "") if messages and messages[-1].get("role") == "assistant" else ""
+        want = int(opts.get("num_predict") or p.default_tokens)
+        if want < 0: want = p.default_tokens
+        done_tokens = len(partial.split())
+        n = max(1, want - done_tokens)
+        key = "\n".join(str(m.get("content") or "") for m in messages if m.get("role") != "assistant")
+        words = self._text(key, want)[done_tokens:done_tokens + n]
+        hang_at = self.rng.randrange(n) if self.rng.random() < p.hang_rate else None
+        error_at = self.rng.randrange(n) if self.rng.random() < p.error_rate else None
+
+        t0 = time.perf_counter_ns()
+        async with self.slots:
+            self._update_heat(); self.busy += 1
+            try:
+                load_s = await self._ensure_loaded(model)
+                t_pe = time.perf_counter_ns()
+                n_prompt = _tokens(prompt)
+                await asyncio.sleep(n_prompt / p.prompt_tps * self._slowdown())
+                t_gen = time.perf_counter_ns()
+                for i, w in enumerate(words):
+                    if i == hang_at:
+                        await asyncio.Event().wait()   # do rozłączenia klienta
+                    if i == error_at:
+                        yield {"error": "simulated failure"}
+                        return
+                    await asyncio.sleep(self._token_s())
+                    yield {"model": model, "created_at": _now_iso(),
+                           "message": {"role": "assistant", "content": w}, "done": False}
+                t_end = time.perf_counter_ns()
+            finally:
+                self._update_heat(); self.busy -= 1
+        yield {"model": model, "created_at": _now_iso(), "message": {"role": "assistant", "content": ""},
+               "done": True, "done_reason": "length",
+               "total_duration": t_end - t0, "load_duration": int(load_s * 1e9),
+               "prompt_eval_count": n_prompt, "prompt_eval_duration": t_gen - t_pe,
+               "eval_count": len(words), "eval_duration": t_end - t_gen}
+
+    def embedding(self, model: str, text: str) -> List[float]:
+        h = hashlib.sha256(f"{model}\n{text}".encode()).digest()
+        rng = random.Random(h)
+        v = [rng.gauss(0.0, 1.0) for _ in range(self.profile.embed_dim)]
+        norm = math.sqrt(sum(x * x for x in v)) or 1.0
+        return [x / norm for x in v]
+
+    async def embed_cost(self, model: str, texts: List[str]) -> float:
+        async with self.slots:
+            self._update_heat(); self.busy += 1
+            try:
+                load_s = await self._ensure_loaded(model)
+                await asyncio.sleep(sum(_tokens(t) for t in texts) / self.profile.prompt_tps * self._slowdown())
+                return load_s
+            finally:
+                self._update_heat(); self.busy -= 1
+
+def _now_iso() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + "Z"
+
+def make_app(phone: FakePhone) -> FastAPI:
+    app = FastAPI(title=f"fake-ollama:{phone.port}")
+    p = phone.profile
+
+    def fail() -> Optional[JSONResponse]:
+        if phone.rng.random() < p.fail_rate:
+            return JSONResponse({"error": "simulated server error"}, status_code=500)
+        return None
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": m, "model": m, "size": 0} for m in p.models]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": m, "model": m} for m in phone.resident]}
+
+    @app.get("/")
+    async def root():
+        return "Ollama is running"
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        if _model(body.get("model")) not in p.models:
+            return JSONResponse({"error": f"model '{body.get('model')}' not found"}, status_code=404)
+        if (resp := fail()) is not None:
+            return resp
+        if body.get("stream", True):
+            async def gen():
+                async for ev in phone.chat(body):
+                    yield json.dumps(ev).encode() + b"\n"
+            return StreamingResponse(gen(), media_type="application/x-ndjson")
+        content, final = [], None
+        async for ev in phone.chat(body):
+            if ev.get("error"):
+                return JSONResponse(ev, status_code=500)
+            content.append(ev["message"]["content"])
+            final = ev
+        final["message"]["content"] = "".join(content)
+        return final
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        model = _model(body.get("model"))
+        if model not in p.models:
+            return JSONResponse({"error": f"model '{body.get('model')}' not found"}, status_code=404)
+        if (resp := fail()) is not None:
+            return resp
+        text = str(body.get("prompt") or "")
+        await phone.embed_cost(model, [text])
+        return {"embedding": phone.embedding(model, text)}
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        model = _model(body.get("model"))
+        if model not in p.models:
+            return JSONResponse({"error": f"model '{body.get('model')}' not found"}, status_code=404)
+        if (resp := fail()) is not None:
+            return resp
+        inp = body.get("input")
+        texts = [inp] if isinstance(inp, str) else [str(t) for t in (inp or [])]
+        t0 = time.perf_counter_ns()
+        load_s = await phone.embed_cost(model, texts)
+        return {"model": model, "embeddings": [phone.embedding(model, t) for t in texts],
+                "total_duration": time.perf_counter_ns() - t0, "load_duration": int(load_s * 1e9),
+                "prompt_eval_count": sum(_tokens(t) for t in texts)}
+
+    return app
+
+def fleet_phones(spec: Dict[str, Any]) -> List[FakePhone]:
+    """Instancje wg specyfikacji floty (patrz docstring modułu)."""
+    base = spec.get("profile") or {}
+    overrides = {int(k): v for k, v in (spec.get("overrides") or {}).items()}
+    seed = int(spec.get("seed", 0))
+    port0 = int(spec.get("base_port", 21434))
+    return [FakePhone(port0 + i, Profile.from_dict({**base, **overrides.get(i, {})}), seed)
+            for i in range(int(spec.get("count", 1)))]
+
+async def serve_fleet(spec: Dict[str, Any]):
+    import uvicorn
+    host = spec.get("host", "127.0.0.1")
+    servers = []
+    for phone in fleet_phones(spec):
+        cfg = uvicorn.Config(make_app(phone), host=host, port=phone.port, log_level="warning",
+                             access_log=False, lifespan="off")
+        servers.append(uvicorn.Server(cfg))
+    await asyncio.gather(*(s.serve() for s in servers))
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Fake Ollama fleet")
+    ap.add_argument("--fleet", help="fleet.json (host/base_port/count/seed/profile/overrides)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--base-port", type=int, default=21434)
+    ap.add_argument("--count", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
+    for f in fields(Profile):
+        if f.name != "models":
+            ap.add_argument("--" + f.name.replace("_", "-"), type=type(Profile().__dict__[f.name]), default=None)
+    ap.add_argument("--models", default=None, help="lista po przecinku")
+    a = ap.parse_args(argv)
+    if a.fleet:
+        with open(a.fleet) as fh:
+            spec = json.load(fh)
+    else:
+        profile = {f.name: getattr(a, f.name) for f in fields(Profile)
+                   if f.name != "models" and getattr(a, f.name) is not None}
+        if a.models:
+            profile["models"] = [_model(m.strip()) for m in a.models.split(",") if m.strip()]
+        spec = {"host": a.host, "base_port": a.base_port, "count": a.count, "seed": a.seed, "profile": profile}
+    asyncio.run(serve_fleet(spec))
+
+if __name__ == "__main__":
+    main()
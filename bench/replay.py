@@ -0,0 +1,205 @@
+# bench/replay.py
+"""
+Odtwarzanie ruchu zapisanego przez bramkę (CAPTURE_PATH, core/capture.py) na dowolnej flocie:
+żądania idą w pętli otwartej z zachowaniem odstępów między przybyciami, przyspieszonych --speed
+razy – tak jak przyszłoby je obsłużyć przy N-krotnie większym ruchu.
+
+    python -m bench.replay traffic.jsonl --target http://127.0.0.1:8000 --speed 2 --out replay.json
+    python -m bench.run_bench bench/scenarios/default.json --set load.replay=traffic.jsonl --set load.speed=3
+
+Bez pełnych ciał (CAPTURE_FULL_BODY=False) prompt jest syntetyczny: ta sama długość i ten
+sam skrót -> ta sama treść, więc trafienia cache / coalescing odtwarzają się jak w oryginale.
+Elementy jednego /ask_batch wracają jako jeden batch, joby przez POST /jobs (+ podgląd strumienia).
+Wynik: jak run_bench (per endpoint) + lag_s (spóźnienie wysyłki względem planu) + "original"
+– latencje z logu dla porównania.
+"""
+from __future__ import annotations
+import argparse, asyncio, json, random, sys, time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench.fake_ollama import WORDS
+from bench.run_bench import Recorder, _read_stream, quantiles
+from core.capture import log_files
+
+def load_records(path: str, since: Optional[float] = None, until: Optional[float] = None,
+                 endpoints: Optional[List[str]] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Rekordy z logu i jego rotacji, posortowane po przybyciu."""
+    out: List[Dict[str, Any]] = []
+    for f in log_files(Path(path)):
+        with open(f, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue   # urwana ostatnia linia
+                if since is not None and rec["t"] < since: continue
+                if until is not None and rec["t"] >= until: continue
+                if endpoints and rec["ep"] not in endpoints: continue
+                out.append(rec)
+    out.sort(key=lambda r: r["t"])
+    return out[:limit] if limit else out
+
+def synth_prompt(rec: Dict[str, Any]) -> str:
+    rng = random.Random(rec.get("sha", ""))
+    words: List[str] = []
+    while sum(len(w) + 1 for w in words) < max(1, int(rec.get("prompt_chars") or 1)):
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+def ask_body(rec: Dict[str, Any], model: Optional[str]) -> Dict[str, Any]:
+    if rec.get("body"):
+        body = {k: v for k, v in rec["body"].items()
+                if k not in ("priority", "deadline_s", "custom_id")}   # pola jobów
+    else:
+        body = {"prompt": synth_prompt(rec), "options": rec.get("options") or {}}
+        if rec.get("model"):
+            body["model"] = rec["model"]
+        if rec.get("session"):
+            body["session_id"] = rec.get("sha")
+    if model:
+        body["model"] = model
+    return body
+
+def schedule(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Elementy /ask_batch z tym samym id -> jedno wysłanie {"ep": "ask_batch", "items": [...]}."""
+    out: List[Dict[str, Any]] = []
+    batches: Dict[str, Dict[str, Any]] = {}
+    for rec in records:
+        if rec["ep"] == "ask_batch" and rec.get("batch"):
+            b = batches.get(rec["batch"])
+            if b is None:
+                b = batches[rec["batch"]] = {"ep": "ask_batch", "t": rec["t"], "tenant": rec.get("tenant"), "items": []}
+                out.append(b)
+            b["items"].append(rec)
+        else:
+            out.append(rec)
+    return out
+
+def _headers(rec: Dict[str, Any]) -> Dict[str, str]:
+    tenant = rec.get("tenant")
+    # skrót klucza (key:...) nie jest nagłówkiem – najemca bez klucza wraca jako X-Tenant
+    return {"X-Tenant": tenant} if tenant and not tenant.startswith("key:") and tenant != "default" else {}
+
+async def send(rec: Dict[str, Any], client: httpx.AsyncClient, rec_out: Recorder, model: Optional[str]):
+    ep = rec["ep"]
+    t0 = time.perf_counter()
+    try:
+        if ep == "ask":
+            r = await client.post("/ask", json=ask_body(rec, model), headers=_headers(rec))
+            ok = r.status_code == 200
+            rec_out.add(ep, ok, time.perf_counter() - t0, None,
+                        int(r.json().get("eval_count") or 0) if ok else 0, str(r.status_code))
+        elif ep == "ask_stream":
+            async with client.stream("POST", "/ask_stream", json=ask_body(rec, model), headers=_headers(rec)) as r:
+                if r.status_code != 200:
+                    await r.aread()
+                    rec_out.add(ep, False, time.perf_counter() - t0, status=str(r.status_code)); return
+                ttft, tokens, failed = await _read_stream(r, t0)
+            rec_out.add(ep, not failed and ttft is not None, time.perf_counter() - t0, ttft, tokens,
+                        "stream_error" if failed else "200")
+        elif ep == "ask_batch":
+            body = {"requests": [ask_body(i, model) for i in rec.get("items") or [rec]]}
+            r = await client.post("/ask_batch", json=body, headers=_headers(rec))
+            ok = r.status_code == 200
+            results = r.json().get("results", []) if ok else []
+            ok = ok and all(x.get("ok") for x in results)
+            tokens = sum(int((x.get("data") or {}).get("eval_count") or 0) for x in results if x.get("ok"))
+            rec_out.add(ep, ok, time.perf_counter() - t0, None, tokens,
+                        str(r.status_code) if r.status_code != 200 or ok else "item_error")
+        elif ep in ("jobs", "jobs_bulk", "jobs_stream"):
+            body = {**ask_body(rec, model), "priority": rec.get("priority", 5)}
+            if rec.get("deadline_s"):
+                body["deadline_s"] = rec["deadline_s"]
+            if ep == "jobs_stream":
+                async with client.stream("POST", "/jobs/stream", json=body, headers=_headers(rec)) as r:
+                    if r.status_code != 200:
+                        await r.aread()
+                        rec_out.add(ep, False, time.perf_counter() - t0, status=str(r.status_code)); return
+                    ttft, tokens, failed = await _read_stream(r, t0)
+                rec_out.add(ep, not failed and ttft is not None, time.perf_counter() - t0, ttft, tokens,
+                            "stream_error" if failed else "200")
+                return
+            r = await client.post("/jobs", json=body, headers=_headers(rec))
+            if r.status_code != 200:
+                rec_out.add(ep, False, time.perf_counter() - t0, status=str(r.status_code)); return
+            job_id = r.json()["job_id"]
+            async with client.stream("GET", f"/jobs/{job_id}/stream") as s:
+                ttft, tokens, _ = await _read_stream(s, t0)
+            status = (await client.get(f"/jobs/{job_id}")).json().get("status")
+            rec_out.add(ep, status == "done", time.perf_counter() - t0, ttft, tokens, str(status))
+        else:
+            rec_out.add(ep, False, 0.0, status="unsupported")
+    except httpx.HTTPError as e:
+        rec_out.add(ep, False, time.perf_counter() - t0, status=type(e).__name__)
+
+def original(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Latencje / TTFT / wynik zapisane w logu – punkt odniesienia dla odtworzenia."""
+    by_ep: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        by_ep.setdefault(r["ep"], []).append(r)
+    out = {}
+    for ep, rows in sorted(by_ep.items()):
+        ok = [r for r in rows if r.get("status") in ("ok", "cached")]
+        out[ep] = {"count": len(rows), "ok": len(ok),
+                   "latency_s": quantiles([r["latency_s"] for r in ok if "latency_s" in r]),
+                   "ttft_s": quantiles([r["ttft_s"] for r in ok if "ttft_s" in r]),
+                   "wait_s": quantiles([r["wait_s"] for r in ok if "wait_s" in r])}
+    return out
+
+async def replay(base_url: str, records: List[Dict[str, Any]], speed: float = 1.0,
+                 timeout_s: float = 300.0, model: Optional[str] = None,
+                 max_connections: int = 1000) -> Dict[str, Any]:
+    plan = schedule(records)
+    rec_out = Recorder()
+    lags: List[float] = []
+    if not plan:
+        return {"summary": {"requests": 0}, "ops": {}}
+    t_first = plan[0]["t"]
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout_s, limits=limits) as client:
+        t_start = time.perf_counter()
+        tasks = []
+        for rec in plan:
+            due = t_start + (rec["t"] - t_first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lags.append(max(0.0, time.perf_counter() - due))
+            tasks.append(asyncio.create_task(send(rec, client, rec_out, model)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - t_start
+    span = (plan[-1]["t"] - t_first) / speed
+    result = rec_out.report(elapsed)
+    result["summary"].update({"speed": speed, "offered_rps": round(len(plan) / span, 3) if span > 0 else None,
+                              "lag_s": quantiles(lags)})
+    result["original"] = original(records)
+    return result
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Replay captured gateway traffic")
+    ap.add_argument("log", help="plik logu (CAPTURE_PATH); rotacje .1 .2 ... czytane automatycznie")
+    ap.add_argument("--target", default="http://127.0.0.1:8000")
+    ap.add_argument("--speed", type=float, default=1.0, help="N = N-krotnie gęstsze przybycia")
+    ap.add_argument("--since", type=float, help="epoch")
+    ap.add_argument("--until", type=float, help="epoch")
+    ap.add_argument("--endpoints", help="po przecinku: ask,ask_stream,ask_batch,jobs,jobs_bulk,jobs_stream")
+    ap.add_argument("--limit", type=int)
+    ap.add_argument("--model", help="podmiana modelu (np. flota symulowana)")
+    ap.add_argument("--timeout", type=float, default=300.0)
+    ap.add_argument("--out", help="plik wyników (domyślnie stdout)")
+    a = ap.parse_args(argv)
+    records = load_records(a.log, a.since, a.until, a.endpoints.split(",") if a.endpoints else None, a.limit)
+    if not records:
+        sys.exit(f"no records in {a.log}")
+    result = asyncio.run(replay(a.target, records, a.speed, a.timeout, a.model))
+    text = json.dumps({"log": a.log, "target": a.target, "records": len(records), **result}, indent=2)
+    if a.out:
+        Path(a.out).write_text(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# bench/run_bench.py
+"""
+Powtarzalny benchmark bramki na symulowanej flocie (bench/fake_ollama.py):
+1. startuje flotę i zapisuje dla niej phones.json w katalogu tymczasowym (GW_DATA_DIR)
+2. uruchamia server.py (uvicorn) z tym katalogiem – repo-owe phones.json / jobs.db zostają nietknięte
+3. odtwarza mieszankę ruchu (/ask, /ask_stream, /ask_batch, /jobs) w pętli zamkniętej
+   z N równoległymi klientami, losowanie z ziarnem ze scenariusza – albo, z load.replay,
+   zapisany ruch produkcyjny (bench/replay.py) w pętli otwartej
+4. wypisuje JSON: przepustowość, latencja p50/p90/p99 i TTFT per operacja + commit
+
+    python -m bench.run_bench bench/scenarios/default.json --out results.json
+    python -m bench.run_bench bench/scenarios/default.json --set load.duration_s=10 --set fleet.count=2
+
+Wyniki dwóch commitów porównuje się zwykłym diffem / jq na polach "ops".
+"""
+from __future__ import annotations
+import argparse, asyncio, json, os, random, shutil, signal, subprocess, sys, tempfile, time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from bench.fake_ollama import Profile, WORDS, fleet_phones
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_SCENARIO: Dict[str, Any] = {
+    "name": "default",
+    "seed": 1,
+    "fleet": {"host": "127.0.0.1", "base_port": 21434, "count": 4, "seed": 1, "profile": {}, "overrides": {}},
+    "max_concurrency": None,      # phones.json; None = profile.parallel
+    "gateway": {"port": 18000, "ready_timeout_s": 60,
+                "capture": None,    # log ruchu bramki (GW_CAPTURE) – materiał dla load.replay
+                "workers": 1},      # > 1: uvicorn --workers N ze wspólnym stanem (GW_SHARED_STATE)
+    "load": {
+        "duration_s": 30,
+        "concurrency": 16,
+        "mix": {"ask": 0.5, "ask_stream": 0.2, "ask_batch": 0.1, "jobs": 0.2},
+        "batch_size": 8,
+        "prompts": 200,           # pula różnych promptów (trafienia cache / coalescing)
+        "prompt_chars": [40, 400],
+        "num_predict": [8, 48],
+        "deterministic": 0.2,     # ułamek żądań z temperature=0 (kandydaci do cache)
+        "model": None,            # None = pierwszy model profilu
+        "request_timeout_s": 300,
+        "replay": None,           # log ruchu (bench/replay.py) zamiast mieszanki – pętla otwarta
+        "speed": 1.0,             # replay: N-krotnie gęstsze przybycia
+    },
+}
+
+def _merge(base: Dict[str, Any], over: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(base)
+    for k, v in over.items():
+        out[k] = _merge(out[k], v) if isinstance(v, dict) and isinstance(out.get(k), dict) else v
+    return out
+
+def _set(cfg: Dict[str, Any], assignment: str):
+    """--set a.b.c=wartość (JSON albo napis)."""
+    path, _, raw = assignment.partition("=")
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    node = cfg
+    *parents, leaf = path.split(".")
+    for k in parents:
+        node = node.setdefault(k, {})
+    node[leaf] = value
+
+def quantiles(xs: List[float]) -> Optional[Dict[str, float]]:
+    if not xs:
+        return None
+    s = sorted(xs)
+    def q(p: float) -> float:
+        return round(s[min(len(s) - 1, int(p * len(s)))], 4)
+    return {"p50": q(0.50), "p90": q(0.90), "p99": q(0.99),
+            "mean": round(sum(s) / len(s), 4), "max": round(s[-1], 4), "n": len(s)}
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[Tuple[bool, float, Optional[float], int, str]]] = {}
+
+    def add(self, op: str, ok: bool, latency: float, ttft: Optional[float] = None,
+            tokens: int = 0, status: str = "200"):
+        self.samples.setdefault(op, []).append((ok, latency, ttft, tokens, status))
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        ops: Dict[str, Any] = {}
+        total = errors = tokens = 0
+        for op, rows in sorted(self.samples.items()):
+            ok = [r for r in rows if r[0]]
+            statuses: Dict[str, int] = {}
+            for r in rows:
+                statuses[r[4]] = statuses.get(r[4], 0) + 1
+            tok = sum(r[3] for r in ok)
+            ops[op] = {"count": len(rows), "ok": len(ok), "errors": len(rows) - len(ok), "status": statuses,
+                       "rps": round(len(ok) / elapsed, 3), "tokens_per_s": round(tok / elapsed, 2),
+                       "latency_s": quantiles([r[1] for r in ok]),
+                       "ttft_s": quantiles([r[2] for r in ok if r[2] is not None])}
+            total += len(rows); errors += len(rows) - len(ok); tokens += tok
+        return {"summary": {"requests": total, "errors": errors, "duration_s": round(elapsed, 3),
+                            "throughput_rps": round((total - errors) / elapsed, 3),
+                            "tokens_per_s": round(tokens / elapsed, 2)},
+                "ops": ops}
+
+class Traffic:
+    """Deterministyczny generator żądań (pula promptów + losowanie per klient z ziarnem)."""
+    def __init__(self, load: Dict[str, Any], seed: int, model: str):
+        self.load = load
+        self.model = model
+        rng = random.Random(f"prompts:{seed}")
+        lo, hi = load["prompt_chars"]
+        self.prompts = []
+        for _ in range(int(load["prompts"])):
+            n = rng.randint(lo, hi)
+            words: List[str] = []
+            while sum(len(w) + 1 for w in words) < n:
+                words.append(rng.choice(WORDS))
+            self.prompts.append(" ".join(words))
+        mix = {k: float(v) for k, v in load["mix"].items() if float(v) > 0}
+        self.ops, self.weights = list(mix), list(mix.values())
+
+    def op(self, rng: random.Random) -> str:
+        return rng.choices(self.ops, self.weights)[0]
+
+    def ask(self, rng: random.Random) -> Dict[str, Any]:
+        lo, hi = self.load["num_predict"]
+        options: Dict[str, Any] = {"num_predict": rng.randint(lo, hi)}
+        if rng.random() < float(self.load["deterministic"]):
+            options["temperature"] = 0
+        return {"prompt": rng.choice(self.prompts), "model": self.model, "options": options}
+
+def _content_tokens(line: str) -> Tuple[bool, int, bool]:
+    """(linia z treścią, eval_count z linii done, błąd) dla linii NDJSON Ollamy."""
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        return False, 0, False
+    if not isinstance(obj, dict):
+        return False, 0, False
+    if obj.get("error"):
+        return False, 0, True
+    return bool((obj.get("message") or {}).get("content")), int(obj.get("eval_count") or 0), False
+
+async def _read_stream(resp: httpx.Response, t0: float) -> Tuple[Optional[float], int, bool]:
+    ttft, tokens, failed = None, 0, False
+    async for line in resp.aiter_lines():
+        if not line.strip():
+            continue
+        has_content, n, err = _content_tokens(line)
+        if has_content and ttft is None:
+            ttft = time.perf_counter() - t0
+        tokens += n
+        failed = failed or err
+    return ttft, tokens, failed
+
+async def run_op(op: str, client: httpx.AsyncClient, traffic: Traffic, rng: random.Random, rec: Recorder):
+    t0 = time.perf_counter()
+    try:
+        if op == "ask":
+            r = await client.post("/ask", json=traffic.ask(rng))
+            ok = r.status_code == 200
+            rec.add(op, ok, time.perf_counter() - t0, None,
+                    int(r.json().get("eval_count") or 0) if ok else 0, str(r.status_code))
+        elif op == "ask_stream":
+            async with client.stream("POST", "/ask_stream", json=traffic.ask(rng)) as r:
+                if r.status_code != 200:
+                    await r.aread()
+                    rec.add(op, False, time.perf_counter() - t0, status=str(r.status_code)); return
+                ttft, tokens, failed = await _read_stream(r, t0)
+            rec.add(op, not failed and ttft is not None, time.perf_counter() - t0, ttft, tokens,
+                    "stream_error" if failed else "200")
+        elif op == "ask_batch":
+            body = {"requests": [traffic.ask(rng) for _ in range(int(traffic.load["batch_size"]))]}
+            r = await client.post("/ask_batch", json=body)
+            ok = r.status_code == 200
+            results = r.json().get("results", []) if ok else []
+            ok = ok and all(x.get("ok") for x in results)
+            tokens = sum(int((x.get("data") or {}).get("eval_count") or 0) for x in results if x.get("ok"))
+            rec.add(op, ok, time.perf_counter() - t0, None, tokens,
+                    str(r.status_code) if r.status_code != 200 or ok else "item_error")
+        elif op == "jobs":
+            r = await client.post("/jobs", json=traffic.ask(rng))
+            if r.status_code != 200:
+                rec.add(op, False, time.perf_counter() - t0, status=str(r.status_code)); return
+            job_id = r.json()["job_id"]
+            async with client.stream("GET", f"/jobs/{job_id}/stream") as s:
+                ttft, tokens, _ = await _read_stream(s, t0)
+            status = (await client.get(f"/jobs/{job_id}")).json().get("status")
+            rec.add(op, status == "done", time.perf_counter() - t0, ttft, tokens, str(status))
+        else:
+            raise ValueError(f"unknown op {op!r}")
+    except httpx.HTTPError as e:
+        rec.add(op, False, time.perf_counter() - t0, status=type(e).__name__)
+
+async def drive(base_url: str, load: Dict[str, Any], seed: int, model: str) -> Dict[str, Any]:
+    traffic = Traffic(load, seed, model)
+    rec = Recorder()
+    n = int(load["concurrency"])
+    limits = httpx.Limits(max_connections=n * 2, max_keepalive_connections=n * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=float(load["request_timeout_s"]), limits=limits) as client:
+        t_start = time.perf_counter()
+        t_stop = t_start + float(load["duration_s"])
+        async def worker(i: int):
+            rng = random.Random(f"{seed}:{i}")
+            while time.perf_counter() < t_stop:
+                await run_op(traffic.op(rng), client, traffic, rng, rec)
+        await asyncio.gather(*(worker(i) for i in range(n)))
+        elapsed = time.perf_counter() - t_start
+    return rec.report(elapsed)
+
+async def wait_ready(url: str, timeout_s: float, check=lambda r: r.status_code == 200):
+    t_end = time.monotonic() + timeout_s
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while True:
+            try:
+                r = await client.get(url)
+                if check(r):
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > t_end:
+                raise TimeoutError(f"{url} not ready after {timeout_s}s")
+            await asyncio.sleep(0.2)
+
+def _git(*args: str) -> Optional[str]:
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _stop(proc: Optional[subprocess.Popen]):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill(); proc.wait()
+
+async def run(cfg: Dict[str, Any], workdir: Path) -> Dict[str, Any]:
+    fleet = cfg["fleet"]
+    phones = fleet_phones(fleet)   # tylko do wygenerowania phones.json
+    model = cfg["load"].get("model") or phones[0].profile.models[0]
+    host = fleet.get("host", "127.0.0.1")
+    (workdir / "fleet.json").write_text(json.dumps(fleet, indent=2))
+    (workdir / "phones.json").write_text(json.dumps([
+        {"host": host, "port": p.port, "model": p.profile.models[0], "weight": 1,
+         "max_concurrency": int(cfg.get("max_concurrency") or p.profile.parallel), "serial": f"sim-{p.port}"}
+        for p in phones], indent=2))
+    port = int(cfg["gateway"]["port"])
+    env = {**os.environ, "GW_DATA_DIR": str(workdir)}
+    if cfg["gateway"].get("capture"):
+        env["GW_CAPTURE"] = str(Path(cfg["gateway"]["capture"]).resolve())
+    workers = int(cfg["gateway"].get("workers") or 1)
+    if workers > 1:
+        env["GW_SHARED_STATE"] = str(workdir / "shared.db")
+    fleet_proc = gw_proc = None
+    try:
+        with open(workdir / "fleet.log", "wb") as fleet_log, open(workdir / "gateway.log", "wb") as gw_log:
+            fleet_proc = subprocess.Popen([sys.executable, "-m", "bench.fake_ollama", "--fleet", str(workdir / "fleet.json")],
+                                          cwd=ROOT, stdout=fleet_log, stderr=subprocess.STDOUT)
+            for p in phones:
+                await wait_ready(f"http://{host}:{p.port}/api/tags", 30)
+            gw_proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                                        "--port", str(port), "--log-level", "warning", "--workers", str(workers)],
+                                       cwd=ROOT, env=env, stdout=gw_log, stderr=subprocess.STDOUT)
+            await wait_ready(f"http://127.0.0.1:{port}/health", float(cfg["gateway"]["ready_timeout_s"]),
+                             lambda r: r.status_code == 200 and all(p["healthy"] for p in r.json()["phones"]))
+            async with httpx.AsyncClient(timeout=120) as client:
+                await client.post(f"http://127.0.0.1:{port}/warmup")   # ładowanie modeli poza pomiarem
+            load = cfg["load"]
+            if load.get("replay"):
+                from bench.replay import load_records, replay
+                result = await replay(f"http://127.0.0.1:{port}", load_records(load["replay"]),
+                                      float(load.get("speed") or 1.0), float(load["request_timeout_s"]), model)
+            else:
+                result = await drive(f"http://127.0.0.1:{port}", load, int(cfg["seed"]), model)
+            async with httpx.AsyncClient(timeout=10) as client:
+                metrics = (await client.get(f"http://127.0.0.1:{port}/metrics")).text
+            (workdir / "metrics.txt").write_text(metrics)
+    finally:
+        _stop(gw_proc)
+        _stop(fleet_proc)
+    return result
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Gateway benchmark against a simulated phone fleet")
+    ap.add_argument("scenario", nargs="?", help="scenariusz JSON (nakładany na DEFAULT_SCENARIO)")
+    ap.add_argument("--set", action="append", default=[], metavar="PATH=VALUE", help="np. load.concurrency=32")
+    ap.add_argument("--out", help="plik wyników (domyślnie stdout)")
+    ap.add_argument("--keep", action="store_true", help="nie usuwaj katalogu roboczego (logi, metrics.txt)")
+    a = ap.parse_args(argv)
+    cfg = DEFAULT_SCENARIO
+    if a.scenario:
+        cfg = _merge(cfg, json.loads(Path(a.scenario).read_text()))
+    else:
+        cfg = json.loads(json.dumps(cfg))
+    for s in a.set:
+        _set(cfg, s)
+    Profile.from_dict(cfg["fleet"].get("profile"))   # walidacja przed startem procesów
+
+    workdir = Path(tempfile.mkdtemp(prefix="gw-bench-"))
+    started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    try:
+        result = asyncio.run(run(cfg, workdir))
+    finally:
+        if a.keep:
+            print(f"workdir: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    out = {"scenario": cfg.get("name"), "commit": _git("rev-parse", "HEAD"),
+           "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+           "started_at": started, "config": cfg, **result}
+    text = json.dumps(out, indent=2)
+    if a.out:
+        Path(a.out).write_text(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
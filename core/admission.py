@@ -0,0 +1,118 @@
+# core/admission.py
+from __future__ import annotations
+import contextlib, hashlib, math
+from typing import Callable, Dict, Iterator, Mapping, Optional, Tuple
+
+class Overloaded(Exception):
+    """Limit przyjęć przekroczony -> 429 z nagłówkiem Retry-After."""
+    def __init__(self, endpoint: str, scope: str, limit: int, retry_after_s: int):
+        super().__init__(f"{endpoint}: {scope} limit of {limit} reached, retry after {retry_after_s}s")
+        self.endpoint = endpoint
+        self.scope = scope          # "endpoint" | "key" (najemca)
+        self.limit = limit
+        self.retry_after_s = retry_after_s
+
+def retry_after_s(depth: int, throughput_rps: float, lo: int = 1, hi: int = 300) -> int:
+    """Ile sekund, zanim praca przed nami (depth) zejdzie przy zmierzonej przepustowości floty."""
+    if throughput_rps <= 0:
+        return hi
+    return int(min(hi, max(lo, math.ceil((depth + 1) / throughput_rps))))
+
+DEFAULT_TENANT = "default"
+
+def tenant_of(api_key: Optional[str], header: Optional[str], names: Mapping[str, str]) -> str:
+    """
+    Najemca (zespół) żądania: nazwa przypisana kluczowi API, inaczej nagłówek
+    X-Tenant, inaczej skrót klucza (surowy klucz nie trafia do metryk).
+    """
+    if api_key and api_key in names:
+        return names[api_key]
+    if header:
+        return header
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:8]
+    return DEFAULT_TENANT
+
+class Admission:
+    """
+    Limity przyjęć per endpoint i per najemca (None = bez limitu):
+    - limits: {"ask": 64, "ask_batch": 256, "jobs": 10_000}
+    - key_limits: {"<najemca>": {"ask": 8}, "*": {...}} – "*" = domyślne dla każdego najemcy
+    - tenants: {"<X-API-Key>": "<najemca>"} – patrz tenant_of()
+    Dla /ask* liczone są żądania w trakcie obsługi (hold), dla /jobs – joby
+    w kolejce (JobsEngine pyta o limit() i sam zrzuca najmniej pilne).
+    Wszystko synchroniczne – bez locków w jednej pętli asyncio.
+    """
+    def __init__(self, limits: Mapping[str, Optional[int]],
+                 key_limits: Optional[Mapping[str, Mapping[str, Optional[int]]]] = None,
+                 tenants: Optional[Mapping[str, str]] = None):
+        self.limits = dict(limits)
+        self.key_limits = dict(key_limits or {})
+        self.tenants = dict(tenants or {})
+        self.inflight: Dict[str, int] = {}
+        self._by_key: Dict[Tuple[str, str], int] = {}
+        self.rejected: Dict[Tuple[str, str], int] = {}   # (endpoint, scope)
+        self.shed = 0
+
+    def tenant(self, api_key: Optional[str], header: Optional[str] = None) -> str:
+        return tenant_of(api_key, header, self.tenants)
+
+    def limit(self, endpoint: str, tenant: Optional[str] = None) -> Optional[int]:
+        """Limit endpointu (tenant=None) albo limit najemcy na tym endpoincie."""
+        if tenant is None:
+            return self.limits.get(endpoint)
+        per_tenant = self.key_limits.get(tenant) or self.key_limits.get("*") or {}
+        return per_tenant.get(endpoint)
+
+    def reject(self, endpoint: str, scope: str, limit: int, retry_after: int) -> Overloaded:
+        key = (endpoint, scope)
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+        return Overloaded(endpoint, scope, limit, retry_after)
+
+    def enter(self, endpoint: str, tenant: Optional[str], n: int,
+              retry_after: Callable[[int], int]) -> None:
+        """Zajmuje n miejsc albo rzuca Overloaded; retry_after(depth) liczone tylko przy odmowie."""
+        used = self.inflight.get(endpoint, 0)
+        lim = self.limit(endpoint)
+        if lim is not None and used + n > lim:
+            raise self.reject(endpoint, "endpoint", lim, retry_after(used))
+        if tenant is not None:
+            used_k = self._by_key.get((endpoint, tenant), 0)
+            lim_k = self.limit(endpoint, tenant)
+            if lim_k is not None and used_k + n > lim_k:
+                raise self.reject(endpoint, "key", lim_k, retry_after(used_k))
+            self._by_key[(endpoint, tenant)] = used_k + n
+        self.inflight[endpoint] = used + n
+
+    def leave(self, endpoint: str, tenant: Optional[str], n: int) -> None:
+        self.inflight[endpoint] = self.inflight.get(endpoint, 0) - n
+        if tenant is not None:
+            k = (endpoint, tenant)
+            left = self._by_key.get(k, 0) - n
+            if left > 0:
+                self._by_key[k] = left
+            else:
+                self._by_key.pop(k, None)
+
+    @contextlib.contextmanager
+    def hold(self, endpoint: str, tenant: Optional[str], n: int,
+             retry_after: Callable[[int], int]) -> Iterator[None]:
+        self.enter(endpoint, tenant, n, retry_after)
+        try:
+            yield
+        finally:
+            self.leave(endpoint, tenant, n)
+
+    def render_prom(self) -> str:
+        lines = ["# HELP gw_admission_rejected_total Requests rejected with 429 by admission control",
+                 "# TYPE gw_admission_rejected_total counter"]
+        for (endpoint, scope), v in self.rejected.items():
+            lines.append(f'gw_admission_rejected_total{{endpoint="{endpoint}",scope="{scope}"}} {v}')
+        lines += ["# HELP gw_admission_inflight Admitted requests currently being served",
+                  "# TYPE gw_admission_inflight gauge"]
+        for endpoint, v in self.inflight.items():
+            lines.append(f'gw_admission_inflight{{endpoint="{endpoint}"}} {v}')
+        lines += ["# HELP gw_jobs_shed_total Queued jobs dropped to admit more urgent ones",
+                  "# TYPE gw_jobs_shed_total counter",
+                  f"gw_jobs_shed_total {self.shed}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,107 @@
+# core/affinity.py
+from __future__ import annotations
+import bisect, hashlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+def _h(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+def affinity_key(session_id: Optional[str], system: Optional[str], prompt: str,
+                 min_prefix_chars: int = 256, prefix_chars: int = 1024) -> Optional[str]:
+    """
+    Klucz powinowactwa (KV cache Ollamy na telefonie):
+    - session_id -> kolejne tury rozmowy na ten sam telefon
+    - system prompt -> żądania ze wspólnym promptem systemowym
+    - długi prompt -> jego prefiks
+    """
+    if session_id:
+        return f"s:{session_id}"
+    if system:
+        return f"p:{hashlib.sha256(system.encode()).hexdigest()}"
+    if len(prompt) >= min_prefix_chars:
+        return f"p:{hashlib.sha256(prompt[:prefix_chars].encode()).hexdigest()}"
+    return None
+
+class HashRing:
+    """Consistent hashing z wirtualnymi węzłami – dodanie/usunięcie telefonu przesuwa ~1/n kluczy."""
+    def __init__(self, vnodes: int = 64):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[Any] = []
+        self._nodes: Dict[int, Tuple[Any, str]] = {}
+
+    def add(self, node: Any, name: str) -> None:
+        self._nodes[id(node)] = (node, name)
+        self._rebuild()
+
+    def remove(self, node: Any) -> None:
+        if self._nodes.pop(id(node), None) is not None:
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        pts = sorted((_h(f"{name}#{i}"), node) for node, name in self._nodes.values()
+                     for i in range(self.vnodes))
+        self._points = [p for p, _ in pts]
+        self._owners = [n for _, n in pts]
+
+    def walk(self, key: str) -> Iterator[Any]:
+        """Kolejne różne węzły zgodnie z ruchem wskazówek zegara od hasha klucza."""
+        if not self._points:
+            return
+        start = bisect.bisect(self._points, _h(key)) % len(self._points)
+        seen = set()
+        for i in range(len(self._points)):
+            node = self._owners[(start + i) % len(self._points)]
+            if id(node) not in seen:
+                seen.add(id(node))
+                yield node
+                if len(seen) == len(self._nodes):
+                    return
+
+class AffinityStats:
+    """
+    Oszczędność prompt_eval: dla żądań na telefon z powinowactwa porównujemy
+    faktyczny czas prompt_eval z EWMA "zimnego" kosztu (s/znak) tego telefonu
+    mierzonego na pozostałych żądaniach.
+    """
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.routed = {"preferred": 0, "fallback": 0}
+        self.prompt_eval_s = {"hit": 0.0, "miss": 0.0}
+        self.prompt_eval_n = {"hit": 0, "miss": 0}
+        self.saved_s = 0.0
+        self._cold_rate: Dict[int, float] = {}   # id(phone) -> s/znak
+
+    def observe(self, phone: Any, hit: bool, prompt_chars: int, data: Dict[str, Any]) -> None:
+        dur = data.get("prompt_eval_duration")
+        if dur is None or prompt_chars <= 0:
+            return
+        actual = dur / 1e9
+        tag = "hit" if hit else "miss"
+        self.prompt_eval_s[tag] += actual
+        self.prompt_eval_n[tag] += 1
+        rate = self._cold_rate.get(id(phone))
+        if hit:
+            if rate is not None:
+                self.saved_s += max(0.0, rate * prompt_chars - actual)
+        else:
+            cur = actual / prompt_chars
+            self._cold_rate[id(phone)] = cur if rate is None else (1 - self.alpha) * rate + self.alpha * cur
+
+    def render_prom(self) -> str:
+        lines = ["# HELP gw_affinity_routed_total Affinity requests by where they landed",
+                 "# TYPE gw_affinity_routed_total counter"]
+        for k, v in self.routed.items():
+            lines.append(f'gw_affinity_routed_total{{result="{k}"}} {v}')
+        lines += ["# HELP gw_prompt_eval_seconds_total Prompt evaluation time reported by phones",
+                  "# TYPE gw_prompt_eval_seconds_total counter"]
+        for k in ("hit", "miss"):
+            lines.append(f'gw_prompt_eval_seconds_total{{affinity="{k}"}} {self.prompt_eval_s[k]:.6f}')
+        lines += ["# HELP gw_prompt_eval_requests_total Requests with prompt_eval stats",
+                  "# TYPE gw_prompt_eval_requests_total counter"]
+        for k in ("hit", "miss"):
+            lines.append(f'gw_prompt_eval_requests_total{{affinity="{k}"}} {self.prompt_eval_n[k]}')
+        lines += ["# HELP gw_affinity_prompt_eval_saved_seconds_total Estimated prompt eval time saved by affinity",
+                  "# TYPE gw_affinity_prompt_eval_saved_seconds_total counter",
+                  f"gw_affinity_prompt_eval_saved_seconds_total {self.saved_s:.6f}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,202 @@
+# core/cache.py
+from __future__ import annotations
+import asyncio, json, sqlite3, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+def is_deterministic(options: Dict[str, Any]) -> bool:
+    """Ollama bez temperature losuje (domyślnie 0.8) – powtarzalne tylko temperature=0 albo seed."""
+    if options.get("seed") is not None:
+        return True
+    t = options.get("temperature")
+    try:
+        return t is not None and float(t) == 0.0
+    except (TypeError, ValueError):
+        return False   # nieliczbowa temperatura – nie zgadujemy, bez cache
+
+def should_cache(options: Dict[str, Any], override: Optional[bool]) -> bool:
+    return override if override is not None else is_deterministic(options)
+
+class ResponseCache:
+    """
+    Dwupoziomowy cache odpowiedzi:
+    - pamięć: LRU ograniczone bajtami (rozmiar = długość JSON-a)
+    - dysk (opcjonalnie): SQLite, przeżywa restart; trafienie promuje wpis do pamięci
+    Każdy wpis ma własny TTL. Pamięć obsługiwana w pętli asyncio (bez locka); dysk poza nią:
+    get() czyta bazę w wątku (to_thread), set() odkłada zapis, a run() zapisuje odłożone
+    wpisy co flush_s jedną transakcją w wątku (ostatnia wartość klucza wygrywa).
+    shared=True: plik dyskowy piszą też inne procesy bramki – rozmiar dysku liczony
+    na nowo z bazy (co SYNC_S) zamiast tylko z własnych zapisów.
+    """
+    SYNC_S = 5.0
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_s: float = 3600.0,
+                 disk_path: Optional[Path] = None, disk_max_bytes: int = 1024 * 1024 * 1024,
+                 shared: bool = False, flush_s: float = 0.2):
+        self.max_bytes = max_bytes
+        self.flush_s = flush_s
+        self._pending: Dict[str, Tuple[bytes, int, float]] = {}   # klucz -> (blob, rozmiar, wygasa) do zapisu
+        self._changed = asyncio.Event()
+        self._lock = threading.Lock()   # jedno połączenie: odczyty i zapisy z wątków
+        self.shared = shared
+        self._synced = 0.0
+        self.ttl_s = ttl_s
+        self.disk_max_bytes = disk_max_bytes
+        self._mem: "OrderedDict[str, Tuple[Dict[str, Any], int, float]]" = OrderedDict()
+        self._mem_bytes = 0
+        self.stats: Dict[str, int] = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "sets": 0,
+                                      "evictions_memory": 0, "evictions_disk": 0, "expired": 0}
+        self.db: Optional[sqlite3.Connection] = None
+        if disk_path is not None:
+            self.db = sqlite3.connect(str(disk_path), isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                            "size INTEGER NOT NULL, expires_at REAL NOT NULL, atime REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS cache_atime ON cache(atime)")
+            self._disk_bytes = self.db.execute("SELECT COALESCE(SUM(size),0) FROM cache").fetchone()[0]
+
+    def close(self) -> None:
+        if self.db is not None:
+            self._write_pending()
+            with self._lock:   # zapis z anulowanego run() mógł jeszcze trwać w wątku
+                self.db.close(); self.db = None
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        hit = self._mem.get(key)
+        if hit is not None:
+            val, size, expires_at = hit
+            if expires_at > now:
+                self._mem.move_to_end(key)
+                self.stats["hits_memory"] += 1
+                return val
+            self._drop_mem(key); self.stats["expired"] += 1
+        if self.db is not None:
+            row = self._pending.get(key) or await asyncio.to_thread(self._disk_get, key, now)
+            if row is not None:
+                blob, size, expires_at = row
+                if expires_at > now:
+                    val = json.loads(blob)
+                    self._put_mem(key, val, size, expires_at)
+                    self.stats["hits_disk"] += 1
+                    return val
+                self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        return None
+
+    def _disk_get(self, key: str, now: float) -> Optional[Tuple[bytes, int, float]]:
+        """Wątek: wpis z dysku (odświeża atime; wygasły jest usuwany, ale zwracany – licznik expired)."""
+        with self._lock:
+            row = self.db.execute("SELECT value, size, expires_at FROM cache WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[2] > now:
+                self.db.execute("UPDATE cache SET atime=? WHERE key=?", (now, key))
+            else:
+                self.db.execute("DELETE FROM cache WHERE key=?", (key,))
+                self._disk_bytes -= row[1]
+            return row
+
+    def set(self, key: str, val: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        blob = json.dumps(val, ensure_ascii=False).encode()
+        size = len(blob)
+        expires_at = time.time() + (self.ttl_s if ttl_s is None else ttl_s)
+        self.stats["sets"] += 1
+        self._put_mem(key, val, size, expires_at)
+        if self.db is not None and size <= self.disk_max_bytes:
+            self._pending[key] = (blob, size, expires_at)
+            self._changed.set()
+
+    async def run(self) -> None:
+        """Pętla zapisu dysku: pierwsza zmiana -> odczekanie flush_s -> zapis odłożonych w wątku."""
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await asyncio.sleep(self.flush_s)
+            if self.db is None:
+                continue
+            rows, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except sqlite3.Error:
+                self._pending = {**rows, **self._pending}   # ponowna próba po flush_s
+                self._changed.set()
+
+    def _write_pending(self) -> None:
+        rows, self._pending = self._pending, {}
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows: Dict[str, Tuple[bytes, int, float]]) -> None:
+        """Wątek: jedna transakcja – wstawienie odłożonych wpisów, rozmiar dysku, eksmisja."""
+        with self._lock:
+            now = time.time()
+            self.db.execute("BEGIN")
+            try:
+                for key, (blob, size, expires_at) in rows.items():
+                    old = self.db.execute("SELECT size FROM cache WHERE key=?", (key,)).fetchone()
+                    self.db.execute("INSERT OR REPLACE INTO cache (key, value, size, expires_at, atime) "
+                                    "VALUES (?,?,?,?,?)", (key, blob, size, expires_at, now))
+                    self._disk_bytes += size - (old[0] if old else 0)
+                if self.shared and time.monotonic() - self._synced >= self.SYNC_S:
+                    self._synced = time.monotonic()
+                    self._disk_bytes = self.db.execute("SELECT COALESCE(SUM(size),0) FROM cache").fetchone()[0]
+                self._evict_disk()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _put_mem(self, key: str, val: Dict[str, Any], size: int, expires_at: float) -> None:
+        if size > self.max_bytes:
+            return  # większe niż cały budżet – tylko dysk
+        if key in self._mem:
+            self._drop_mem(key)
+        self._mem[key] = (val, size, expires_at)
+        self._mem_bytes += size
+        while self._mem_bytes > self.max_bytes:
+            old_key = next(iter(self._mem))
+            self._drop_mem(old_key); self.stats["evictions_memory"] += 1
+
+    def _drop_mem(self, key: str) -> None:
+        _, size, _ = self._mem.pop(key)
+        self._mem_bytes -= size
+
+    def _evict_disk(self) -> None:
+        if self._disk_bytes <= self.disk_max_bytes:
+            return
+        now = time.time()
+        self._disk_bytes -= self.db.execute(
+            "SELECT COALESCE(SUM(size),0) FROM cache WHERE expires_at <= ?", (now,)).fetchone()[0]
+        self.db.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        drop: List[Tuple[str]] = []
+        for k, size in self.db.execute("SELECT key, size FROM cache ORDER BY atime"):
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            drop.append((k,)); self._disk_bytes -= size
+        self.db.executemany("DELETE FROM cache WHERE key=?", drop)
+        self.stats["evictions_disk"] += len(drop)
+
+    def render_prom(self) -> str:
+        lines = ["# HELP gw_cache_requests_total Cache lookups by outcome",
+                 "# TYPE gw_cache_requests_total counter",
+                 f'gw_cache_requests_total{{result="hit",tier="memory"}} {self.stats["hits_memory"]}',
+                 f'gw_cache_requests_total{{result="hit",tier="disk"}} {self.stats["hits_disk"]}',
+                 f'gw_cache_requests_total{{result="miss"}} {self.stats["misses"]}',
+                 "# HELP gw_cache_evictions_total Entries evicted for the byte budget",
+                 "# TYPE gw_cache_evictions_total counter",
+                 f'gw_cache_evictions_total{{tier="memory"}} {self.stats["evictions_memory"]}',
+                 f'gw_cache_evictions_total{{tier="disk"}} {self.stats["evictions_disk"]}',
+                 "# HELP gw_cache_expired_total Entries dropped after TTL",
+                 "# TYPE gw_cache_expired_total counter",
+                 f'gw_cache_expired_total {self.stats["expired"]}',
+                 "# HELP gw_cache_bytes Bytes held per tier",
+                 "# TYPE gw_cache_bytes gauge",
+                 f'gw_cache_bytes{{tier="memory"}} {self._mem_bytes}',
+                 f'gw_cache_bytes{{tier="disk"}} {self._disk_bytes if self.db is not None else 0}',
+                 "# HELP gw_cache_entries Entries held in memory",
+                 "# TYPE gw_cache_entries gauge",
+                 f"gw_cache_entries {len(self._mem)}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,200 @@
+# core/capture.py
+from __future__ import annotations
+import asyncio, contextlib, hashlib, json, os, time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from core.admission import Overloaded
+
+# rekord bieżącego żądania – wypełniany po drodze przez Gateway (_slot, _chat_events)
+_current: ContextVar[Optional[Dict[str, Any]]] = ContextVar("traffic_record", default=None)
+
+def body_sha(body: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":"),
+                                     ensure_ascii=False).encode()).hexdigest()[:16]
+
+def status_of(e: BaseException) -> str:
+    code = getattr(e, "status_code", None)   # HTTPException
+    if code is not None:
+        return str(code)
+    if isinstance(e, Overloaded):
+        return "429"
+    if isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    return "error"
+
+# --- wywoływane z wnętrza bramki; bez aktywnego rekordu nic nie robią ---
+def note_wait(wait_s: float) -> None:
+    rec = _current.get()
+    if rec is not None:
+        rec["wait_s"] = round(rec.get("wait_s", 0.0) + wait_s, 4)
+
+def note_attempt(phone: str) -> None:
+    rec = _current.get()
+    if rec is not None:
+        rec["phone"] = phone
+        rec["attempts"] = rec.get("attempts", 0) + 1
+
+def note_done(ttft_s: Optional[float], final: Dict[str, Any]) -> None:
+    rec = _current.get()
+    if rec is not None:
+        if ttft_s is not None and "ttft_s" not in rec:
+            rec["ttft_s"] = round(ttft_s, 4)
+        rec["prompt_tokens"] = rec.get("prompt_tokens", 0) + int(final.get("prompt_eval_count") or 0)
+        rec["eval_tokens"] = rec.get("eval_tokens", 0) + int(final.get("eval_count") or 0)
+
+def bind(rec: Optional[Dict[str, Any]]) -> None:
+    """Rekord jako bieżący do końca tasku – dla tasków obsługujących w całości jeden rekord (job)."""
+    if rec is not None:
+        _current.set(rec)
+
+def mark(**fields: Any) -> None:
+    rec = _current.get()
+    if rec is not None:
+        rec.update(fields)
+
+class TrafficLog:
+    """
+    Zapis ruchu produkcyjnego do rotowanego JSONL (planowanie pojemności, bench/replay.py):
+    rekord = przybycie (t, epoch), endpoint, najemca, skrót ciała (albo całe ciało
+    przy full_body), rozmiar promptu, options, wybrany telefon, czekanie na slot,
+    latencja, TTFT, tokeny i status.
+    - path=None -> wyłączone (begin() zwraca None, reszta to no-op)
+    - zapis poza pętlą asyncio (to_thread) co flush_s; ponad max_pending rekordów
+      czekających na zapis nowe są liczone jako dropped zamiast blokować żądania
+    - rotacja po max_bytes: path -> path.1 -> ... -> path.<backups>
+    """
+    def __init__(self, path: Optional[Path], max_bytes: int = 64 * 1024 * 1024, backups: int = 5,
+                 full_body: bool = False, flush_s: float = 1.0, max_pending: int = 100_000):
+        self.path = Path(path) if path else None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.full_body = full_body
+        self.flush_s = flush_s
+        self.max_pending = max_pending
+        self._pending: List[str] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def begin(self, endpoint: str, body: Dict[str, Any], tenant: Optional[str],
+              t: Optional[float] = None, **extra: Any) -> Optional[Dict[str, Any]]:
+        """Nowy rekord (t = przybycie, domyślnie teraz); None gdy zapis wyłączony."""
+        if not self.enabled:
+            return None
+        rec: Dict[str, Any] = {"t": round(time.time() if t is None else t, 4), "ep": endpoint, "tenant": tenant,
+                               "model": body.get("model"), "sha": body_sha(body),
+                               "prompt_chars": len(body.get("prompt") or "") + len(body.get("system") or "")}
+        if body.get("options"):
+            rec["options"] = body["options"]
+        if body.get("session_id"):
+            rec["session"] = True
+        if self.full_body:
+            rec["body"] = body
+        rec.update({k: v for k, v in extra.items() if v is not None})
+        return rec
+
+    @contextlib.contextmanager
+    def active(self, rec: Optional[Dict[str, Any]]) -> Iterator[Optional[Dict[str, Any]]]:
+        """Rekord jako bieżący dla note_*/mark (w tym tasku i tworzonych w nim); wyjątek -> status."""
+        if rec is None:
+            yield None; return
+        token = _current.set(rec)
+        try:
+            yield rec
+        except BaseException as e:
+            rec.setdefault("status", status_of(e))
+            raise
+        finally:
+            with contextlib.suppress(ValueError):   # async generator domknięty z innego kontekstu
+                _current.reset(token)
+
+    def finish(self, rec: Optional[Dict[str, Any]], status: Optional[str] = None) -> None:
+        if rec is None:
+            return
+        rec["latency_s"] = round(time.time() - rec["t"], 4)
+        if status is not None:
+            rec["status"] = status
+        rec.setdefault("status", "ok")
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(json.dumps(rec, separators=(",", ":"), ensure_ascii=False, default=str))
+
+    @contextlib.contextmanager
+    def request(self, endpoint: str, body: Dict[str, Any], tenant: Optional[str],
+                **extra: Any) -> Iterator[Optional[Dict[str, Any]]]:
+        """begin + active + finish dla obsługi zamkniętej w jednym bloku."""
+        rec = self.begin(endpoint, body, tenant, **extra)
+        try:
+            with self.active(rec):
+                yield rec
+        finally:
+            self.finish(rec)
+
+    # --- zapis ---
+    async def start(self):
+        if self.enabled and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flusher
+            self._flusher = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_s)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        await asyncio.to_thread(self._write, lines)
+        self.written += len(lines)
+
+    def _write(self, lines: List[str]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            size = f.tell()
+        if size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def render_prom(self) -> str:
+        if not self.enabled:
+            return ""
+        return "\n".join([
+            "# HELP gw_capture_records_total Traffic records written to the capture log",
+            "# TYPE gw_capture_records_total counter",
+            f"gw_capture_records_total {self.written}",
+            "# HELP gw_capture_dropped_total Traffic records dropped because the writer fell behind",
+            "# TYPE gw_capture_dropped_total counter",
+            f"gw_capture_dropped_total {self.dropped}",
+        ]) + "\n"
+
+def log_files(path: Path) -> List[Path]:
+    """Pliki logu od najstarszego (path.N ... path.1, path)."""
+    path = Path(path)
+    rotated = sorted((p for p in path.parent.glob(path.name + ".*") if p.suffix[1:].isdigit()),
+                     key=lambda p: int(p.suffix[1:]), reverse=True)
+    return rotated + ([path] if path.exists() else [])
@@ -0,0 +1,60 @@
+# core/deadlines.py
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass, fields, replace
+from typing import Any, Awaitable, Mapping, Optional, Tuple
+
+class PhaseTimeout(TimeoutError):
+    """Przekroczony limit jednej fazy wywołania telefonu (connect/ttft/inter_token/total)."""
+    def __init__(self, phase: str, limit_s: float):
+        super().__init__(f"{phase} deadline exceeded ({limit_s:.1f}s)")
+        self.phase = phase
+        self.limit_s = limit_s
+
+@dataclass(frozen=True)
+class Deadlines:
+    """
+    Limity czasowe wywołania /api/chat (None = bez limitu):
+    - connect_s: nawiązanie połączenia TCP
+    - ttft_s: od wysłania żądania do pierwszej linii strumienia (ładowanie modelu + prompt eval)
+    - inter_token_s: maks. przerwa między kolejnymi liniami (wykrywanie zawieszenia)
+    - total_s: całe wywołanie, łącznie z wznowieniami na innych telefonach
+    """
+    connect_s: Optional[float] = 5.0
+    ttft_s: Optional[float] = 120.0
+    inter_token_s: Optional[float] = 30.0
+    total_s: Optional[float] = 900.0
+
+    def merged(self, overrides: Optional[Mapping[str, Any]]) -> "Deadlines":
+        if not overrides:
+            return self
+        known = {f.name for f in fields(self)}
+        unknown = set(overrides) - known
+        if unknown:
+            raise ValueError(f"unknown deadline(s): {', '.join(sorted(unknown))} (known: {', '.join(sorted(known))})")
+        return replace(self, **{k: (None if v is None else float(v)) for k, v in overrides.items()})
+
+def check_overrides(overrides: Optional[Mapping[str, Any]]) -> Optional[Mapping[str, Any]]:
+    """Walidacja pola `deadlines` z żądania (ValueError -> 422 w pydantic)."""
+    Deadlines().merged(overrides)
+    return overrides
+
+def resolve_deadlines(base: Deadlines, per_model: Mapping[str, Mapping[str, Any]],
+                      model: Optional[str], request: Optional[Mapping[str, Any]]) -> Deadlines:
+    """Domyślne -> per model -> per żądanie."""
+    return base.merged(per_model.get(model or "")).merged(request)
+
+def phase_budget(phase: str, phase_left: Optional[float], total_left: Optional[float]) -> Tuple[Optional[float], str]:
+    """(timeout, faza) dla najbliższego oczekiwania – limit fazy przycięty pozostałym czasem całkowitym."""
+    if total_left is not None and (phase_left is None or total_left < phase_left):
+        return max(0.0, total_left), "total"
+    return (None if phase_left is None else max(0.0, phase_left)), phase
+
+async def within(aw: Awaitable[Any], timeout: Optional[float], phase: str) -> Any:
+    """await z limitem fazy; przekroczenie -> PhaseTimeout(phase)."""
+    if timeout is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise PhaseTimeout(phase, timeout) from None
@@ -0,0 +1,79 @@
+# core/embed.py
+from __future__ import annotations
+import math, struct, sys
+from array import array
+from typing import Any, Dict, List, Sequence, Tuple
+
+F32_MEDIA_TYPE = "application/octet-stream"
+
+def est_tokens(text: str) -> int:
+    # ~4 znaki na token – tylko do wielkości kawałków (prawdziwą liczbę zwraca Ollama: prompt_eval_count)
+    return max(1, math.ceil(len(text) / 4))
+
+def chunk_end(texts: Sequence[str], start: int, stop: int, tokens_per_s: float, target_s: float,
+              lo: int, hi: int) -> int:
+    """
+    Koniec kawałka texts[start:end] (end <= stop) na ~target_s pracy telefonu o przepustowości
+    tokens_per_s – szybki telefon dostaje więcej tekstów, wolny mniej; zawsze lo..hi tekstów.
+    """
+    budget = tokens_per_s * target_s
+    end, used = start, 0
+    while end < stop and end - start < hi:
+        if end - start >= lo and used + est_tokens(texts[end]) > budget:
+            break
+        used += est_tokens(texts[end])
+        end += 1
+    return end
+
+def pack_f32(vectors: Sequence[Sequence[float]]) -> Tuple[bytes, int]:
+    """Wektory -> (float32 little-endian wierszami, wymiar); różne wymiary -> ValueError."""
+    dim = len(vectors[0]) if vectors else 0
+    flat = array("f")
+    for v in vectors:
+        if len(v) != dim:
+            raise ValueError(f"embedding dimension mismatch: {len(v)} != {dim}")
+        flat.extend(v)
+    if sys.byteorder == "big":
+        flat.byteswap()
+    return flat.tobytes(), dim
+
+def f32_body(result: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+    """Wynik embed() -> ciało binarnej odpowiedzi + nagłówki z liczbą wektorów, wymiarem i modelem."""
+    body, dim = pack_f32(result["embeddings"])
+    return body, {"X-Embedding-Count": str(len(result["embeddings"])), "X-Embedding-Dim": str(dim),
+                  "X-Model": str(result.get("model") or "")}
+
+def unpack_f32(data: bytes, dim: int) -> List[List[float]]:
+    """Odwrotność pack_f32 (klient / benchmark)."""
+    flat = struct.unpack(f"<{len(data) // 4}f", data)
+    return [list(flat[i:i + dim]) for i in range(0, len(flat), dim)] if dim else []
+
+class EmbedStats:
+    """Liczniki /embed: kawałki per telefon i wynik, teksty, ponowienia kawałków na innym telefonie."""
+    def __init__(self):
+        self.chunks: Dict[Tuple[str, str], int] = {}   # (telefon, ok|error)
+        self.texts = 0
+        self.retries = 0
+        self.failed = 0   # żądania bez kompletu wektorów
+
+    def chunk(self, phone: str, ok: bool, n: int) -> None:
+        k = (phone, "ok" if ok else "error")
+        self.chunks[k] = self.chunks.get(k, 0) + 1
+        if ok:
+            self.texts += n
+
+    def render_prom(self) -> str:
+        lines = ["# HELP gw_embed_chunks_total Embedding chunks sent to phones by outcome",
+                 "# TYPE gw_embed_chunks_total counter"]
+        for (phone, result), v in self.chunks.items():
+            lines.append(f'gw_embed_chunks_total{{phone="{phone}",result="{result}"}} {v}')
+        lines += ["# HELP gw_embed_texts_total Texts embedded",
+                  "# TYPE gw_embed_texts_total counter",
+                  f"gw_embed_texts_total {self.texts}",
+                  "# HELP gw_embed_retries_total Failed chunks re-sent to another phone",
+                  "# TYPE gw_embed_retries_total counter",
+                  f"gw_embed_retries_total {self.retries}",
+                  "# HELP gw_embed_failed_total Embedding requests that could not embed every text",
+                  "# TYPE gw_embed_failed_total counter",
+                  f"gw_embed_failed_total {self.failed}"]
+        return "\n".join(lines) + "\n"
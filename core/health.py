@@ -0,0 +1,172 @@
+# core/health.py
+from __future__ import annotations
+import random, time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+CLOSED, SUSPECT, OPEN, HALF_OPEN = "closed", "suspect", "open", "half_open"
+STATES = (CLOSED, SUSPECT, OPEN, HALF_OPEN)
+
+@dataclass(frozen=True)
+class HealthPolicy:
+    """
+    Parametry automatu zdrowia telefonu:
+    - fail_threshold: kolejne porażki (błąd, zawieszenie, nieudana sonda) -> open
+    - open_s .. open_max_s: czas otwarcia, x2 po każdej nieudanej próbie half-open
+    - half_open_trials: ile żądań naraz wpuszczać na próbę; half_open_successes: ile udanych -> closed
+    - suspect_clear: kolejne sukcesy, po których suspect wraca do closed (albo suspect_quiet_s bez sygnałów)
+    - outlier_factor: tokeny/s poniżej EWMA / factor = odstające (telefon podejrzany)
+    - probe_*: sondowanie /api/tags – szybkie dla podejrzanych, wolne dla stabilnych
+      (closed bez sygnałów od stable_after_s), zawsze z jitterem ±probe_jitter
+    """
+    fail_threshold: int = 3
+    open_s: float = 5.0
+    open_max_s: float = 120.0
+    half_open_trials: int = 1
+    half_open_successes: int = 2
+    suspect_clear: int = 3
+    suspect_quiet_s: float = 30.0
+    outlier_factor: float = 3.0
+    probe_fast_s: float = 1.0
+    probe_s: float = 10.0
+    probe_slow_s: float = 30.0
+    stable_after_s: float = 120.0
+    probe_jitter: float = 0.2
+
+class PhoneHealth:
+    """
+    Automat stanu jednego telefonu – jedyne miejsce, które zmienia licznik porażek
+    i czas otwarcia (wcześniej _post_chat / _stream_chat / health-check robiły to osobno):
+
+        closed --porażka/odstająca latencja--> suspect --fail_threshold porażek--> open
+        open --udana sonda po open_until--> half_open --half_open_successes--> closed
+        half_open --porażka--> open (dłużej)      suspect --suspect_clear sukcesów--> closed
+
+    Sygnały bierne: on_success()/on_failure() z prawdziwych wywołań, aktywne: on_probe().
+    Czas: monotoniczny (loop.time() / time.monotonic()), przekazywany z zewnątrz.
+    Synchroniczne – jedna pętla asyncio.
+    """
+    def __init__(self, key: str, policy: HealthPolicy,
+                 on_transition: Optional[Callable[["PhoneHealth", str, str, str], None]] = None):
+        self.key = key
+        self.policy = policy
+        self.on_transition = on_transition
+        self.state = CLOSED
+        self.failures = 0          # kolejne porażki
+        self.successes = 0         # kolejne sukcesy (suspect / half_open)
+        self.open_until = 0.0
+        self.open_s = policy.open_s
+        self.last_signal = 0.0     # ostatnia porażka / odstająca latencja
+        self.since = time.monotonic()   # wejście w bieżący stan (zegar pętli asyncio)
+
+    def _go(self, new: str, now: float, reason: str):
+        old, self.state, self.since = self.state, new, now
+        self.successes = 0
+        if new == OPEN:
+            self.open_until = now + self.open_s
+        elif new == CLOSED:
+            self.failures = 0
+            self.open_s = self.policy.open_s
+        if self.on_transition is not None:
+            self.on_transition(self, old, new, reason)
+
+    def admits(self, load: int, now: float) -> bool:
+        """Czy wpuścić kolejne żądanie (load = inflight + queued telefonu)."""
+        if self.state == OPEN:
+            return False
+        if self.state == HALF_OPEN:
+            return load < self.policy.half_open_trials
+        return True
+
+    def on_success(self, now: float, tps: Optional[float] = None, ewma_tps: Optional[float] = None):
+        if self.state == OPEN:
+            return   # żądanie sprzed otwarcia – o powrocie decyduje sonda
+        self.failures = 0
+        if tps is not None and ewma_tps and tps < ewma_tps / self.policy.outlier_factor:
+            self.last_signal = now
+            if self.state == CLOSED:
+                self._go(SUSPECT, now, f"slow: {tps:.1f} tok/s vs ewma {ewma_tps:.1f}")
+            return
+        self.successes += 1
+        if self.state == HALF_OPEN and self.successes >= self.policy.half_open_successes:
+            self._go(CLOSED, now, f"{self.successes} trial requests ok")
+        elif self.state == SUSPECT and self.successes >= self.policy.suspect_clear:
+            self._go(CLOSED, now, f"{self.successes} requests ok")
+
+    def on_failure(self, now: float, kind: str):
+        self.last_signal = now
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN:
+            self.open_s = min(self.policy.open_max_s, self.open_s * 2)
+            self._go(OPEN, now, f"trial failed: {kind}")
+            return
+        self.failures += 1
+        self.successes = 0
+        if self.failures >= self.policy.fail_threshold:
+            self._go(OPEN, now, f"{self.failures} consecutive failures, last: {kind}")
+        elif self.state == CLOSED:
+            self._go(SUSPECT, now, kind)
+
+    def on_probe(self, ok: bool, now: float, reason: str = "probe"):
+        """Wynik sondy /api/tags: w open po open_until decyduje o half_open albo dłuższym open."""
+        if self.state == OPEN:
+            if now < self.open_until:
+                return
+            if ok:
+                self._go(HALF_OPEN, now, "probe ok")
+            else:
+                self.open_s = min(self.policy.open_max_s, self.open_s * 2)
+                self._go(OPEN, now, f"probe failed: {reason}")
+            return
+        if not ok:
+            self.on_failure(now, f"probe: {reason}")
+        elif self.state == SUSPECT and now - self.last_signal >= self.policy.suspect_quiet_s:
+            # sonda nie zeruje porażek (telefon może odpowiadać na /api/tags, a psuć /api/chat),
+            # ale podejrzany bez ruchu i bez nowych sygnałów wraca do closed
+            self._go(CLOSED, now, f"quiet for {self.policy.suspect_quiet_s:.0f}s")
+
+    def probe_in(self, now: float, rng: random.Random = random) -> float:
+        """Za ile sekund następna sonda – krótko dla podejrzanych, długo dla stabilnych."""
+        p = self.policy
+        if self.state == OPEN:
+            base = max(0.0, self.open_until - now) or p.probe_fast_s
+        elif self.state in (SUSPECT, HALF_OPEN):
+            base = p.probe_fast_s
+        elif now - max(self.last_signal, self.since) >= p.stable_after_s:
+            base = p.probe_slow_s
+        else:
+            base = p.probe_s
+        return base * (1.0 + rng.uniform(-p.probe_jitter, p.probe_jitter))
+
+class HealthEvents:
+    """Przejścia stanów wszystkich telefonów: licznik (metryka) + ostatnie zdarzenia (GET /health/events)."""
+    def __init__(self, maxlen: int = 1000):
+        self.transitions: Dict[Tuple[str, str, str], int] = {}   # (telefon, z, do)
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=maxlen)
+        self._seq = 0
+
+    def record(self, phone: str, old: str, new: str, reason: str) -> Dict[str, Any]:
+        k = (phone, old, new)
+        self.transitions[k] = self.transitions.get(k, 0) + 1
+        self._seq += 1
+        ev = {"seq": self._seq, "ts": time.time(), "phone": phone, "from": old, "to": new, "reason": reason}
+        self.recent.append(ev)
+        return ev
+
+    def since(self, seq: int = 0) -> List[Dict[str, Any]]:
+        return [e for e in self.recent if e["seq"] > seq]
+
+    def render_prom(self, states: Dict[str, str]) -> str:
+        """states: telefon -> bieżący stan."""
+        lines = ["# HELP gw_phone_health_transitions_total Phone health state machine transitions",
+                 "# TYPE gw_phone_health_transitions_total counter"]
+        for (phone, old, new), v in self.transitions.items():
+            lines.append(f'gw_phone_health_transitions_total{{phone="{phone}",from="{old}",to="{new}"}} {v}')
+        lines += ["# HELP gw_phone_health_state Current phone health state (1 = in state)",
+                  "# TYPE gw_phone_health_state gauge"]
+        for phone, cur in states.items():
+            for s in STATES:
+                lines.append(f'gw_phone_health_state{{phone="{phone}",state="{s}"}} {1 if s == cur else 0}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,61 @@
+# core/hedge.py
+from __future__ import annotations
+from typing import Dict, Optional
+
+from core.metrics import Histogram, LATENCY_BUCKETS
+
+class Hedger:
+    """
+    Hedged requests: gdy żądanie nie dostało pierwszego tokenu w czasie kwantyla
+    TTFT modelu (np. p95), wysyłamy duplikat na inny telefon; wygrywa pierwsza
+    udana odpowiedź, przegrana jest anulowana.
+
+    Budżet (token bucket): każde wywołanie telefonu (także bez hedgingu) dokłada
+    budget_pct żetonu, hedge kosztuje 1 – hedge'y nie przekroczą budget_pct
+    całego ruchu do floty.
+    """
+    def __init__(self, percentile: float = 0.95, budget_pct: float = 0.1, burst: float = 5.0,
+                 min_samples: int = 20, default_delay_s: Optional[float] = None, min_delay_s: float = 0.05):
+        self.percentile = percentile
+        self.budget_pct = budget_pct
+        self.burst = burst
+        self.min_samples = min_samples
+        self.default_delay_s = default_delay_s
+        self.min_delay_s = min_delay_s
+        self._tokens = 1.0
+        self._latency: Dict[str, Histogram] = {}
+        self.stats = {"issued": 0, "won": 0, "denied": 0, "no_phone": 0}
+
+    def observe(self, model: Optional[str], ttft_s: float) -> None:
+        h = self._latency.get(model or "")
+        if h is None:
+            h = self._latency[model or ""] = Histogram(LATENCY_BUCKETS)
+        h.observe(ttft_s)
+
+    def delay(self, model: Optional[str]) -> Optional[float]:
+        """Po ilu sekundach hedge'ować; None = za mało danych i brak domyślnego opóźnienia."""
+        h = self._latency.get(model or "")
+        if h is None or h.count < self.min_samples:
+            return self.default_delay_s
+        q = h.quantile(self.percentile)
+        return max(self.min_delay_s, q) if q is not None else self.default_delay_s
+
+    def on_request(self) -> None:
+        self._tokens = min(self.burst, self._tokens + self.budget_pct)
+
+    def try_spend(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        self.stats["denied"] += 1
+        return False
+
+    def render_prom(self) -> str:
+        lines = ["# HELP gw_hedge_total Hedged requests by outcome",
+                 "# TYPE gw_hedge_total counter"]
+        for k, v in self.stats.items():
+            lines.append(f'gw_hedge_total{{result="{k}"}} {v}')
+        lines += ["# HELP gw_hedge_budget_tokens Hedges currently allowed by the budget",
+                  "# TYPE gw_hedge_budget_tokens gauge",
+                  f"gw_hedge_budget_tokens {self._tokens:.3f}"]
+        return "\n".join(lines) + "\n"
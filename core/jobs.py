@@ -1,137 +1,709 @@
 # core/jobs.py
 from __future__ import annotations
-import asyncio, uuid
+import asyncio, hashlib, heapq, json, math, time, uuid
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Dict, Any, Optional, Tuple, List, AsyncIterator
+from typing import Dict, Any, Optional, Tuple, List, AsyncIterator, Container
 from datetime import datetime, timezone
 from contextlib import suppress
 
+from core import capture
+from core.admission import DEFAULT_TENANT, Admission
+from core.capture import TrafficLog
+from core.jobstore import FINISHED, JobStore
+from core.shared import SharedState
+from core.streambuf import ChunkBuffer
+
 def _iso_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+def request_key(req: Dict[str, Any]) -> str:
+    # te same pola co cache_key() w server.py; job embeddingów – lista tekstów
+    if req.get("kind") == "embed":
+        payload = {"kind": "embed", "input": req.get("input"), "model": req.get("model")}
+    else:
+        payload = {"prompt": req.get("prompt"), "system": req.get("system"),
+                   "model": req.get("model"), "options": req.get("options") or {}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
 @dataclass
 class Job:
     id: str
     req: Dict[str, Any]           # AskRequest as dict
     priority: int = 5             # 0 = najwyższy
-    status: str = "queued"        # queued | running | done | error
+    status: str = "queued"        # queued | running | done | error | cancelled
     enqueued_at: str = field(default_factory=_iso_now)
     started_at: Optional[str] = None
     finished_at: Optional[str] = None
     device: Optional[Dict[str, Any]] = None   # {"host","port","serial"}
     result: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
-    # streaming
-    stream: bool = False
-    events: Optional[asyncio.Queue] = None    # Queue[Optional[bytes]]; None = sentinel
+    seq: int = 0                  # kolejność w obrębie priorytetu
+    coalesced_with: Optional[str] = None      # id joba-lidera, gdy identyczny był już w locie
+    tenant: Optional[str] = None              # klucz API zlecającego (limity per klucz)
+    group: Optional[str] = None               # grupa z /jobs/bulk
+    deadline: Optional[float] = None          # epoch (time.time()); po nim job nie jest już potrzebny
+    stream: bool = False          # klient chce surowy strumień (nagłówki "# ...", anulowanie po rozłączeniu)
 
 class JobsEngine:
     """
     Kolejka zadań:
-    - enqueue(): non-stream (worker woła _post_chat)
-    - enqueue_stream(): stream (worker woła _stream_chat i publikuje bajty na kolejkę)
+    - enqueue(): non-stream (_post_chat)
+    - enqueue_stream(): stream (_stream_chat, bajty publikowane na kolejkę)
+
+    Dispatcher zamiast puli workerów: job jest zdejmowany z kopca dopiero, gdy
+    gateway zarezerwuje dla niego konkretny wolny slot telefonu, więc kolejność
+    w kolejce = kolejność wykonania, a liczba slotów podąża za telefonami.
+
+    Z JobStore w self.jobs są tylko joby queued/running; zakończone (z wynikiem)
+    są w SQLite i czytane stamtąd przez get_status()/get_result().
+
+    Z Admission kolejka ma limit (całkowity i per klucz API): przy pełnej
+    kolejce zrzucany jest najmniej pilny czekający job (najwyższy priority,
+    najnowszy), a gdy nowy nie jest pilniejszy od żadnego – Overloaded (429).
+
+    Najemcy (tenant): każdy ma własny kopiec, a kolejny job bierze najemca
+    z najmniejszym czasem wirtualnym (WFQ) – obsłużony job przesuwa go o
+    1/waga, więc przy zapchanej kolejce sloty dzielą się wg TENANT_WEIGHTS
+    niezależnie od tego, ile i jak pilnych jobów ktoś wrzucił. Najemca, który
+    wraca po przerwie, startuje od bieżącego czasu wirtualnego (bez "oszczędności").
+    W obrębie najemcy: priorytet postarzany o jeden poziom na każde aging_s
+    czekania (klucz statyczny: priority + czas zgłoszenia / aging_s), więc niski
+    priorytet nie czeka w nieskończoność.
+
+    Deadline: w obrębie poziomu priorytetu najpierw najwcześniejszy deadline (EDF);
+    przy aging_s job z deadline'em bliższym niż aging_s liczy się, jakby czekał od
+    deadline - aging_s – kolejność wg deadline'u nie zależy od chwili zgłoszenia;
+    job, którego deadline minął przed startem, kończy się błędem bez telefonu,
+    a uruchomiony dostaje resztę czasu jako limit total_s wywołania.
+    cancel() usuwa job z kolejki albo przerywa wykonanie (slot wraca do puli).
+
+    Job embeddingów (req["kind"] == "embed"): zarezerwowany slot to pierwszy kawałek,
+    resztę gateway.embed() rozdziela po wolnych slotach floty.
+
+    Wyjście każdego joba (także non-stream) trafia do ChunkBuffer: follow()
+    pozwala dowolnej liczbie odbiorców odtworzyć je od offsetu i śledzić na
+    żywo; bufor żyje jeszcze OUTPUT_RETAIN_S po zakończeniu joba. Job stream,
+    którego nikt nie słucha przez STREAM_ABANDON_S, jest anulowany.
+
+    Tryb współdzielony (shared, kilka procesów bramki na jednym JobStore): job wykonuje
+    proces, który go przyjął (kolejka, WFQ i single-flight są per proces); status, wynik
+    i wyniki grup czyta każdy z bazy. Co SHARED_POLL_S proces przejmuje joby martwych
+    procesów (claim_orphans) i wykonuje prośby o anulowanie złożone u innych procesów.
     """
-    def __init__(self, gateway):
+    SCAN_LIMIT = 64         # ile jobów bez wolnego slotu (inny model) przejrzeć w jednej rundzie
+    POLL_S = 1.0            # okresowe wybudzenie (np. koniec circuit-open)
+    EVICT_INTERVAL_S = 60.0
+    OUTPUT_RETAIN_S = 300.0     # replay wyjścia po zakończeniu joba
+    STREAM_ABANDON_S = 30.0     # czas na ponowne podłączenie, zanim job stream zostanie anulowany
+    SHARED_POLL_S = 2.0         # tryb współdzielony: joby martwych procesów, anulowania z innych procesów
+
+    def __init__(self, gateway, store: Optional[JobStore] = None, admission: Optional[Admission] = None,
+                 weights: Optional[Dict[str, float]] = None, aging_s: Optional[float] = None,
+                 traffic: Optional[TrafficLog] = None, shared: Optional[SharedState] = None):
         self.gateway = gateway
-        self.q: "asyncio.PriorityQueue[Tuple[int,int,str]]" = asyncio.PriorityQueue()
+        self.store = store
+        self.shared = shared
+        self.admission = admission
+        self.traffic = traffic
+        self._captured: Dict[str, Dict[str, Any]] = {}     # job_id -> rekord ruchu wypełniany w _run
+        self.weights = dict(weights or {})
+        self.aging_s = aging_s
+        # najemca -> kopiec (postarzony priorytet, deadline|inf, seq, job_id)
+        self._queues: Dict[str, List[Tuple[float, float, int, str]]] = {}
+        self._vt: Dict[str, float] = {}    # czas wirtualny najemcy (WFQ)
+        self._vtime = 0.0                  # czas wirtualny ostatnio obsłużonego
+        self._deadlines: List[Tuple[float, str]] = []       # (deadline, job_id) – wygasanie w kolejce
+        # czekające joby zajmujące miejsce w kolejce (bez duplikatów) – limity _admit w O(log n)
+        self._waiting: Dict[str, int] = {}
+        self._n_waiting = 0
+        # kandydaci do zrzutu: kopce (-priority, -seq, job_id), nieaktualne wpisy pomijane leniwie
+        self._victims: List[Tuple[int, int, str]] = []
+        self._tenant_victims: Dict[str, List[Tuple[int, int, str]]] = {}
         self.jobs: Dict[str, Job] = {}
         self._seq = 0
-        self._workers: List[asyncio.Task] = []
-        self._lock = asyncio.Lock()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._evictor: Optional[asyncio.Task] = None
+        self._syncer: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._outputs: Dict[str, ChunkBuffer] = {}          # job_id -> wyjście (duplikaty dzielą bufor lidera)
+        self._retired: deque = deque()                       # (monotonic do usunięcia, job_id)
+        self._reapers: Dict[str, asyncio.Task] = {}
+        # single-flight: klucz żądania -> lider, lider -> joby czekające na jego wynik
+        self._leaders: Dict[str, str] = {}
+        self._followers: Dict[str, List[Job]] = {}
+        self.coalesced = 0
+        # wymieniany przy każdym zakończeniu joba – czytelnicy wyników grup czekają na bieżący
+        self._finished = asyncio.Event()
+        self._wake = asyncio.Event()
         self._stop_event = asyncio.Event()
+        gateway.add_slot_listener(self._wake.set)
 
-    async def start(self, worker_count: int):
-        worker_count = max(1, int(worker_count))
-        for i in range(worker_count):
-            self._workers.append(asyncio.create_task(self._worker(i)))
+    async def start(self):
+        if self.store is not None:
+            self._writer = asyncio.create_task(self.store.run())   # zapisy stanu jobów poza pętlą
+            if self.shared is not None:
+                self._recover(await self.store.claim_orphans(await self.shared.alive()))
+                self._syncer = asyncio.create_task(self._shared_loop())
+            else:
+                self._recover(await self.store.recover())
+            self._evictor = asyncio.create_task(self._evict_loop())
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
 
     async def stop(self):
         self._stop_event.set()
-        for w in self._workers:
-            w.cancel()
+        tasks = [t for t in (self._dispatcher, self._evictor, self._syncer, self._writer) if t] + list(self._running.values()) \
+            + list(self._reapers.values())
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
             with suppress(asyncio.CancelledError):
-                await w
+                await t
+        # przerwane joby zostają w store jako running -> wrócą do kolejki po restarcie
+        # (w trybie współdzielonym przejmą je pozostałe procesy)
+        if self.store is not None:
+            await self.store.flush()
+            self.store.close()
+
+    def _recover(self, rows: List[Dict[str, Any]]):
+        for row in rows:
+            job = Job(id=row["id"], req=row["req"], priority=row["priority"], seq=row["seq"],
+                      enqueued_at=row["enqueued_at"], stream=row["stream"], tenant=row["tenant"], group=row["group"],
+                      deadline=row["deadline"])
+            self._seq = max(self._seq, job.seq)
+            if job.stream:
+                # strumień nie ma już odbiorcy – nie wznawiamy
+                job.status, job.error, job.finished_at = "error", "interrupted by restart", _iso_now()
+                self.store.save(job, job.seq)
+                continue
+            self.jobs[job.id] = job
+            self._outputs[job.id] = ChunkBuffer()
+            self._enheap(job)
+            self.store.save(job, job.seq)  # running -> queued
+        if any(self._queues.values()):
+            self._wake.set()
+
+    async def _shared_loop(self):
+        while True:
+            await asyncio.sleep(self.SHARED_POLL_S)
+            for job_id in await self.store.cancel_requests():
+                if job_id in self.jobs:
+                    await self.cancel(job_id)
+            self._recover(await self.store.claim_orphans(await self.shared.alive()))
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(self.EVICT_INTERVAL_S)
+            await self.store.evict()
 
-    async def enqueue(self, req: Dict[str, Any], priority: int = 5) -> str:
+    def _persist(self, job: Job):
+        if self.store is None:
+            return
+        self.store.save(job, job.seq)
+        if job.status in FINISHED:
+            self.jobs.pop(job.id, None)  # wynik już na dysku
+
+    def _entry(self, job: Job) -> Tuple[float, float, int, str]:
+        level: float = job.priority
+        deadline = math.inf if job.deadline is None else job.deadline
+        if self.aging_s:
+            # starszy o aging_s = pilniejszy o poziom; względem innych jobów to samo co priority - czekanie/aging_s.
+            # Ciągle, bez okien: deadline rozstrzyga remis poziomów, a przy oknach tylko w obrębie jednego okna.
+            t = min(datetime.fromisoformat(job.enqueued_at).timestamp(), deadline - self.aging_s)
+            level += t / self.aging_s
+        return level, deadline, job.seq, job.id
+
+    def _enheap(self, job: Job):
+        tenant = job.tenant or DEFAULT_TENANT
+        q = self._queues.setdefault(tenant, [])
+        if not q:
+            # najemca wraca po przerwie – bez kredytu za czas bezczynności
+            self._vt[tenant] = max(self._vt.get(tenant, 0.0), self._vtime)
+        heapq.heappush(q, self._entry(job))
+        if job.deadline is not None:
+            heapq.heappush(self._deadlines, (job.deadline, job.id))
+        self._waiting[tenant] = self._waiting.get(tenant, 0) + 1
+        self._n_waiting += 1
+        self._push_victim(job)
+
+    def _push_victim(self, job: Job):
+        entry = (-job.priority, -job.seq, job.id)
+        heapq.heappush(self._victims, entry)
+        heapq.heappush(self._tenant_victims.setdefault(job.tenant or DEFAULT_TENANT, []), entry)
+
+    def _unqueue(self, job: Job):
+        """Job opuszcza kolejkę (start, zrzut, anulowanie, deadline) – przed zmianą statusu."""
+        if job.status != "queued" or job.coalesced_with is not None:
+            return
+        tenant = job.tenant or DEFAULT_TENANT
+        self._waiting[tenant] -= 1
+        self._n_waiting -= 1
+        # uruchomione joby to zwykle te najpilniejsze – na dno kopca, skąd leniwie nie zejdą
+        for heap, n in ((self._victims, self._n_waiting), (self._tenant_victims[tenant], self._waiting[tenant])):
+            if len(heap) > 2 * n + 64:
+                heap[:] = [e for e in heap if self._is_victim(e)]
+                heapq.heapify(heap)
+
+    def _is_victim(self, entry: Tuple[int, int, str]) -> bool:
+        job = self.jobs.get(entry[2])
+        return (job is not None and job.status == "queued" and job.coalesced_with is None
+                and (-job.priority, -job.seq) == entry[:2])
+
+    def _victim(self, heap: List[Tuple[int, int, str]]) -> Optional[Job]:
+        """Najmniej pilny czekający job (najwyższy priority, najnowszy)."""
+        while heap and not self._is_victim(heap[0]):
+            heapq.heappop(heap)
+        return self.jobs[heap[0][2]] if heap else None
+
+    def _push(self, job: Job):
+        self._seq += 1
+        job.seq = self._seq
+        self._enheap(job)
+        self._persist(job)
+        self._wake.set()
+
+    async def _admit(self, priority: int, tenant: Optional[str]):
+        """Miejsce w kolejce dla nowego joba: zrzut mniej pilnego czekającego albo Overloaded."""
+        if self.admission is None:
+            return
+        # najpierw limit klucza – żeby nie zrzucić cudzego joba, a potem odrzucić ten
+        for scope, lim in (("key", self.admission.limit("jobs", tenant) if tenant is not None else None),
+                           ("endpoint", self.admission.limit("jobs"))):
+            if lim is None:
+                continue
+            # duplikaty (coalesced_with) nie zajmują miejsca – wykonują się razem z liderem
+            if scope == "key":
+                depth, heap = self._waiting.get(tenant, 0), self._tenant_victims.get(tenant, [])
+            else:
+                depth, heap = self._n_waiting, self._victims
+            if depth < lim:
+                continue
+            victim = self._victim(heap)
+            if victim is None or victim.priority <= priority:
+                # Retry-After z pracy przed nami w tym zakresie
+                raise self.admission.reject("jobs", scope, lim, self.gateway.retry_after(depth))
+            self.admission.shed += 1
+            await self._fail(victim, RuntimeError(f"shed: job queue full ({scope} limit {lim})"))
+
+    async def enqueue(self, req: Dict[str, Any], priority: int = 5, tenant: Optional[str] = None,
+                      group: Optional[str] = None, deadline_s: Optional[float] = None) -> str:
         job_id = uuid.uuid4().hex
-        job = Job(id=job_id, req=req, priority=int(priority))
-        async with self._lock:
+        job = Job(id=job_id, req=req, priority=int(priority), tenant=tenant, group=group,
+                  deadline=None if deadline_s is None else time.time() + deadline_s)
+        key = request_key(req)
+        leader = self.jobs.get(self._leaders.get(key, ""))
+        if leader is not None and leader.status in ("queued", "running"):
+            # identyczny job już w locie – ten dostanie jego wynik
             self.jobs[job_id] = job
+            self._outputs[job_id] = self._outputs[leader.id]
+            job.coalesced_with = leader.id
+            self._followers.setdefault(leader.id, []).append(job)
+            self.coalesced += 1
             self._seq += 1
-            await self.q.put((job.priority, self._seq, job_id))
+            job.seq = self._seq
+            if job.deadline is not None:
+                heapq.heappush(self._deadlines, (job.deadline, job.id))
+            self._persist(job)
+            if leader.status == "queued" and job.priority < leader.priority:
+                # pilniejszy duplikat podnosi priorytet lidera (stary wpis kopca zostanie pominięty)
+                leader.priority = job.priority
+                heapq.heappush(self._queues[leader.tenant or DEFAULT_TENANT], self._entry(leader))
+                self._push_victim(leader)
+                self._wake.set()
+            return job_id
+        await self._admit(job.priority, tenant)
+        self.jobs[job_id] = job
+        self._outputs[job_id] = ChunkBuffer()
+        self._leaders[key] = job_id
+        self._push(job)
         return job_id
 
-    async def enqueue_stream(self, req: Dict[str, Any], priority: int = 5) -> str:
+    async def enqueue_stream(self, req: Dict[str, Any], priority: int = 5, tenant: Optional[str] = None,
+                             deadline_s: Optional[float] = None) -> str:
+        await self._admit(int(priority), tenant)
         job_id = uuid.uuid4().hex
-        job = Job(id=job_id, req=req, priority=int(priority), stream=True, events=asyncio.Queue())
-        async with self._lock:
-            self.jobs[job_id] = job
-            self._seq += 1
-            await self.q.put((job.priority, self._seq, job_id))
+        job = Job(id=job_id, req=req, priority=int(priority), stream=True, tenant=tenant,
+                  deadline=None if deadline_s is None else time.time() + deadline_s)
+        self.jobs[job_id] = job
+        self._outputs[job_id] = ChunkBuffer()
+        self._push(job)
         return job_id
 
+    async def group_counts(self, group: str) -> Dict[str, int]:
+        """Liczba jobów grupy wg statusu (+ "total"); pusty słownik = brak grupy."""
+        if self.store is not None:
+            counts = await self.store.group_counts(group)
+        else:
+            counts = {}
+            for j in self.jobs.values():
+                if j.group == group:
+                    counts[j.status] = counts.get(j.status, 0) + 1
+        if counts:
+            counts["total"] = sum(counts.values())
+        return counts
+
+    async def _group_finished(self, group: str, since: str) -> List[Dict[str, Any]]:
+        if self.store is not None:
+            return await self.store.group_finished(group, since)
+        done = sorted((j for j in self.jobs.values() if j.group == group and j.status in FINISHED
+                       and j.finished_at and j.finished_at >= since), key=lambda j: (j.finished_at, j.id))
+        return [{"id": j.id, "status": j.status, "req": j.req, "error": j.error, "result": j.result,
+                 "finished_at": j.finished_at} for j in done]
+
+    async def group_results(self, group: str) -> AsyncIterator[Dict[str, Any]]:
+        """Zakończone joby grupy w kolejności ukończenia; czeka na resztę, aż wszystkie się skończą."""
+        since, seen, sent = "", set(), 0
+        while True:
+            finished = self._finished   # przed odczytem – zakończenie w trakcie nie przepadnie
+            new = 0
+            for row in await self._group_finished(group, since):
+                if row["finished_at"] != since:
+                    since, seen = row["finished_at"], set()
+                elif row["id"] in seen:
+                    continue
+                seen.add(row["id"])
+                new += 1
+                yield row
+            sent += new
+            if sent >= (await self.group_counts(group)).get("total", 0):
+                return
+            if new:
+                continue    # kolejna strona już zakończonych
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(finished.wait(), timeout=self.POLL_S)
+
+    def queue_depth(self) -> int:
+        """Joby czekające na slot (duplikaty czekają na lidera, nie na telefon)."""
+        return self._n_waiting
+
+    def gauges(self) -> List[Tuple[str, str, Dict[str, str], float]]:
+        out = [("gw_jobs_queue_depth", "Jobs waiting for a phone slot", {}, self.queue_depth()),
+               ("gw_jobs_running", "Jobs bound to a phone slot", {}, len(self._running))]
+        depth = {t: self._waiting.get(t, 0) for t in self._queues}
+        out += [("gw_jobs_tenant_queue_depth", "Jobs waiting per tenant", {"tenant": t}, n)
+                for t, n in depth.items()]
+        out += [("gw_jobs_tenant_weight", "WFQ weight per tenant", {"tenant": t}, self.weights.get(t, 1.0))
+                for t in depth]
+        for (t,), h in self.gateway.metrics.tenant_wait.series.items():
+            for q in (0.5, 0.95, 0.99):
+                v = h.quantile(q)
+                if v is not None:
+                    out.append(("gw_jobs_tenant_wait_quantile_seconds", "Approximate job wait percentile per tenant",
+                                {"tenant": t, "quantile": str(q)}, round(v, 3)))
+        return out
+
     async def get_status(self, job_id: str) -> Optional[Job]:
-        return self.jobs.get(job_id)
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            row = await self.store.load(job_id)
+            if row is not None:
+                job = Job(**row)
+        return job
+
+    async def get_result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if job is not None and job.result is not None:
+            return job.result
+        return await self.store.load_result(job_id) if self.store is not None else None
+
+    def has_output(self, job_id: str) -> bool:
+        return job_id in self._outputs
+
+    async def follow(self, job_id: str, offset: int = 0) -> AsyncIterator[Tuple[int, bytes]]:
+        """
+        (offset za kawałkiem, kawałek) wyjścia joba od offset, potem na żywo do końca joba.
+        Bez bufora (job zakończony dawniej niż OUTPUT_RETAIN_S): sam wynik jako jedna linia.
+        """
+        buf = self._outputs.get(job_id)
+        if buf is None:
+            job = await self.get_status(job_id)
+            # job innego procesu (tryb współdzielony): bez wyjścia na żywo, tylko wynik na końcu
+            while self.shared is not None and job is not None and job.status not in FINISHED:
+                await asyncio.sleep(self.POLL_S)
+                job = await self.get_status(job_id)
+            if job is not None and job.status == "done" and offset == 0:
+                result = await self.get_result(job_id)
+                if result is not None:
+                    line = (json.dumps(result, ensure_ascii=False) + "\n").encode()
+                    yield len(line), line
+            return
+        try:
+            async for item in buf.follow(offset):
+                yield item
+        finally:
+            job = self.jobs.get(job_id)
+            if job is not None and job.stream and job.status not in FINISHED and buf.subscribers == 0:
+                self._watch_abandoned(job_id)
 
     async def stream_job(self, job_id: str) -> AsyncIterator[bytes]:
+        async for _, chunk in self.follow(job_id):
+            yield chunk
+
+    def _watch_abandoned(self, job_id: str):
+        if job_id not in self._reapers:
+            self._reapers[job_id] = asyncio.create_task(self._reap_abandoned(job_id))
+
+    async def _reap_abandoned(self, job_id: str):
+        """Job stream bez odbiorców: po STREAM_ABANDON_S bez ponownego podłączenia – anulowanie."""
+        try:
+            await asyncio.sleep(self.STREAM_ABANDON_S)
+            buf = self._outputs.get(job_id)
+            if buf is not None and buf.subscribers == 0:
+                await self.cancel(job_id)
+        finally:
+            self._reapers.pop(job_id, None)
+
+    def _emit(self, job: Job, data: bytes):
+        buf = self._outputs.get(job.id)
+        if buf is not None:
+            buf.append(data)
+
+    def _retire_outputs(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        while self._retired and self._retired[0][0] <= now:
+            self._outputs.pop(self._retired.popleft()[1], None)
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        """Anuluje job queued/running; None gdy nie ma go w locie (nieznany albo już zakończony)."""
         job = self.jobs.get(job_id)
-        if not job or not job.stream or job.events is None:
-            # brak streamu dla tego joba – nic do wysłania
+        if job is None and self.shared is not None and self.store is not None:
+            # job innego procesu: anuluje go tamten przy najbliższym _shared_loop
+            return await self.get_status(job_id) if await self.store.request_cancel(job_id) else None
+        if job is None or job.status in FINISHED:
+            return None
+        await self._drop(job, "cancelled", "cancelled")
+        return job
+
+    def _promote(self, job: Job):
+        """Job-lider odpada: pierwszy z duplikatów przejmuje jego rolę i wraca do kolejki."""
+        followers = self._followers.pop(job.id, [])
+        if not followers:
             return
-        while True:
-            item = await job.events.get()
-            if item is None:
-                break
-            yield item
+        new, rest = followers[0], followers[1:]
+        new.coalesced_with = None
+        new.priority = min(f.priority for f in followers)
+        for f in rest:
+            f.coalesced_with = new.id
+        if rest:
+            self._followers[new.id] = rest
+        buf = ChunkBuffer()   # wyjście starego lidera nie jest ich wyjściem
+        for f in followers:
+            self._outputs[f.id] = buf
+        self._leaders[request_key(new.req)] = new.id
+        self._enheap(new)
+        self._wake.set()
 
-    async def _worker(self, worker_idx: int):
-        while not self._stop_event.is_set():
-            try:
-                priority, seq, job_id = await self.q.get()
-            except asyncio.CancelledError:
-                break
+    async def _drop(self, job: Job, status: str, reason: str):
+        """Koniec joba, którego wynik nie jest już potrzebny (cancel, deadline) – bez wpływu na duplikaty."""
+        if job.coalesced_with is not None:
+            followers = self._followers.get(job.coalesced_with, [])
+            if job in followers:
+                followers.remove(job)
+        else:
+            self._promote(job)
+        self._unqueue(job)
+        job.status, job.error = status, reason
+        task = self._running.get(job.id)
+        if task is not None:
+            task.cancel()   # _run: zapis stanu i zwolnienie slotu w finally
+            return
+        job.finished_at = _iso_now()
+        if job.coalesced_with is None:
+            self._emit(job, f"# {status}: {reason}\n".encode())
+        self._complete(job)
+
+    async def _expire(self):
+        """Joby czekające, których deadline minął – bez wywołania telefonu."""
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, job_id = heapq.heappop(self._deadlines)
             job = self.jobs.get(job_id)
-            if job is None:
-                self.q.task_done()
-                continue
-            job.status = "running"
-            job.started_at = _iso_now()
-
-            try:
-                phone = await self.gateway._next_phone()
-                payload = self.gateway._build_payload(_DictToAsk(job.req), fallback=phone.cfg.model)
-                job.device = {"host": phone.cfg.host, "port": phone.cfg.port, "serial": phone.cfg.serial}
-
-                if job.stream and job.events is not None:
-                    # lekki nagłówek dla czytelności (opcjonalny)
-                    await job.events.put(f"# picked {phone.cfg.host}:{phone.cfg.port} model={payload.get('model')}\n".encode())
-                    await job.events.put(b"# posting (streaming)...\n")
-                    # strumień 1:1 z telefonu
-                    async for chunk in self.gateway._stream_chat(phone, payload):
-                        if chunk:
-                            await job.events.put(chunk)
-                    await job.events.put(b"\n# done\n")
-                    job.status = "done"
+            if job is not None and job.status == "queued":
+                await self._drop(job, "error", "deadline exceeded before dispatch")
+
+    async def _dispatch_loop(self):
+        while not self._stop_event.is_set():
+            self._wake.clear()
+            self._retire_outputs()
+            await self._expire()
+            await self._dispatch_ready()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), timeout=self.POLL_S)
+
+    def _next_tenant(self, passed: Container[str] = ()) -> Optional[str]:
+        """
+        Najemca z czekającymi jobami i najmniejszym czasem wirtualnym; najemcy z passed
+        (ich job czeka w tej rundzie na slot) dopiero, gdy nie ma innych.
+        """
+        best = None
+        for tenant, q in self._queues.items():
+            if q and (best is None or (tenant in passed, self._vt[tenant]) < (best in passed, self._vt[best])):
+                best = tenant
+        return best
+
+    async def _dispatch_ready(self):
+        skipped: Dict[str, List[Tuple[float, float, int, str]]] = {}
+        n_skipped = 0
+        try:
+            while n_skipped < self.SCAN_LIMIT and self.gateway.has_free_slot():
+                # najemca z pominiętym jobem nie zjada limitu skanu reszcie (zachowuje najmniejszy czas wirtualny)
+                tenant = self._next_tenant(skipped)
+                if tenant is None:
+                    break
+                entry = heapq.heappop(self._queues[tenant])
+                job = self.jobs.get(entry[-1])
+                if job is None or job.status != "queued":
+                    continue
+                try:
+                    phone = await self.gateway.try_acquire_slot(
+                        job.req.get("model"), self.gateway.affinity_key(_DictToAsk(job.req)))
+                except Exception as e:   # np. ModelUnavailable – job nie ma gdzie się wykonać
+                    await self._fail(job, e)
+                    continue
+                if phone is None:
+                    skipped.setdefault(tenant, []).append(entry)  # brak wolnego slotu dla modelu tego joba
+                    n_skipped += 1
+                    continue
+                if job.status != "queued":   # anulowany w trakcie rezerwacji (slot współdzielony to await)
+                    self.gateway.release_slot(phone)
+                    continue
+                self._vtime = self._vt[tenant]
+                self._vt[tenant] += 1.0 / self.weights.get(tenant, 1.0)
+                self._unqueue(job)
+                job.status = "running"
+                job.started_at = _iso_now()
+                wait_s = (datetime.fromisoformat(job.started_at) - datetime.fromisoformat(job.enqueued_at)).total_seconds()
+                self.gateway.metrics.observe_queue_wait("jobs", self.gateway._devkey(phone.cfg),
+                                                        job.req.get("model") or phone.cfg.model, wait_s)
+                self.gateway.metrics.observe_tenant_wait(tenant, wait_s)
+                rec = self._traffic_record(job, wait_s=round(wait_s, 4))
+                if rec is not None:
+                    self._captured[job.id] = rec
+                self._persist(job)
+                self._running[job.id] = asyncio.create_task(self._run(job, phone))
+        finally:
+            for tenant, entries in skipped.items():
+                for entry in entries:
+                    heapq.heappush(self._queues[tenant], entry)
+
+    def _complete(self, job: Job):
+        """Zapis końcowego stanu + rozesłanie wyniku do jobów-duplikatów."""
+        key = request_key(job.req)
+        if self._leaders.get(key) == job.id:
+            del self._leaders[key]
+        retire_at = time.monotonic() + self.OUTPUT_RETAIN_S
+        for f in self._followers.pop(job.id, []):
+            f.status, f.result, f.error, f.device = job.status, job.result, job.error, job.device
+            f.started_at, f.finished_at = job.started_at, job.finished_at
+            self._persist(f)
+            self._capture(f)
+            self._retired.append((retire_at, f.id))
+        self._persist(job)
+        self._capture(job)
+        buf = self._outputs.get(job.id)
+        if buf is not None:
+            if job.coalesced_with is None:   # duplikat odpinający się od lidera nie zamyka jego wyjścia
+                buf.close()
+            self._retired.append((retire_at, job.id))
+        self._finished.set()
+        self._finished = asyncio.Event()
+
+    def _traffic_record(self, job: Job, **extra: Any) -> Optional[Dict[str, Any]]:
+        if self.traffic is None:
+            return None
+        t = datetime.fromisoformat(job.enqueued_at).timestamp()
+        ep = "jobs_stream" if job.stream else "jobs_bulk" if job.group else "jobs"
+        return self.traffic.begin(ep, job.req, job.tenant, t=t, job=job.id, priority=job.priority,
+                                  group=job.group, coalesced=True if job.coalesced_with else None,
+                                  deadline_s=None if job.deadline is None else round(job.deadline - t, 3),
+                                  **extra)
+
+    def _capture(self, job: Job):
+        """Rekord ruchu zakończonego joba (także odrzuconego w kolejce i duplikatu)."""
+        rec = self._captured.pop(job.id, None) or self._traffic_record(job)
+        if rec is not None:
+            if job.device and "phone" not in rec:
+                rec["phone"] = job.device.get("serial") or f"{job.device['host']}:{job.device['port']}"
+            self.traffic.finish(rec, "ok" if job.status == "done" else job.status)
+
+    async def _fail(self, job: Job, e: Exception):
+        self._unqueue(job)
+        job.error = str(e)
+        job.status = "error"
+        job.finished_at = _iso_now()
+        self._emit(job, f"# error: {e}\n".encode())
+        self._complete(job)
+
+    async def _run(self, job: Job, phone):
+        """Wykonanie joba na zarezerwowanym slocie; slot zwalniany na końcu (albo wcześniej, przy failoverze)."""
+        capture.bind(self._captured.get(job.id))   # telefon / TTFT / tokeny z _chat_events
+        held = self.gateway.hold(phone)
+        try:
+            ask = _DictToAsk(job.req)
+            payload = self.gateway._build_payload(ask, fallback=phone.cfg.model)
+            dl = self.gateway.deadlines_for(ask, payload.get("model"))
+            if job.deadline is not None:
+                # reszta czasu joba jako limit całego wywołania (także dla hedge'a)
+                left = max(0.0, job.deadline - time.time())
+                ask.deadlines = {**(ask.deadlines or {}), "total_s": left if dl.total_s is None else min(dl.total_s, left)}
+                dl = self.gateway.deadlines_for(ask, payload.get("model"))
+            job.device = {"host": phone.cfg.host, "port": phone.cfg.port, "serial": phone.cfg.serial}
+
+            if job.req.get("kind") == "embed":
+                # kawałki na całej flocie; zarezerwowany slot przejmuje (i zwalnia) gateway.embed()
+                result = await self.gateway.embed(job.req["input"], job.req.get("model"), held=held.take())
+                vectors = result["embeddings"]
+                summary = {"model": result["model"], "count": len(vectors), "dim": len(vectors[0]) if vectors else 0,
+                           "prompt_eval_count": result["prompt_eval_count"]}
+                self._emit(job, (json.dumps(summary) + "\n").encode())   # wektory: GET /jobs/{id}/result
+                job.result = result
+                job.status = "done"
+            elif job.stream:
+                # lekki nagłówek dla czytelności (opcjonalny)
+                self._emit(job, f"# picked {phone.cfg.host}:{phone.cfg.port} model={payload.get('model')}\n".encode())
+                self._emit(job, b"# posting (streaming)...\n")
+                # strumień 1:1 z telefonu
+                async for chunk in self.gateway._stream_chat(phone, payload, held=held, raise_on_error=True, deadlines=dl):
+                    self._emit(job, chunk)
+                self._emit(job, b"\n# done\n")
+                job.status = "done"
+            else:
+                # non-stream
+                if self.gateway.hedge_enabled(ask):
+                    # dwa wyścigowe wywołania – na żywo nie ma jednego wyjścia, tylko wynik zwycięzcy
+                    winner, result = await self.gateway.post_chat_hedged(phone, ask, held=held)
+                    job.device = {"host": winner.cfg.host, "port": winner.cfg.port, "serial": winner.cfg.serial}
+                    self._emit(job, (json.dumps(result, ensure_ascii=False) + "\n").encode())
                 else:
-                    # non-stream
-                    result = await self.gateway._post_chat(phone, payload)
-                    job.result = result
-                    job.status = "done"
-            except Exception as e:
-                job.error = str(e)
-                job.status = "error"
-                if job.stream and job.events is not None:
-                    await job.events.put(f'# error: {e}\n'.encode())
-            finally:
-                job.finished_at = _iso_now()
-                if job.stream and job.events is not None:
-                    # zamknij strumień
-                    await job.events.put(None)  # sentinel
-                self.q.task_done()
+                    winner, result = phone, await self.gateway._post_chat(
+                        phone, payload, held=held, deadlines=dl, on_line=lambda raw: self._emit(job, raw))
+                self.gateway.note_prompt_eval(winner, ask, self.gateway.affinity_key(ask), result)
+                job.result = result
+                job.status = "done"
+        except asyncio.CancelledError:
+            if job.status != "cancelled":
+                raise   # stop() – job zostaje running i wróci do kolejki po restarcie
+            self._emit(job, b"\n# cancelled\n")
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+            self._emit(job, f"# error: {e}\n".encode())
+        finally:
+            job.finished_at = _iso_now()
+            if job.status in FINISHED:
+                self._complete(job)   # zamyka też bufor wyjścia
+            else:
+                self._persist(job)  # przerwany (stop) – zostaje running, wróci po restarcie
+            self._running.pop(job.id, None)
+            held.release()
 
 class _DictToAsk:
     def __init__(self, d: Dict[str, Any]):
         self.prompt = d.get("prompt") or ""
         self.system = d.get("system")
         self.model = d.get("model")
+        self.session_id = d.get("session_id")
+        self.hedge = d.get("hedge")
+        self.deadlines = d.get("deadlines")
         self.options = d.get("options") or {}
@@ -0,0 +1,279 @@
+# core/jobstore.py
+from __future__ import annotations
+import asyncio, json, sqlite3, threading, time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    stream INTEGER NOT NULL DEFAULT 0,
+    req TEXT NOT NULL,
+    enqueued_at TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    device TEXT,
+    error TEXT,
+    result TEXT,
+    result_bytes INTEGER NOT NULL DEFAULT 0,
+    finished_ts REAL,
+    tenant TEXT,
+    grp TEXT,
+    deadline REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status);
+CREATE INDEX IF NOT EXISTS jobs_finished_ts ON jobs(finished_ts);
+"""
+
+_COLS = ("id", "status", "priority", "seq", "stream", "req", "enqueued_at", "started_at",
+         "finished_at", "device", "error", "result", "result_bytes", "finished_ts", "tenant", "grp", "deadline",
+         "owner")
+_META = ("id, status, priority, seq, stream, req, enqueued_at, started_at, finished_at, "
+         "device, error, tenant, grp, deadline")
+# kolumny dodane po pierwszej wersji schematu – ALTER TABLE dla starszych baz
+_ADDED = {"tenant": "TEXT", "grp": "TEXT", "deadline": "REAL", "owner": "TEXT", "cancel_req": "INTEGER"}
+FINISHED = ("done", "error", "cancelled")
+
+class JobStore:
+    """
+    Trwały magazyn jobów (SQLite w trybie WAL):
+    - w pamięci JobsEngine trzyma tylko queued/running (hot index)
+    - zakończone joby (z wynikiem) lądują tylko tu, z TTL i limitami rozmiaru
+    - recover(): joby queued/running z poprzedniego procesu
+    - owner: proces bramki, który wykonuje job (tryb współdzielony, kilka procesów na jednej bazie):
+      claim_orphans() przejmuje joby martwych procesów, request_cancel() / cancel_requests() –
+      anulowanie joba wykonywanego przez inny proces
+    - save() tylko odkłada wiersz w pamięci (ostatni stan joba wygrywa); run() zapisuje
+      odłożone wiersze co flush_s jedną transakcją poza pętlą asyncio (to_thread), jak DeviceStore.
+      Odczyty są async i też idą w wątku (lock trzyma zapis całej transakcji): load()/load_result()
+      widzą odłożone wiersze, zapytania po wielu jobach (recover, grupy, evict) najpierw dopisują
+      zaległe (flush); close() zapisuje resztę synchronicznie – tylko przy zamykaniu
+    """
+    def __init__(self, path: Path, result_ttl_s: float = 24 * 3600,
+                 max_finished: int = 200_000, max_result_bytes: int = 512 * 1024 * 1024,
+                 owner: Optional[str] = None, flush_s: float = 0.2):
+        self.path = Path(path)
+        self.owner = owner
+        self.result_ttl_s = result_ttl_s
+        self.max_finished = max_finished
+        self.max_result_bytes = max_result_bytes
+        self.flush_s = flush_s
+        self.evicted = 0
+        self.writes = 0
+        self._pending: Dict[str, Tuple] = {}   # id -> wiersz (_COLS) do zapisu
+        self._writing: Dict[str, Tuple] = {}   # wiersze zapisywane właśnie w wątku
+        self._changed = asyncio.Event()
+        self._flushing = asyncio.Lock()         # flush() czeka też na zapis w toku
+        self._lock = threading.Lock()           # jedno połączenie: pętla + wątek zapisu
+        self.db = sqlite3.connect(str(self.path), isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        have = {r["name"] for r in self.db.execute("PRAGMA table_info(jobs)")}
+        for col, decl in _ADDED.items():
+            if col not in have:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {col} {decl}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_grp ON jobs(grp, finished_at)")
+
+    def close(self) -> None:
+        self.flush_sync()
+        with self._lock:   # zapis z anulowanego run() mógł jeszcze trwać w wątku
+            self.db.close()
+
+    def save(self, job: Any, seq: int = 0) -> None:
+        """Upsert stanu joba (odłożony do run()); wynik zapisywany tylko dla zakończonych."""
+        result = json.dumps(job.result, ensure_ascii=False) if job.result is not None else None
+        finished_ts = time.time() if job.status in FINISHED else None
+        row = (job.id, job.status, job.priority, seq, int(job.stream),
+               json.dumps(job.req, ensure_ascii=False), job.enqueued_at, job.started_at,
+               job.finished_at, json.dumps(job.device) if job.device else None, job.error,
+               result, len(result.encode()) if result else 0, finished_ts, job.tenant, job.group, job.deadline,
+               self.owner)
+        self._pending[job.id] = row
+        self._changed.set()
+
+    def _write(self, rows: List[Tuple]) -> None:
+        # priority/seq/deadline też: podniesiony priorytet (duplikat, promocja) przetrwa restart
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    f"INSERT INTO jobs ({','.join(_COLS)}) VALUES ({','.join('?' * len(_COLS))}) "
+                    "ON CONFLICT(id) DO UPDATE SET status=excluded.status, priority=excluded.priority, "
+                    "seq=excluded.seq, deadline=excluded.deadline, started_at=excluded.started_at, "
+                    "finished_at=excluded.finished_at, device=excluded.device, error=excluded.error, "
+                    "result=excluded.result, result_bytes=excluded.result_bytes, finished_ts=excluded.finished_ts",
+                    rows)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        self.writes += 1
+
+    async def run(self) -> None:
+        """Pętla zapisu: pierwsza zmiana -> odczekanie flush_s -> jedna transakcja w wątku."""
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await asyncio.sleep(self.flush_s)
+            try:
+                await self.flush()
+            except sqlite3.Error:
+                pass   # wiersze wróciły do _pending – ponowna próba po flush_s
+
+    async def flush(self) -> None:
+        """Zaległe wiersze w wątku; po powrocie w bazie jest wszystko, co save() odłożyło wcześniej."""
+        async with self._flushing:
+            if not self._pending:
+                return
+            self._writing, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, list(self._writing.values()))
+            except BaseException:
+                # nowsze stany z _pending wygrywają ze zwracanymi
+                self._pending = {**self._writing, **self._pending}
+                self._changed.set()
+                raise
+            finally:
+                self._writing = {}
+
+    def flush_sync(self) -> None:
+        """Zaległe wiersze od razu, w bieżącym wątku – close() po zatrzymaniu pętli zapisu."""
+        if self._pending:
+            rows, self._pending = list(self._pending.values()), {}
+            self._write(rows)
+
+    def _query(self, sql: str, args: Tuple = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self.db.execute(sql, args).fetchall()
+
+    async def _read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Zapytanie po wielu jobach: najpierw zaległe zapisy, potem fn w wątku."""
+        await self.flush()
+        return await asyncio.to_thread(fn, *args)
+
+    def _unsaved(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._pending.get(job_id) or self._writing.get(job_id)
+        return dict(zip(_COLS, row)) if row is not None else None
+
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Metadane joba bez wyniku (wynik: load_result)."""
+        d = self._unsaved(job_id)
+        if d is not None:
+            return self._row({k: d[k] for k in _META.replace(" ", "").split(",")})
+        # nie ma w _pending/_writing -> już w bazie albo nieznany, bez flush()
+        r = await asyncio.to_thread(self._query, f"SELECT {_META} FROM jobs WHERE id=?", (job_id,))
+        return self._row(r[0]) if r else None
+
+    async def load_result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        d = self._unsaved(job_id)
+        if d is not None:
+            return json.loads(d["result"]) if d["result"] else None
+        r = await asyncio.to_thread(self._query, "SELECT result FROM jobs WHERE id=?", (job_id,))
+        return json.loads(r[0]["result"]) if r and r[0]["result"] else None
+
+    async def recover(self) -> List[Dict[str, Any]]:
+        rows = await self._read(self._query,
+                                f"SELECT {_META} FROM jobs WHERE status IN ('queued','running') ORDER BY seq")
+        return [self._row(r) for r in rows]
+
+    async def claim_orphans(self, alive: List[str]) -> List[Dict[str, Any]]:
+        """
+        Joby queued/running procesów spoza alive (i sprzed trybu współdzielonego, owner NULL)
+        przechodzą na self.owner – w jednej transakcji, więc każdy przejmie tylko jeden proces.
+        """
+        return [self._row(r) for r in await self._read(self._claim, alive)]
+
+    def _claim(self, alive: List[str]) -> List[sqlite3.Row]:
+        marks = ",".join("?" * len(alive))
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    f"SELECT {_META} FROM jobs WHERE status IN ('queued','running') "
+                    f"AND (owner IS NULL OR owner NOT IN ({marks})) ORDER BY seq", alive).fetchall()
+                self.db.executemany("UPDATE jobs SET owner=? WHERE id=?", [(self.owner, r["id"]) for r in rows])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return rows
+
+    async def request_cancel(self, job_id: str) -> bool:
+        """Prośba o anulowanie joba w locie u innego procesu; False gdy job już zakończony albo nieznany."""
+        def mark():
+            with self._lock:
+                return self.db.execute("UPDATE jobs SET cancel_req=1 WHERE id=? AND status IN ('queued','running')",
+                                       (job_id,)).rowcount > 0
+        return await self._read(mark)
+
+    async def cancel_requests(self) -> List[str]:
+        """Id jobów self.owner z prośbą o anulowanie (zdejmowana przy odczycie)."""
+        def take():
+            with self._lock:
+                ids = [r[0] for r in self.db.execute("SELECT id FROM jobs WHERE owner=? AND cancel_req=1",
+                                                     (self.owner,))]
+                self.db.executemany("UPDATE jobs SET cancel_req=NULL WHERE id=?", [(i,) for i in ids])
+            return ids
+        return await asyncio.to_thread(take)
+
+    def _row(self, r: Any) -> Dict[str, Any]:
+        d = dict(r)
+        d["req"] = json.loads(d["req"])
+        d["device"] = json.loads(d["device"]) if d.get("device") else None
+        d["stream"] = bool(d["stream"])
+        if "grp" in d:
+            d["group"] = d.pop("grp")
+        return d
+
+    async def group_counts(self, group: str) -> Dict[str, int]:
+        return {r[0]: r[1] for r in await self._read(
+            self._query, "SELECT status, COUNT(*) FROM jobs WHERE grp=? GROUP BY status", (group,))}
+
+    async def group_finished(self, group: str, since: str = "", limit: int = 500) -> List[Dict[str, Any]]:
+        """Zakończone joby grupy (z wynikiem) od finished_at >= since, w kolejności ukończenia."""
+        rows = await self._read(self._query,
+            "SELECT id, status, req, error, result, finished_at FROM jobs "
+            "WHERE grp=? AND finished_at IS NOT NULL AND finished_at >= ? AND status IN ('done','error','cancelled') "
+            "ORDER BY finished_at, id LIMIT ?", (group, since, limit))
+        return [{"id": r["id"], "status": r["status"], "req": json.loads(r["req"]), "error": r["error"],
+                 "result": json.loads(r["result"]) if r["result"] else None,
+                 "finished_at": r["finished_at"]} for r in rows]
+
+    async def evict(self, now: Optional[float] = None) -> int:
+        """TTL, potem limit liczby zakończonych jobów i łącznego rozmiaru wyników (najstarsze pierwsze)."""
+        now = time.time() if now is None else now
+        def run():
+            with self._lock:
+                return self._evict(now)
+        return await self._read(run)
+
+    def _evict(self, now: float) -> int:
+        n = self.db.execute("DELETE FROM jobs WHERE finished_ts IS NOT NULL AND finished_ts < ?",
+                            (now - self.result_ttl_s,)).rowcount
+        count, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(result_bytes),0) FROM jobs WHERE finished_ts IS NOT NULL").fetchone()
+        if count > self.max_finished:
+            n += self.db.execute(
+                "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE finished_ts IS NOT NULL "
+                "ORDER BY finished_ts LIMIT ?)", (count - self.max_finished,)).rowcount
+        if size > self.max_result_bytes:
+            drop, freed = [], 0
+            for r in self.db.execute("SELECT id, result_bytes FROM jobs WHERE finished_ts IS NOT NULL "
+                                     "ORDER BY finished_ts"):
+                if size - freed <= self.max_result_bytes:
+                    break
+                drop.append((r["id"],)); freed += r["result_bytes"]
+            self.db.executemany("DELETE FROM jobs WHERE id=?", drop)
+            n += len(drop)
+        self.evicted += n
+        return n
+
+    def stats(self) -> Dict[str, int]:
+        count, size = self._query(
+            "SELECT COUNT(*), COALESCE(SUM(result_bytes),0) FROM jobs WHERE finished_ts IS NOT NULL")[0]
+        return {"finished": count, "result_bytes": size, "evicted": self.evicted}
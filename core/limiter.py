@@ -0,0 +1,168 @@
+# core/limiter.py
+from __future__ import annotations
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Optional
+
+class ResizableSemaphore:
+    """
+    Semafor asyncio z limitem zmienianym w locie (resize):
+    - zwiększenie od razu wpuszcza czekających
+    - zmniejszenie nie przerywa trwających – nowe wejdą dopiero, gdy held spadnie poniżej limitu
+    Kolejność FIFO, jak asyncio.Semaphore; locked() – czy acquire() by czekał.
+    """
+    def __init__(self, limit: int):
+        self.limit = max(1, int(limit))
+        self.held = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def locked(self) -> bool:
+        return self.held >= self.limit or any(not w.done() for w in self._waiters)
+
+    async def acquire(self) -> bool:
+        if not self.locked():
+            self.held += 1
+            return True
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()   # permit przydzielony tuż przed anulowaniem – oddajemy
+            raise
+        return True
+
+    def release(self) -> None:
+        self.held -= 1
+        self._wake()
+
+    def resize(self, limit: int) -> None:
+        self.limit = max(1, int(limit))
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.held < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.held += 1
+                fut.set_result(True)
+
+@dataclass(frozen=True)
+class LimitPolicy:
+    """
+    Parametry adaptacyjnego limitu współbieżności telefonu:
+    - initial: limit startowy (przycięty do sufitu = max_concurrency z phones.json)
+    - window: min. próbek na jednym poziomie limitu przed decyzją (i nie mniej niż 2 x limit)
+    - tolerance: względna zmiana przepustowości uznawana za szum
+    - hold_windows: ile okien trzymać znalezione kolano (albo sufit), zanim znów sondować
+    - backoff: mnożnik przy błędzie / zawieszeniu (multiplicative decrease)
+    - min_tokens: krótsze odpowiedzi nie są próbką (dominuje prefill i narzut)
+    """
+    initial: int = 2
+    window: int = 8
+    tolerance: float = 0.1
+    hold_windows: int = 4
+    backoff: float = 0.7
+    min_tokens: int = 8
+
+class AdaptiveLimit:
+    """
+    AIMD na przepustowości telefonu, mierzonej z latencji i tokenów:
+
+        okno: średnia współbieżność * suma tokenów / suma latencji   (Little: tokeny/s całego telefonu)
+
+    Liczą się tylko żądania, które szły przy współbieżności == limit (telefon nasycony);
+    przy mniejszym ruchu limit stoi. Po oknie próbek porównanie z poprzednim oknem
+    (na sąsiednim poziomie) i krok o 1 (hill climbing):
+    - poprzedni krok w górę: zysk > tolerance -> dalej w górę, inaczej z powrotem w dół
+      (więcej współbieżności bez zysku = tylko wolniejsze żądania)
+    - poprzedni krok w dół: strata > tolerance -> w górę i trzymanie tego poziomu przez
+      hold_windows okien (kolano), chyba że przepustowość na nim spadnie; potem sonda w górę
+    Limit krąży więc wokół kolana krzywej przepustowości i idzie za nim, gdy telefon
+    się grzeje albo zmienia model. Błąd / zawieszenie: limit * backoff.
+    Sufit: max_concurrency z phones.json. Synchroniczne – jedna pętla asyncio.
+    """
+    def __init__(self, ceiling: int, policy: LimitPolicy, limit: Optional[int] = None):
+        self.policy = policy
+        self.ceiling = max(1, int(ceiling))
+        self.limit = self._clamp(policy.initial if limit is None else limit)
+        self.direction = 1
+        self.last_tps: Optional[float] = None   # przepustowość poprzedniego okna
+        self.tps: Optional[float] = None        # ostatnia zmierzona (widok / metryki)
+        self._tokens = 0
+        self._latency = 0.0
+        self._conc = 0.0
+        self._n = 0
+        self._hold = 0
+        self._armed = True   # równoległe porażki jednego zdarzenia tną limit raz
+
+    def _clamp(self, limit: int) -> int:
+        return max(1, min(self.ceiling, int(limit)))
+
+    def _reset(self):
+        self._tokens = 0; self._latency = 0.0; self._conc = 0.0; self._n = 0
+
+    def set_ceiling(self, ceiling: int) -> int:
+        self.ceiling = max(1, int(ceiling))
+        if self.limit > self.ceiling:
+            self.limit = self.ceiling
+            self._reset(); self.last_tps = None; self._hold = 0
+        return self.limit
+
+    def adopt(self, limit: int) -> int:
+        """Limit ustalony gdzie indziej (inny proces bramki na tym samym telefonie); pomiary od nowa."""
+        self.limit = self._clamp(limit)
+        self._reset(); self.last_tps = None; self.direction = 1; self._hold = 0
+        return self.limit
+
+    def on_sample(self, tokens: int, latency_s: float, concurrency: float) -> Optional[int]:
+        """Udane wywołanie; concurrency = średnie inflight telefonu w trakcie. Zwraca nowy limit albo None."""
+        self._armed = True
+        if tokens < self.policy.min_tokens or latency_s <= 0 or round(concurrency) != self.limit:
+            return None
+        self._tokens += tokens; self._latency += latency_s; self._conc += concurrency
+        self._n += 1
+        if self._n < max(self.policy.window, 2 * self.limit):
+            return None
+        # sumy, nie średnia ilorazów – ta zawyża przy rozrzucie latencji (czekanie w kolejce Ollamy)
+        tps = self.tps = (self._conc / self._n) * self._tokens / self._latency
+        self._reset()
+        tol = self.policy.tolerance
+        if self.last_tps is None:
+            step = 1
+        elif self._hold > 0:
+            if tps >= self.last_tps * (1 - tol):
+                self._hold -= 1
+                self.last_tps = tps if self._hold else None   # koniec trzymania -> sonda w górę
+                return None
+            step, self._hold = -1, 0   # spadek na tym samym poziomie (grzanie, inny model)
+        elif self.direction > 0:
+            step = 1 if tps > self.last_tps * (1 + tol) else -1
+        else:
+            step = 1 if tps < self.last_tps * (1 - tol) else -1
+            if step > 0:
+                self._hold = self.policy.hold_windows
+        self.last_tps, self.direction = tps, step
+        new = self._clamp(self.limit + step)
+        if new == self.limit:
+            if step < 0:
+                self.last_tps = None   # na dnie: następne okno sprawdzi poziom wyżej
+            else:
+                self._hold = self.policy.hold_windows   # na suficie: trzymamy
+            return None
+        self.limit = new
+        return new
+
+    def on_failure(self) -> Optional[int]:
+        """Błąd / zawieszenie: multiplicative decrease (raz do następnego sukcesu); pomiary od nowa."""
+        if not self._armed:
+            return None
+        self._armed = False
+        self._reset(); self.last_tps = None; self.direction = 1; self._hold = 0
+        new = self._clamp(min(self.limit - 1, int(self.limit * self.policy.backoff)))
+        if new == self.limit:
+            return None
+        self.limit = new
+        return new
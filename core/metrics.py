@@ -0,0 +1,172 @@
+# core/metrics.py
+from __future__ import annotations
+import bisect
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TPS_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0)
+LOAD_BUCKETS = (0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """
+    Histogram w stylu Prometheusa. Zapis to bisect + dwa dodawania – bez locka,
+    bo całość działa w jednej pętli asyncio (brak await w środku).
+    """
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # ostatni = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Przybliżony kwantyl (interpolacja liniowa w kubełku), None gdy pusto."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            if acc + c >= rank and c:
+                lo = self.bounds[i - 1] if i > 0 else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lo + (hi - lo) * ((rank - acc) / c)
+            acc += c
+        return self.bounds[-1]
+
+class HistogramFamily:
+    """Histogramy jednej metryki rozbite po etykietach (np. phone, model)."""
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...], bounds: Tuple[float, ...]):
+        self.name, self.help, self.labels, self.bounds = name, help_, labels, bounds
+        self.series: Dict[Tuple[str, ...], Histogram] = {}
+
+    def observe(self, labels: Tuple[str, ...], v: float) -> None:
+        h = self.series.get(labels)
+        if h is None:
+            h = self.series[labels] = Histogram(self.bounds)
+        h.observe(v)
+
+    def get(self, labels: Tuple[str, ...]) -> Optional[Histogram]:
+        return self.series.get(labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, h in self.series.items():
+            lbl = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, values))
+            acc = 0
+            for bound, c in zip(self.bounds, h.counts):
+                acc += c
+                lines.append(f'{self.name}_bucket{{{lbl},le="{bound}"}} {acc}')
+            lines.append(f'{self.name}_bucket{{{lbl},le="+Inf"}} {h.count}')
+            lines.append(f"{self.name}_sum{{{lbl}}} {h.sum:.6f}")
+            lines.append(f"{self.name}_count{{{lbl}}} {h.count}")
+        return lines
+
+def _tps(count: Any, duration_ns: Any) -> Optional[float]:
+    if count and duration_ns:
+        return count / (duration_ns / 1e9)
+    return None
+
+class Metrics:
+    """
+    Liczniki i histogramy gatewaya. Zapis jest synchroniczny i bez locków.
+    Pola telemetryczne Ollamy (prompt_eval_*, eval_*, load_duration) są
+    rozbijane po telefonie i modelu.
+    """
+    def __init__(self):
+        self.total_requests = 0; self.total_failures = 0
+        self.latency_sum = 0.0; self.phone_hits: Dict[str, int] = {}
+        pm = ("phone", "model")
+        self.latency = HistogramFamily("gw_request_duration_seconds", "End-to-end phone call latency", pm, LATENCY_BUCKETS)
+        self.ttft = HistogramFamily("gw_ttft_seconds", "Time to first token", pm, LATENCY_BUCKETS)
+        self.queue_wait = HistogramFamily("gw_queue_wait_seconds", "Wait before a phone slot was granted",
+                                          ("queue", "phone", "model"), LATENCY_BUCKETS)
+        self.tenant_wait = HistogramFamily("gw_jobs_tenant_wait_seconds", "Job wait in the queue per tenant",
+                                           ("tenant",), LATENCY_BUCKETS)
+        self.prompt_tps = HistogramFamily("gw_prompt_tokens_per_second", "Prompt evaluation throughput", pm, TPS_BUCKETS)
+        self.gen_tps = HistogramFamily("gw_generation_tokens_per_second", "Generation throughput", pm, TPS_BUCKETS)
+        self.load = HistogramFamily("gw_model_load_seconds", "Model load time reported by Ollama", pm, LOAD_BUCKETS)
+        self.prompt_tokens: Dict[Tuple[str, str], int] = {}
+        self.gen_tokens: Dict[Tuple[str, str], int] = {}
+        self.deadline_exceeded: Dict[Tuple[str, str], int] = {}   # (faza, telefon)
+
+    def mark(self, phone: Optional[str], ok: bool, latency: float):
+        self.total_requests += 1
+        if ok: self.latency_sum += latency
+        else: self.total_failures += 1
+        if phone:
+            self.phone_hits[phone] = self.phone_hits.get(phone, 0) + 1
+
+    def observe_response(self, phone: str, model: Optional[str], latency_s: float,
+                         data: Optional[Dict[str, Any]], ttft_s: Optional[float] = None):
+        data = data or {}
+        key = (phone, model or data.get("model") or "")
+        self.latency.observe(key, latency_s)
+        if ttft_s is None and (data.get("prompt_eval_duration") is not None or data.get("load_duration") is not None):
+            # non-stream: pierwszy token ~ po załadowaniu modelu i ewaluacji promptu
+            ttft_s = ((data.get("load_duration") or 0) + (data.get("prompt_eval_duration") or 0)) / 1e9
+        if ttft_s is not None:
+            self.ttft.observe(key, ttft_s)
+        tps = _tps(data.get("prompt_eval_count"), data.get("prompt_eval_duration"))
+        if tps: self.prompt_tps.observe(key, tps)
+        tps = _tps(data.get("eval_count"), data.get("eval_duration"))
+        if tps: self.gen_tps.observe(key, tps)
+        if data.get("load_duration"):
+            self.load.observe(key, data["load_duration"] / 1e9)
+        if data.get("prompt_eval_count"):
+            self.prompt_tokens[key] = self.prompt_tokens.get(key, 0) + data["prompt_eval_count"]
+        if data.get("eval_count"):
+            self.gen_tokens[key] = self.gen_tokens.get(key, 0) + data["eval_count"]
+
+    def observe_queue_wait(self, queue: str, phone: str, model: Optional[str], wait_s: float):
+        self.queue_wait.observe((queue, phone, model or ""), wait_s)
+
+    def observe_tenant_wait(self, tenant: str, wait_s: float):
+        self.tenant_wait.observe((tenant,), wait_s)
+
+    def mark_deadline(self, phase: str, phone: str):
+        key = (phase, phone)
+        self.deadline_exceeded[key] = self.deadline_exceeded.get(key, 0) + 1
+
+    def render_prom(self, gauges: Iterable[Tuple[str, str, Dict[str, str], float]] = ()) -> str:
+        """gauges: (nazwa, help, etykiety, wartość) – np. głębokość kolejki jobów, inflight."""
+        successes = max(1, self.total_requests - self.total_failures)
+        avg = self.latency_sum / successes
+        lines = [
+            "# HELP gw_requests_total Total requests",
+            "# TYPE gw_requests_total counter",
+            f"gw_requests_total {self.total_requests}",
+            "# HELP gw_failures_total Total failed requests",
+            "# TYPE gw_failures_total counter",
+            f"gw_failures_total {self.total_failures}",
+            "# HELP gw_latency_seconds_avg Average success latency",
+            "# TYPE gw_latency_seconds_avg gauge",
+            f"gw_latency_seconds_avg {avg:.6f}",
+        ]
+        for k, v in self.phone_hits.items():
+            lines.append(f'gw_phone_hits_total{{phone=\"{k}\"}} {v}')
+        for fam in (self.latency, self.ttft, self.queue_wait, self.tenant_wait, self.prompt_tps, self.gen_tps, self.load):
+            lines.extend(fam.render())
+        for name, help_, series in (("gw_prompt_tokens_total", "Prompt tokens evaluated", self.prompt_tokens),
+                                    ("gw_generated_tokens_total", "Tokens generated", self.gen_tokens)):
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} counter")
+            for (phone, model), v in series.items():
+                lines.append(f'{name}{{phone="{phone}",model="{model}"}} {v}')
+        lines += ["# HELP gw_deadline_exceeded_total Phone calls aborted by a phase deadline",
+                  "# TYPE gw_deadline_exceeded_total counter"]
+        for (phase, phone), v in self.deadline_exceeded.items():
+            lines.append(f'gw_deadline_exceeded_total{{phase="{phase}",phone="{phone}"}} {v}')
+        seen = set()
+        for name, help_, labels, value in gauges:
+            if name not in seen:
+                seen.add(name)
+                lines += [f"# HELP {name} {help_}", f"# TYPE {name} gauge"]
+            lbl = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{lbl}}} {value}" if lbl else f"{name} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,106 @@
+# core/pool.py
+from __future__ import annotations
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional
+
+import httpx
+
+class _ClosingStream(httpx.AsyncByteStream):
+    """Ciało odpowiedzi, które przy zamknięciu (raz) woła on_close – połączenie wraca do puli."""
+    def __init__(self, inner: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self._inner = inner
+        self._on_close: Optional[Callable[[], None]] = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._inner:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if self._on_close is not None:
+            self._on_close(); self._on_close = None
+        await self._inner.aclose()
+
+class _CountingTransport(httpx.AsyncBaseTransport):
+    """Transport puli + licznik żądań trzymających połączenie (od wysłania do zamknięcia odpowiedzi)."""
+    def __init__(self, inner: httpx.AsyncBaseTransport):
+        self._inner = inner
+        self.active = 0
+
+    def _done(self) -> None:
+        self.active -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        try:
+            resp = await self._inner.handle_async_request(request)
+        except BaseException:
+            self.active -= 1
+            raise
+        resp.stream = _ClosingStream(resp.stream, self._done)
+        return resp
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+class PhoneClient:
+    """
+    Długożyjący klient HTTP (pula połączeń keep-alive) dla jednego telefonu:
+    - rozmiar puli = max_concurrency + zapas na health-checki / ping
+    - osobne timeouty: connect vs read (read=None -> bez limitu, jak dotąd)
+    - statystyki: nowe połączenia vs ponownie użyte (przez trace httpcore), zajęte
+      połączenia (żądania w toku, liczone we własnym transporcie – bez prywatnych pól httpx)
+    """
+    def __init__(self, host: str, port: int, max_concurrency: int,
+                 connect_timeout: float = 5.0, read_timeout: Optional[float] = None,
+                 spare: int = 2):
+        self.base_url = f"http://{host}:{port}"
+        size = max(1, int(max_concurrency)) + max(0, int(spare))
+        self.max_connections = size
+        self.connect_timeout = connect_timeout
+        self.requests = 0
+        self.new_connections = 0
+        self._transport = _CountingTransport(httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size)))
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url, transport=self._transport,
+            timeout=self.timeout(read_timeout),
+            event_hooks={"request": [self._on_request]})
+
+    def timeout(self, read: Optional[float], connect: Optional[float] = None) -> httpx.Timeout:
+        # read/write/pool dostają ten sam limit, connect osobny (None -> domyślny puli)
+        return httpx.Timeout(read, connect=self.connect_timeout if connect is None else connect)
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event: str, info: Dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.complete":
+            self.new_connections += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self._transport.active,
+            "max": self.max_connections,
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused": max(0, self.requests - self.new_connections),
+        }
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+def render_pool_prom(clients: Iterable[tuple]) -> str:
+    """clients: iterowalne (phone_key, PhoneClient)"""
+    rows: List[tuple] = [(k, c.stats()) for k, c in clients if c is not None]
+    lines: List[str] = []
+    for name, field, kind, help_ in (
+        ("gw_pool_connections_active", "active", "gauge", "Connections carrying a request per phone pool"),
+        ("gw_pool_connections_max", "max", "gauge", "Configured pool size per phone"),
+        ("gw_pool_connections_new_total", "new_connections", "counter", "TCP connections opened"),
+        ("gw_pool_connections_reused_total", "reused", "counter", "Requests served on a reused connection"),
+    ):
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {kind}")
+        for k, s in rows:
+            lines.append(f'{name}{{phone="{k}"}} {s[field]}')
+    return "\n".join(lines) + "\n"
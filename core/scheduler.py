@@ -0,0 +1,206 @@
+# core/scheduler.py
+from __future__ import annotations
+import heapq, itertools
+from typing import Any, Dict, FrozenSet, List, Optional
+
+class Scheduler:
+    """
+    Polityka wyboru telefonu. Wszystkie metody są synchroniczne – w jednej pętli
+    asyncio nie potrzebują locka (brak await między odczytem a zapisem stanu).
+    - select(): zwraca telefon albo None (Gateway robi wtedy fallback);
+      free_only=True -> tylko telefony z wolnym slotem (dispatcher jobów)
+    - touch(): zmiana inflight/queued/health telefonu
+    - observe(): wynik zakończonego żądania (EWMA latencji i tokenów/s)
+    """
+    name = "base"
+
+    def __init__(self, phones: List[Any], alpha: float = 0.2):
+        self.phones: List[Any] = []
+        self.alpha = alpha
+        for p in phones:
+            self.add(p)
+
+    def add(self, phone: Any) -> None:
+        self.phones.append(phone)
+
+    def remove(self, phone: Any) -> None:
+        self.phones = [p for p in self.phones if p is not phone]
+
+    def touch(self, phone: Any) -> None:
+        pass
+
+    def observe(self, phone: Any, latency_s: Optional[float] = None,
+                tokens_per_s: Optional[float] = None, load_s: Optional[float] = None) -> None:
+        a = self.alpha
+        if latency_s is not None:
+            phone.ewma_latency_s = latency_s if phone.ewma_latency_s is None \
+                else (1 - a) * phone.ewma_latency_s + a * latency_s
+        if tokens_per_s:
+            phone.ewma_tps = tokens_per_s if phone.ewma_tps is None \
+                else (1 - a) * phone.ewma_tps + a * tokens_per_s
+        if load_s:
+            phone.ewma_load_s = load_s if phone.ewma_load_s is None \
+                else (1 - a) * phone.ewma_load_s + a * load_s
+        self.touch(phone)
+
+    def select(self, allowed: Optional[FrozenSet[int]], model: Optional[str], now: float,
+               free_only: bool = False) -> Optional[Any]:
+        raise NotImplementedError
+
+def usable(phone: Any, now: float) -> bool:
+    # health: automat zdrowia (core/health.py) – open nic nie wpuszcza, half_open tylko próby
+    health = getattr(phone, "health", None)
+    if health is None:
+        return phone.healthy and phone.open_until <= now
+    return phone.healthy and health.admits(phone.inflight + phone.queued, now)
+
+def limit(phone: Any) -> int:
+    # bieżący limit współbieżności (adaptacyjny, core/limiter.py) albo max_concurrency z konfiguracji
+    return getattr(phone, "limit", None) or phone.cfg.max_concurrency
+
+def slots(phone: Any) -> int:
+    # sloty dla tego procesu: limit minus sloty zajęte przez inne procesy bramki (tryb współdzielony)
+    return max(0, limit(phone) - getattr(phone, "remote", 0))
+
+def has_free_slot(phone: Any) -> bool:
+    # queued = czekający na semafor, więc wolny slot dopiero gdy nikt nie stoi w kolejce
+    return phone.inflight + phone.queued < slots(phone)
+
+class RoundRobinScheduler(Scheduler):
+    """
+    Dotychczasowe zachowanie: lista z powtórzeniami wg weight, kursor RR.
+    1) zdrowy z wolnym slotem (preferuj model już w pamięci)
+    2) najmniej obciążony zdrowy
+    """
+    name = "rr"
+
+    def __init__(self, phones: List[Any], alpha: float = 0.2):
+        self.rr: List[Any] = []
+        self._rr_idx = 0
+        super().__init__(phones, alpha)
+
+    def add(self, phone: Any) -> None:
+        super().add(phone)
+        self.rr.extend([phone] * max(1, phone.cfg.weight))
+
+    def remove(self, phone: Any) -> None:
+        super().remove(phone)
+        self.rr = [p for p in self.rr if p is not phone]
+        self._rr_idx = 0
+
+    def select(self, allowed, model, now, free_only=False):
+        n = len(self.rr)
+        first_free = None
+        for _ in range(n):
+            st = self.rr[self._rr_idx]
+            self._rr_idx = (self._rr_idx + 1) % n
+            if (
+                    (allowed is None or id(st) in allowed)
+                    and usable(st, now)
+                    and st.inflight < slots(st)
+            ):
+                if model is None or model in st.resident:
+                    return st
+                if first_free is None:
+                    first_free = st
+        if first_free or free_only:
+            return first_free
+
+        best = None
+        best_load = 1e9
+        for st in self.phones:
+            if (allowed is None or id(st) in allowed) and usable(st, now):
+                load = st.inflight / max(1, slots(st))
+                if load < best_load:
+                    best = st
+                    best_load = load
+        return best
+
+class LeastExpectedTimeScheduler(Scheduler):
+    """
+    Least-expected-completion-time (LECT):
+      est = service_s * (1 + max(0, inflight + remote + queued + 1 - limit) / limit)
+    gdzie service_s = EWMA latencji telefonu (dla nowych – optymistyczny prior),
+    limit = bieżący limit współbieżności telefonu, remote = sloty innych procesów bramki.
+    Gdy model nie jest w pamięci telefonu, doliczamy EWMA czasu ładowania.
+
+    Kopiec z leniwą inwalidacją: każda zmiana stanu telefonu (touch/observe)
+    dokłada nowy wpis z wyższą wersją, a przestarzałe wpisy są wyrzucane przy pop.
+    select() to O(log n) w typowym przypadku; telefony niedozwolone (model,
+    health) są zdejmowane i odkładane z powrotem.
+    """
+    name = "lect"
+
+    def __init__(self, phones: List[Any], alpha: float = 0.2,
+                 prior_s: float = 1.0, load_prior_s: float = 5.0):
+        self._heap: List[tuple] = []
+        self._ver: Dict[int, int] = {}
+        self._seq = itertools.count()
+        self.prior_s = prior_s
+        self.load_prior_s = load_prior_s
+        super().__init__(phones, alpha)
+
+    def add(self, phone: Any) -> None:
+        super().add(phone)
+        self._ver[id(phone)] = 0
+        self.touch(phone)
+
+    def remove(self, phone: Any) -> None:
+        super().remove(phone)
+        self._ver.pop(id(phone), None)  # wpisy w kopcu staną się przestarzałe
+
+    def score(self, phone: Any) -> float:
+        service = phone.ewma_latency_s if phone.ewma_latency_s is not None else self.prior_s
+        cap = max(1, limit(phone))
+        backlog = max(0, phone.inflight + getattr(phone, "remote", 0) + phone.queued + 1 - cap)
+        return service * (1.0 + backlog / cap)
+
+    def touch(self, phone: Any) -> None:
+        key = id(phone)
+        if key not in self._ver:
+            return  # telefon usunięty
+        ver = self._ver[key] + 1
+        self._ver[key] = ver
+        heapq.heappush(self._heap, (self.score(phone), ver, next(self._seq), phone))
+        if len(self._heap) > 4 * len(self.phones) + 64:
+            self._compact()
+
+    def observe(self, phone, latency_s=None, tokens_per_s=None, load_s=None):
+        if latency_s is not None and latency_s < self.prior_s:
+            self.prior_s = latency_s  # prior optymistyczny: nowe telefony dostają szansę
+        super().observe(phone, latency_s, tokens_per_s, load_s)
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if self._ver.get(id(e[3])) == e[1]]
+        heapq.heapify(self._heap)
+
+    def select(self, allowed, model, now, free_only=False):
+        best = None; best_score = float("inf")
+        skipped: List[tuple] = []
+        heap = self._heap
+        while heap and heap[0][0] < best_score:
+            entry = heapq.heappop(heap)
+            score, ver, _, st = entry
+            if self._ver.get(id(st)) != ver:
+                continue  # przestarzały wpis
+            skipped.append(entry)
+            if (allowed is not None and id(st) not in allowed) or not usable(st, now):
+                continue
+            if free_only and not has_free_slot(st):
+                continue
+            if model is not None and model not in st.resident:
+                score += st.ewma_load_s if st.ewma_load_s is not None else self.load_prior_s
+            if score < best_score:
+                best, best_score = st, score
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return best
+
+SCHEDULERS = {cls.name: cls for cls in (RoundRobinScheduler, LeastExpectedTimeScheduler)}
+
+def make_scheduler(policy: str, phones: List[Any], **kw) -> Scheduler:
+    try:
+        cls = SCHEDULERS[policy]
+    except KeyError:
+        raise ValueError(f"unknown scheduler policy '{policy}' (known: {', '.join(SCHEDULERS)})")
+    return cls(phones, **kw)
@@ -0,0 +1,173 @@
+# core/shared.py
+from __future__ import annotations
+import asyncio, os, socket, sqlite3, threading, time, uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class SharedState:
+    """
+    Stan współdzielony przez kilka procesów bramki (uvicorn --workers N) albo kilka hostów
+    obsługujących jedną flotę telefonów. Backend wymienny – bramka korzysta tylko z tych metod:
+    - procesy: heartbeat() / alive(); proces bez heartbeatu przez dead_s jest martwy,
+      a jego sloty i joby przechodzą na pozostałe
+    - sloty telefonów: lease() bierze slot tylko gdy suma slotów wszystkich procesów < limit,
+      release() oddaje; usage() – sloty zajęte przez inne procesy (widok schedulera)
+    - limity współbieżności: set_limit() / limits() – ostatnia decyzja limitera wygrywa
+    - metryki: publish_metrics() / metrics() – tekst Prometheus każdego żywego procesu
+    Wszystkie metody async (backend może robić IO).
+    """
+    owner: str
+
+    async def start(self) -> None: ...
+    async def stop(self) -> None: ...
+    async def heartbeat(self) -> None: raise NotImplementedError
+    async def alive(self) -> List[str]: raise NotImplementedError
+    async def lease(self, phone: str, limit: int) -> Optional[int]: raise NotImplementedError
+    async def release(self, lease_id: int) -> None: raise NotImplementedError
+    async def usage(self) -> Dict[str, int]: raise NotImplementedError
+    async def set_limit(self, phone: str, limit: int) -> None: raise NotImplementedError
+    async def limits(self) -> Dict[str, Tuple[int, str, float]]: raise NotImplementedError
+    async def publish_metrics(self, text: str) -> None: raise NotImplementedError
+    async def metrics(self) -> Dict[str, str]: raise NotImplementedError
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (owner TEXT PRIMARY KEY, pid INTEGER, host TEXT, started REAL, seen REAL);
+CREATE TABLE IF NOT EXISTS leases (id INTEGER PRIMARY KEY AUTOINCREMENT, phone TEXT NOT NULL,
+                                   owner TEXT NOT NULL, t REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS leases_phone ON leases(phone);
+CREATE INDEX IF NOT EXISTS leases_owner ON leases(owner);
+CREATE TABLE IF NOT EXISTS limits (phone TEXT PRIMARY KEY, lim INTEGER NOT NULL, owner TEXT, t REAL);
+CREATE TABLE IF NOT EXISTS metrics (owner TEXT PRIMARY KEY, text TEXT NOT NULL, t REAL);
+"""
+
+class SqliteSharedState(SharedState):
+    """
+    SharedState w jednym pliku SQLite (WAL) – procesy na jednym hoście (albo hosty ze wspólnym
+    dyskiem z poprawnymi lockami). lease() to jedna transakcja BEGIN IMMEDIATE (policz + wstaw),
+    więc dwa procesy nie wezmą ostatniego slotu naraz. Zapytania w wątku (to_thread),
+    jedno połączenie na proces pod lockiem. Czas: time.time() (wspólny zegar hosta).
+    """
+    def __init__(self, path: Path, owner: Optional[str] = None, dead_s: float = 10.0):
+        self.path = Path(path)
+        self.owner = owner or worker_id()
+        self.dead_s = dead_s
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), isolation_level=None, check_same_thread=False, timeout=30.0)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        def call():
+            with self._lock:
+                return fn(*args)
+        return await asyncio.to_thread(call)
+
+    def _cutoff(self) -> float:
+        return time.time() - self.dead_s
+
+    async def start(self) -> None:
+        await self.heartbeat()
+
+    async def stop(self) -> None:
+        def clear():
+            for table in ("leases", "workers", "metrics"):
+                self.db.execute(f"DELETE FROM {table} WHERE owner=?", (self.owner,))
+        await self._run(clear)
+        self.db.close()
+
+    async def heartbeat(self) -> None:
+        def beat():
+            now = time.time()
+            self.db.execute("INSERT INTO workers (owner, pid, host, started, seen) VALUES (?,?,?,?,?) "
+                            "ON CONFLICT(owner) DO UPDATE SET seen=excluded.seen",
+                            (self.owner, os.getpid(), socket.gethostname(), now, now))
+            # sprzątanie po martwych: sloty od razu nie są liczone (JOIN z seen), tu tylko usuwane
+            dead = [r[0] for r in self.db.execute("SELECT owner FROM workers WHERE seen < ?", (now - self.dead_s,))]
+            for owner in dead:
+                for table in ("leases", "workers", "metrics"):
+                    self.db.execute(f"DELETE FROM {table} WHERE owner=?", (owner,))
+        await self._run(beat)
+
+    async def alive(self) -> List[str]:
+        return await self._run(lambda: [r[0] for r in self.db.execute(
+            "SELECT owner FROM workers WHERE seen >= ?", (self._cutoff(),))])
+
+    async def lease(self, phone: str, limit: int) -> Optional[int]:
+        """Id slotu albo None, gdy wszystkie procesy razem mają już limit slotów telefonu."""
+        def take():
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                n = self.db.execute("SELECT COUNT(*) FROM leases l JOIN workers w ON w.owner = l.owner "
+                                    "WHERE l.phone=? AND w.seen >= ?", (phone, self._cutoff())).fetchone()[0]
+                lease_id = None
+                if n < limit:
+                    lease_id = self.db.execute("INSERT INTO leases (phone, owner, t) VALUES (?,?,?)",
+                                               (phone, self.owner, time.time())).lastrowid
+                self.db.execute("COMMIT")
+                return lease_id
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return await self._run(take)
+
+    async def release(self, lease_id: int) -> None:
+        await self._run(lambda: self.db.execute("DELETE FROM leases WHERE id=?", (lease_id,)))
+
+    async def usage(self) -> Dict[str, int]:
+        return await self._run(lambda: {r[0]: r[1] for r in self.db.execute(
+            "SELECT l.phone, COUNT(*) FROM leases l JOIN workers w ON w.owner = l.owner "
+            "WHERE w.seen >= ? AND l.owner != ? GROUP BY l.phone", (self._cutoff(), self.owner))})
+
+    async def set_limit(self, phone: str, limit: int) -> None:
+        await self._run(lambda: self.db.execute(
+            "INSERT OR REPLACE INTO limits (phone, lim, owner, t) VALUES (?,?,?,?)",
+            (phone, int(limit), self.owner, time.time())))
+
+    async def limits(self) -> Dict[str, Tuple[int, str, float]]:
+        return await self._run(lambda: {r[0]: (r[1], r[2], r[3]) for r in self.db.execute(
+            "SELECT phone, lim, owner, t FROM limits")})
+
+    async def publish_metrics(self, text: str) -> None:
+        await self._run(lambda: self.db.execute(
+            "INSERT OR REPLACE INTO metrics (owner, text, t) VALUES (?,?,?)", (self.owner, text, time.time())))
+
+    async def metrics(self) -> Dict[str, str]:
+        return await self._run(lambda: {r[0]: r[1] for r in self.db.execute(
+            "SELECT m.owner, m.text FROM metrics m JOIN workers w ON w.owner = m.owner "
+            "WHERE w.seen >= ? ORDER BY m.owner", (self._cutoff(),))})
+
+def _with_label(sample: str, label: str) -> str:
+    brace, space = sample.find("{"), sample.find(" ")
+    if 0 <= brace < space:   # nazwa{etykiety} wartość
+        sep = "" if sample[brace + 1] == "}" else ","
+        return f"{sample[:brace + 1]}{label}{sep}{sample[brace + 1:]}"
+    return f"{sample[:space]}{{{label}}}{sample[space:]}"
+
+def merge_prom(texts: Dict[str, str], label: str = "worker") -> str:
+    """
+    Teksty Prometheus kilku procesów -> jeden: każda próbka dostaje etykietę worker="...",
+    rodzina metryk (HELP/TYPE + próbki) występuje raz, w kolejności pierwszego wystąpienia.
+    """
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for owner, text in texts.items():
+        current = ""
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("# "):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    current = parts[2]
+                    head, _ = families.setdefault(current, ([], []))
+                    if line not in head:
+                        head.append(line)
+                continue
+            families.setdefault(current, ([], []))[1].append(_with_label(line, f'{label}="{owner}"'))
+    out: List[str] = []
+    for head, samples in families.values():
+        out += head + samples
+    return "\n".join(out) + "\n"
@@ -0,0 +1,43 @@
+# core/singleflight.py
+from __future__ import annotations
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Mapping
+
+class SingleFlight:
+    """
+    Deduplikacja identycznych żądań w locie (po kluczu, np. cache_key()):
+    pierwsze wywołanie wykonuje fn(), równoległe duplikaty czekają na ten sam
+    wynik – także na ten sam wyjątek. fn() działa we własnym tasku, więc
+    rozłączenie klienta-lidera nie przerywa pracy pozostałym.
+    """
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.hits = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is not None:
+            self.hits += 1
+        else:
+            self.leaders += 1
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # odebrany – brak ostrzeżeń gdy wszyscy czekający się rozłączyli
+
+    def inflight(self) -> int:
+        return len(self._calls)
+
+def render_coalesce_prom(counters: Mapping[str, int]) -> str:
+    lines = ["# HELP gw_coalesced_total Requests served by an identical in-flight request",
+             "# TYPE gw_coalesced_total counter"]
+    for kind, n in counters.items():
+        lines.append(f'gw_coalesced_total{{kind="{kind}"}} {n}')
+    return "\n".join(lines) + "\n"
@@ -1,34 +1,62 @@
 # core/store.py
 from __future__ import annotations
+import asyncio
 import json
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from datetime import datetime, timezone
 import tempfile
 import os
 
 DYNAMIC_KEYS = {
-    "healthy", "reason", "inflight", "models",
-    "last_ok_at", "last_error_at", "open_until"
+    "healthy", "reason", "inflight", "models", "resident",
+    "last_ok_at", "last_error_at", "open_until", "circuit", "limit"
 }
 
 def _iso_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+def _atomic_write(path: Path, text: str) -> None:
+    tmpfd, tmppath = tempfile.mkstemp(prefix=path.stem + ".", suffix=path.suffix, dir=str(path.parent))
+    try:
+        with os.fdopen(tmpfd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    finally:
+        try:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        except Exception:
+            pass
+
 class DeviceStore:
     """
-    phones.json store:
-    - NIE nadpisuje pól konfiguracyjnych (host, port, model, weight, max_concurrency, serial)
-    - Aktualizuje TYLKO dynamiczne (DYNAMIC_KEYS)
+    Konfiguracja urządzeń + ich stan runtime, w dwóch plikach:
+    - phones.json: konfiguracja (host, port, model, weight, max_concurrency, serial) –
+      pisana przez phones_map.sh / człowieka, bramka jej NIE nadpisuje; reload() czyta ją
+      ponownie (hot-reload), a pola runtime zapisane tam przez starsze wersje są pomijane
+    - state_path (domyślnie phones.state.json obok): DYNAMIC_KEYS per urządzenie
+    - update_dynamic()/mark_*() zmieniają tylko pamięć; run() zapisuje stan z opóźnieniem
+      debounce_s (zmiany z tego okna idą jednym zapisem), serializacja i zapis poza pętlą
+      asyncio (to_thread), atomowo (tmp + fsync + replace)
     - NIE dodaje nowych rekordów (brak autodiscovery)
     - Deduplikacja po serial, a gdy brak – po "host:port"
     """
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, state_path: Optional[Path] = None, debounce_s: float = 2.0):
         self.path = Path(path)
+        self.state_path = Path(state_path) if state_path else self.path.with_name(self.path.stem + ".state.json")
+        self.debounce_s = debounce_s
         self._data: List[Dict[str, Any]] = []
         self._index: Dict[str, int] = {}
+        self._state: Dict[str, Dict[str, Any]] = {}
         self._dirty = False
+        self._changed = asyncio.Event()
+        self.mtime: Optional[float] = None
+        self.writes = 0
         self.reload()
+        self._load_state()
 
     def _key_for(self, entry: Dict[str, Any]) -> Optional[str]:
         serial = entry.get("serial")
@@ -37,33 +65,73 @@ class DeviceStore:
         if host and port is not None: return f"{host}:{port}"
         return None
 
-    def reload(self) -> None:
+    def _read(self) -> tuple:
+        mtime = self.path.stat().st_mtime
         raw = json.loads(self.path.read_text())
         if not isinstance(raw, list):
             raise ValueError("phones.json must be a JSON array")
-        self._data = raw
-        self._rebuild_index()
-        self._dirty = False
+        return mtime, [{k: v for k, v in e.items() if k not in DYNAMIC_KEYS} for e in raw if isinstance(e, dict)]
+
+    def _apply(self, mtime: float, data: List[Dict[str, Any]],
+               check: Optional[Callable[[List[Dict[str, Any]]], Any]]) -> Any:
+        index = self._build_index(data)
+        entries = [dict(data[i]) for i in sorted(index.values())]
+        # check() rzuca przy złych wpisach – wtedy obecna konfiguracja zostaje
+        result = check(entries) if check is not None else entries
+        self.mtime, self._data, self._index = mtime, data, index
+        return result
+
+    def reload(self, check: Optional[Callable[[List[Dict[str, Any]]], Any]] = None) -> Any:
+        """
+        Ponowny odczyt phones.json -> wpisy bez duplikatów albo check(wpisy).
+        Zły plik (OSError/ValueError) albo wyjątek z check() – obecna konfiguracja zostaje.
+        """
+        return self._apply(*self._read(), check)
+
+    async def reload_async(self, check: Optional[Callable[[List[Dict[str, Any]]], Any]] = None) -> Any:
+        return self._apply(*(await asyncio.to_thread(self._read)), check)
+
+    async def config_mtime(self) -> Optional[float]:
+        """mtime phones.json (None gdy pliku brak) – do porównania z self.mtime ostatniego reload()."""
+        try:
+            return (await asyncio.to_thread(self.path.stat)).st_mtime
+        except OSError:
+            return None
+
+    def _load_state(self) -> None:
+        try:
+            raw = json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            raw = {}
+        if isinstance(raw, dict):
+            self._state = {k: {f: v for f, v in s.items() if f in DYNAMIC_KEYS}
+                           for k, s in raw.items() if isinstance(s, dict)}
 
-    def _rebuild_index(self) -> None:
-        self._index.clear()
-        for i, e in enumerate(self._data):
+    def _build_index(self, data: List[Dict[str, Any]]) -> Dict[str, int]:
+        index: Dict[str, int] = {}
+        for i, e in enumerate(data):
             k = self._key_for(e)
-            if k is not None and k not in self._index:
-                self._index[k] = i
+            if k is not None and k not in index:
+                index[k] = i
+        return index
+
+    def config(self) -> List[Dict[str, Any]]:
+        """Wpisy konfiguracji bez duplikatów (pierwszy wygrywa)."""
+        return [dict(self._data[i]) for i in sorted(self._index.values())]
 
     def get_entry_by_key(self, key: str) -> Optional[Dict[str, Any]]:
         idx = self._index.get(key)
-        return self._data[idx] if idx is not None else None
+        if idx is None:
+            return None
+        return {**self._data[idx], **self._state.get(key, {})}
 
     def get_snapshot(self) -> List[Dict[str, Any]]:
-        return self._data  # tylko do odczytu
+        return [self.get_entry_by_key(k) for k in self._index]
 
     def update_dynamic(self, key: str, fields: Dict[str, Any]) -> None:
-        idx = self._index.get(key)
-        if idx is None:
+        if key not in self._index:
             return  # nie dopisujemy nowych urządzeń
-        entry = self._data[idx]
+        entry = self._state.setdefault(key, {})
         changed = False
         for k, v in fields.items():
             if k not in DYNAMIC_KEYS:
@@ -71,8 +139,9 @@ class DeviceStore:
             if entry.get(k) != v:
                 entry[k] = v
                 changed = True
-        if changed:
+        if changed and not self._dirty:
             self._dirty = True
+            self._changed.set()
 
     def mark_ok(self, key: str) -> None:
         self.update_dynamic(key, {"last_ok_at": _iso_now(), "last_error_at": None})
@@ -80,19 +149,30 @@ class DeviceStore:
     def mark_error(self, key: str) -> None:
         self.update_dynamic(key, {"last_error_at": _iso_now()})
 
-    def flush_if_dirty(self) -> None:
+    async def run(self) -> None:
+        """Pętla zapisu: pierwsza zmiana -> odczekanie debounce_s -> jeden zapis poza pętlą."""
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await asyncio.sleep(self.debounce_s)
+            try:
+                await self.flush()
+            except OSError:
+                pass   # flush() zostawił _dirty – ponowna próba po debounce_s
+
+    async def flush(self) -> None:
         if not self._dirty:
             return
-        tmpfd, tmppath = tempfile.mkstemp(prefix="phones.", suffix=".json", dir=str(self.path.parent))
+        # kopia w pętli (tanie), json.dumps + zapis + fsync w wątku
+        snapshot = {k: dict(self._state[k]) for k in self._index if k in self._state}
+        self._dirty = False
         try:
-            with os.fdopen(tmpfd, "w", encoding="utf-8") as f:
-                json.dump(self._data, f, ensure_ascii=False, indent=2)
-                f.write("\n")
-            os.replace(tmppath, self.path)
-            self._dirty = False
-        finally:
-            try:
-                if os.path.exists(tmppath):
-                    os.remove(tmppath)
-            except Exception:
-                pass
+            await asyncio.to_thread(self._write, snapshot)
+        except Exception:
+            self._dirty = True
+            self._changed.set()
+            raise
+
+    def _write(self, snapshot: Dict[str, Dict[str, Any]]) -> None:
+        _atomic_write(self.state_path, json.dumps(snapshot, ensure_ascii=False, indent=2) + "\n")
+        self.writes += 1
@@ -0,0 +1,55 @@
+# core/streambuf.py
+from __future__ import annotations
+import asyncio
+from typing import AsyncIterator, Tuple
+
+class ChunkBuffer:
+    """
+    Append-only bufor wyjścia joba (bajty NDJSON + linie "# ..."):
+    - dowolna liczba odbiorców, każdy z własnym offsetem (w bajtach)
+    - follow(offset) odtwarza od offsetu, potem czeka na nowe dane aż do close()
+    Zapis synchroniczny – jedna pętla asyncio, bez locków.
+    """
+    __slots__ = ("_data", "closed", "subscribers", "_grown")
+
+    def __init__(self):
+        self._data = bytearray()
+        self.closed = False
+        self.subscribers = 0
+        self._grown = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def append(self, chunk: bytes) -> None:
+        if chunk and not self.closed:
+            self._data += chunk
+            self._notify()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self._notify()
+
+    def _notify(self) -> None:
+        # nowy Event na każdą zmianę: czekający dostają set(), kolejni czekają na świeży
+        self._grown.set()
+        self._grown = asyncio.Event()
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[Tuple[int, bytes]]:
+        """(offset za kawałkiem, kawałek) od offset; koniec po close() i odczytaniu wszystkiego."""
+        pos = max(0, min(offset, len(self._data)))
+        self.subscribers += 1
+        try:
+            while True:
+                grown = self._grown
+                if pos < len(self._data):
+                    chunk = bytes(self._data[pos:])
+                    pos += len(chunk)
+                    yield pos, chunk
+                    continue
+                if self.closed:
+                    return
+                await grown.wait()
+        finally:
+            self.subscribers -= 1
@@ -8,8 +8,10 @@ async def list_devices(request: Request):
     """
     Jeden widok urządzeń:
     - stałe (z phones.json): host, port, serial, weight, max_concurrency, default_model
-    - runtime: healthy, reason, inflight, open_until
-    - ostatnio wykryte modele + timestampe: models, last_ok_at, last_error_at
+    - runtime: healthy, reason, circuit (closed/suspect/open/half_open), inflight, queued, open_until
+    - limit: bieżący adaptacyjny limit współbieżności (sufit = max_concurrency) i zmierzone przy nim tokeny/s
+    - estymaty schedulera: ewma_latency_s, ewma_tokens_per_s
+    - ostatnio wykryte modele + timestampe: models, resident_models (/api/ps), last_ok_at, last_error_at
     """
     app = request.app
     gw = getattr(app.state, "gateway", None)
@@ -17,7 +19,7 @@ async def list_devices(request: Request):
     if gw is None or store is None:
         raise HTTPException(status_code=503, detail="Gateway not ready")
 
-    unique = {id(x): x for x in gw.rr}.values()
+    unique = gw.unique_phones()
     out = []
     for st in unique:
         cfg = st.cfg
@@ -30,13 +32,35 @@ async def list_devices(request: Request):
             "serial": cfg.serial,
             "weight": cfg.weight,
             "max_concurrency": cfg.max_concurrency,
+            "limit": st.limit,
+            "limit_tokens_per_s": st.limiter.tps if st.limiter else None,
             "default_model": cfg.model,
             "healthy": st.healthy,
             "reason": st.reason,
+            "circuit": st.health.state if st.health else None,
             "inflight": st.inflight,
             "open_until": st.open_until,
+            "queued": st.queued,
+            "ewma_latency_s": st.ewma_latency_s,
+            "ewma_tokens_per_s": st.ewma_tps,
             "models": saved.get("models", []),
+            "resident_models": saved.get("resident", []),
             "last_ok_at": saved.get("last_ok_at"),
             "last_error_at": saved.get("last_error_at"),
         })
     return {"object": "list", "data": out}
+
+@router.post("/devices/reload")
+async def reload_devices(request: Request):
+    """
+    Ponowny odczyt phones.json bez restartu (to samo robi watcher co PHONES_WATCH_S):
+    zwraca klucze urządzeń added / removed / resized / updated; zły plik -> 422, flota bez zmian.
+    """
+    gw = getattr(request.app.state, "gateway", None)
+    if gw is None or gw.store is None:
+        raise HTTPException(status_code=503, detail="Gateway not ready")
+    try:
+        diff = await gw.reload_config()
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"phones.json rejected: {e}")
+    return {"object": "devices.reload", **diff, "phones": len(gw.phones)}
@@ -1,24 +1,64 @@
 # routers/jobs.py
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
-from typing import Any, Dict, Optional
+import json, uuid
+from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from core.admission import Overloaded, tenant_of
+from core.deadlines import check_overrides
+from core.embed import F32_MEDIA_TYPE, f32_body
 
 router = APIRouter()
 
+BULK_MAX_REPORTED_ERRORS = 100
+
+def _tenant(request: Request) -> str:
+    """Najemca joba: klucz API (TENANTS) albo nagłówek X-Tenant – patrz core.admission.tenant_of."""
+    key, header = request.headers.get("x-api-key"), request.headers.get("x-tenant")
+    admission = getattr(request.app.state, "admission", None)
+    return admission.tenant(key, header) if admission is not None else tenant_of(key, header, {})
+
 class EnqueueRequest(BaseModel):
     prompt: str
     system: Optional[str] = None
     model: Optional[str] = None
     options: Dict[str, Any] = Field(default_factory=dict)
+    session_id: Optional[str] = None  # powinowactwo rozmowy do telefonu
+    hedge: Optional[bool] = None      # hedging dla jobów non-stream
+    deadlines: Optional[Dict[str, Optional[float]]] = None  # connect_s / ttft_s / inter_token_s / total_s
     priority: int = 5  # 0=wysoki
+    deadline_s: Optional[float] = Field(default=None, gt=0)   # po tylu sekundach od zgłoszenia wynik nie jest potrzebny
+    custom_id: Optional[str] = None   # /jobs/bulk: identyfikator linii zwracany w wynikach grupy
+
+    @field_validator("deadlines")
+    @classmethod
+    def _check_deadlines(cls, v): return check_overrides(v)
+
+class EmbedJobRequest(BaseModel):
+    input: List[str] = Field(min_length=1)
+    model: Optional[str] = None
+    priority: int = 5
+    deadline_s: Optional[float] = Field(default=None, gt=0)
 
 @router.post("/jobs")
 async def enqueue_job(request: Request, body: EnqueueRequest):
     jobs = getattr(request.app.state, "jobs", None)
     if jobs is None:
         raise HTTPException(status_code=503, detail="Jobs engine not ready")
-    job_id = await jobs.enqueue(body.model_dump(), priority=body.priority)
+    # Overloaded (pełna kolejka) -> 429 z Retry-After (handler w server.py)
+    job_id = await jobs.enqueue(body.model_dump(), priority=body.priority,
+                                tenant=_tenant(request), deadline_s=body.deadline_s)
+    return {"job_id": job_id, "queued": True}
+
+@router.post("/jobs/embed")
+async def enqueue_embed_job(request: Request, body: EmbedJobRequest):
+    """Embeddingi jako job: wektory z GET /jobs/{id}/result (format=f32 – binarnie), w kolejności input."""
+    jobs = getattr(request.app.state, "jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="Jobs engine not ready")
+    job_id = await jobs.enqueue({"kind": "embed", "input": body.input, "model": body.model},
+                                priority=body.priority, tenant=_tenant(request), deadline_s=body.deadline_s)
     return {"job_id": job_id, "queued": True}
 
 @router.get("/jobs/{job_id}")
@@ -37,11 +77,26 @@ async def job_status(request: Request, job_id: str):
         "started_at": job.started_at,
         "finished_at": job.finished_at,
         "device": job.device,
-        "error": job.error
+        "error": job.error,
+        "deadline": job.deadline
     }
 
+@router.delete("/jobs/{job_id}")
+async def cancel_job(request: Request, job_id: str):
+    """queued -> usunięty z kolejki; running -> przerwany, slot telefonu wraca do puli."""
+    jobs = getattr(request.app.state, "jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="Jobs engine not ready")
+    job = await jobs.get_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    previous = job.status
+    if await jobs.cancel(job_id) is None:
+        raise HTTPException(status_code=409, detail=f"Job status is {previous}")
+    return {"id": job_id, "cancelled": True, "previous_status": previous}
+
 @router.get("/jobs/{job_id}/result")
-async def job_result(request: Request, job_id: str):
+async def job_result(request: Request, job_id: str, format: Optional[str] = None):
     jobs = getattr(request.app.state, "jobs", None)
     if jobs is None:
         raise HTTPException(status_code=503, detail="Jobs engine not ready")
@@ -50,7 +105,16 @@ async def job_result(request: Request, job_id: str):
         raise HTTPException(status_code=404, detail="Job not found")
     if job.status != "done":
         raise HTTPException(status_code=202, detail=f"Job status is {job.status}")
-    return job.result
+    result = await jobs.get_result(job_id)
+    if format == "f32":
+        if not isinstance(result, dict) or "embeddings" not in result:
+            raise HTTPException(status_code=400, detail="format=f32 is only available for embedding jobs")
+        try:
+            data, headers = f32_body(result)
+        except ValueError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        return Response(content=data, media_type=F32_MEDIA_TYPE, headers=headers)
+    return result
 
 # NEW: strumień wprost po enqueue (tokeny na żywo)
 @router.post("/jobs/stream")
@@ -58,10 +122,130 @@ async def enqueue_job_stream(request: Request, body: EnqueueRequest):
     jobs = getattr(request.app.state, "jobs", None)
     if jobs is None:
         raise HTTPException(status_code=503, detail="Jobs engine not ready")
-    job_id = await jobs.enqueue_stream(body.model_dump(), priority=body.priority)
+    job_id = await jobs.enqueue_stream(body.model_dump(), priority=body.priority,
+                                       tenant=_tenant(request), deadline_s=body.deadline_s)
 
     async def gen():
         async for chunk in jobs.stream_job(job_id):
             if chunk:
                 yield chunk
-    return StreamingResponse(gen(), media_type="application/octet-stream")
+    # X-Job-Id: po zerwaniu połączenia GET /jobs/{id}/stream?from=<odebrane bajty>
+    return StreamingResponse(gen(), media_type="application/octet-stream", headers={"X-Job-Id": job_id})
+
+@router.get("/jobs/{job_id}/stream")
+async def job_stream(request: Request, job_id: str, offset: int = Query(default=0, alias="from", ge=0),
+                     format: Optional[str] = None):
+    """
+    Wyjście joba od offsetu (bajty), potem na żywo – dowolnie wielu odbiorców.
+    format=sse (albo Accept: text/event-stream): zdarzenie na linię, id = offset
+    za linią, więc przeglądarka wznawia sama (Last-Event-ID); na końcu event: end.
+    """
+    jobs = getattr(request.app.state, "jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="Jobs engine not ready")
+    job = await jobs.get_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    sse = format == "sse" or (format is None and "text/event-stream" in request.headers.get("accept", ""))
+    if not sse:
+        async def raw():
+            async for _, chunk in jobs.follow(job_id, offset):
+                yield chunk
+        return StreamingResponse(raw(), media_type="application/octet-stream")
+
+    last = request.headers.get("last-event-id")
+    if last and last.isdigit():
+        offset = int(last)
+
+    async def events():
+        async for end, chunk in jobs.follow(job_id, offset):
+            pos = end - len(chunk)
+            for line in chunk.splitlines(keepends=True):
+                pos += len(line)
+                text = line.rstrip(b"\r\n").decode(errors="replace")
+                yield f"id: {pos}\ndata: {text}\n\n".encode()
+        done = await jobs.get_status(job_id)
+        yield f"event: end\ndata: {json.dumps({'status': done.status if done else None})}\n\n".encode()
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def _lines(request: Request) -> AsyncIterator[bytes]:
+    """Linie ciała żądania czytane strumieniowo (bez trzymania całego uploadu w pamięci)."""
+    buf = b""
+    async for chunk in request.stream():
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield line
+    if buf:
+        yield buf
+
+@router.post("/jobs/bulk")
+async def enqueue_bulk(request: Request, priority: Optional[int] = None, start_line: int = Query(default=0, ge=0)):
+    """
+    JSONL: jedna linia = EnqueueRequest -> jeden job w nowej grupie.
+    custom_id domyślnie = numer linii (od start_line); priority z query dla linii bez własnego.
+    Błędne linie są pomijane (raport: errors). Pełna kolejka -> 429 z group_id
+    i resume_from_line – ponowny upload od tej linii z ?group=<group_id>&start_line=<resume_from_line>
+    (numery linii, a więc i domyślne custom_id, liczone dalej jak w pierwszym uploadzie).
+    """
+    jobs = getattr(request.app.state, "jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="Jobs engine not ready")
+    tenant = _tenant(request)
+    group = request.query_params.get("group") or uuid.uuid4().hex
+    accepted, rejected, lineno = 0, 0, start_line - 1
+    errors: List[Dict[str, Any]] = []
+    try:
+        async for raw in _lines(request):
+            lineno += 1
+            if not raw.strip():
+                continue
+            try:
+                obj = json.loads(raw)
+                if not isinstance(obj, dict):
+                    raise ValueError("line is not a JSON object")
+                obj.setdefault("custom_id", str(lineno))
+                if priority is not None:
+                    obj.setdefault("priority", priority)
+                body = EnqueueRequest.model_validate(obj)
+            except ValueError as e:   # JSONDecodeError / pydantic ValidationError
+                rejected += 1
+                if len(errors) < BULK_MAX_REPORTED_ERRORS:
+                    errors.append({"line": lineno, "error": str(e)})
+                continue
+            await jobs.enqueue(body.model_dump(), priority=body.priority, tenant=tenant, group=group,
+                               deadline_s=body.deadline_s)
+            accepted += 1
+    except Overloaded as e:
+        return JSONResponse(status_code=429, headers={"Retry-After": str(e.retry_after_s)}, content={
+            "detail": str(e), "group_id": group, "accepted": accepted, "rejected": rejected,
+            "resume_from_line": lineno, "errors": errors})
+    return {"group_id": group, "accepted": accepted, "rejected": rejected, "errors": errors}
+
+@router.get("/jobs/groups/{group_id}")
+async def group_status(request: Request, group_id: str):
+    jobs = getattr(request.app.state, "jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="Jobs engine not ready")
+    counts = await jobs.group_counts(group_id)
+    if not counts:
+        raise HTTPException(status_code=404, detail="Group not found")
+    out = {"group_id": group_id, "queued": 0, "running": 0, "done": 0, "error": 0}
+    out.update(counts)
+    return out
+
+@router.get("/jobs/groups/{group_id}/results")
+async def group_results(request: Request, group_id: str):
+    """JSONL w kolejności ukończenia; strumień trwa, aż skończą się wszystkie joby grupy."""
+    jobs = getattr(request.app.state, "jobs", None)
+    if jobs is None:
+        raise HTTPException(status_code=503, detail="Jobs engine not ready")
+    if not await jobs.group_counts(group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+
+    async def gen():
+        async for row in jobs.group_results(group_id):
+            line = {"custom_id": row["req"].get("custom_id"), "id": row["id"], "status": row["status"],
+                    "result": row["result"], "error": row["error"]}
+            yield (json.dumps(line, ensure_ascii=False) + "\n").encode()
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
@@ -1,16 +1,32 @@
-import asyncio, json, logging, random, time, contextlib, hashlib, sys
+import asyncio, json, logging, os, random, time, contextlib, hashlib, sys, uuid
+from collections import deque
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Optional, Any, AsyncIterator
+from typing import Dict, List, Literal, Optional, Any, AsyncIterator, Callable, Deque, Set, Tuple
 
 import httpx
 from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import StreamingResponse, PlainTextResponse
-from pydantic import BaseModel, Field
-from collections import OrderedDict
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
+from pydantic import BaseModel, Field, field_validator
 
 from core.store import DeviceStore
+from core.admission import Admission, Overloaded, retry_after_s
+from core import capture
+from core.capture import TrafficLog
 from core.jobs import JobsEngine
+from core.jobstore import JobStore
+from core.cache import ResponseCache, should_cache
+from core.health import CLOSED, HALF_OPEN, OPEN, HealthEvents, HealthPolicy, PhoneHealth
+from core.embed import EmbedStats, F32_MEDIA_TYPE, chunk_end, est_tokens, f32_body
+from core.deadlines import Deadlines, PhaseTimeout, check_overrides, phase_budget, resolve_deadlines, within
+from core.metrics import Metrics
+from core.hedge import Hedger
+from core.affinity import AffinityStats, HashRing, affinity_key
+from core.limiter import AdaptiveLimit, LimitPolicy, ResizableSemaphore
+from core.pool import PhoneClient, render_pool_prom
+from core.scheduler import make_scheduler, usable, has_free_slot, slots
+from core.shared import SharedState, SqliteSharedState, merge_prom
+from core.singleflight import SingleFlight, render_coalesce_prom
 from routers.devices import router as devices_router
 from routers.jobs import router as jobs_router
 
@@ -26,48 +42,115 @@ logger.propagate = False
 # Configuration
 API_KEY_REQUIRED = False
 API_KEY_VALUE = ""
-HEALTH_INTERVAL_S = 10
-CB_FAIL_THRESHOLD = 3
-CB_OPEN_SECONDS = 30
-POST_TIMEOUT_S = None
-STREAM_TIMEOUT_S = None
-ENABLE_LRU_CACHE = True
-LRU_MAX_ITEMS = 128
+# katalog phones.json / jobs.db / cache.db; GW_DATA_DIR – np. benchmark na symulowanej flocie (bench/)
+DATA_DIR = Path(os.environ.get("GW_DATA_DIR") or Path(__file__).parent)
+PHONES_WATCH_S = 2.0       # co ile sprawdzać mtime phones.json (hot-reload bez restartu; 0 = tylko POST /devices/reload)
+RELOAD_DRAIN_S = 900       # usunięty telefon / stara pula: maks. czekanie na dokończenie wywołań
+HEALTH_INTERVAL_S = 10     # sonda /api/tags telefonu w stanie closed; podejrzane co ~1s, stabilne co 30s
+CB_FAIL_THRESHOLD = 3      # kolejne porażki (błędy, zawieszenia, sondy) -> circuit open
+CB_OPEN_SECONDS = 5        # pierwsze otwarcie; x2 po każdej nieudanej próbie half-open, maks. CB_OPEN_MAX_SECONDS
+CB_OPEN_MAX_SECONDS = 120
+HEALTH_POLICY = HealthPolicy(fail_threshold=CB_FAIL_THRESHOLD, open_s=CB_OPEN_SECONDS,
+                             open_max_s=CB_OPEN_MAX_SECONDS, probe_s=HEALTH_INTERVAL_S)
+# adaptacyjny limit współbieżności telefonu (AIMD na tokenach/s, core/limiter.py);
+# max_concurrency z phones.json = sufit. False -> stały limit = max_concurrency
+ADAPTIVE_CONCURRENCY = True
+LIMIT_POLICY = LimitPolicy(initial=2, window=8, tolerance=0.1, hold_windows=4, backoff=0.7)
+CONNECT_TIMEOUT_S = 5.0
+# limity faz wywołania telefonu (None = bez limitu); nadpisywane per model i per żądanie (AskRequest.deadlines)
+DEFAULT_DEADLINES = Deadlines(connect_s=CONNECT_TIMEOUT_S, ttft_s=120.0, inter_token_s=30.0, total_s=900.0)
+MODEL_DEADLINES: Dict[str, Dict[str, Optional[float]]] = {}   # np. {"llama3:8b": {"ttft_s": 300}}
+STREAM_MAX_ATTEMPTS = 3    # strumień: pierwsza próba + wznowienia na innych telefonach
+HEALTH_TIMEOUT_S = 5.0
+POOL_SPARE_CONNECTIONS = 2   # ponad max_concurrency: health-check, /ping
+SCHEDULER_POLICY = "lect"   # "lect" (least expected completion time) | "rr" (weighted round-robin)
+EWMA_ALPHA = 0.2
+JOBS_DB_PATH = DATA_DIR / "jobs.db"   # None -> joby tylko w pamięci
+JOBS_RESULT_TTL_S = 24 * 3600
+JOBS_MAX_FINISHED = 200_000
+JOBS_MAX_RESULT_BYTES = 512 * 1024 * 1024
+ENABLE_AFFINITY = True     # session_id / system prompt / prefiks -> ten sam telefon (KV cache Ollamy)
+AFFINITY_CANDIDATES = 2    # ile kolejnych telefonów z pierścienia próbować przed schedulerem
+AFFINITY_MIN_PREFIX_CHARS = 256
+HEDGE_DEFAULT = False      # opt-in per żądanie (AskRequest.hedge / EnqueueRequest.hedge)
+HEDGE_PERCENTILE = 0.95    # hedge, gdy pierwszy token nie przyszedł w tym kwantylu TTFT modelu
+HEDGE_BUDGET_PCT = 0.10    # maks. dodatkowy ruch z hedge'y
+HEDGE_MIN_SAMPLES = 20
+ENABLE_COALESCING = True   # identyczne /ask w locie czekają na jeden wynik
+ENABLE_RESPONSE_CACHE = True   # tylko deterministyczne żądania (temperature=0 / seed), chyba że AskRequest.cache
+CACHE_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+CACHE_TTL_S = 3600
+CACHE_DISK_PATH = DATA_DIR / "cache.db"   # None -> tylko pamięć
+CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+# admission control: None = bez limitu; /ask* = żądania w obsłudze, ask_batch = elementy, jobs = joby w kolejce,
+# embed = teksty w obsłudze /embed
+ADMISSION_LIMITS: Dict[str, Optional[int]] = {"ask": 64, "ask_batch": 256, "jobs": 10_000, "embed": 200_000}
+ADMISSION_KEY_LIMITS: Dict[str, Dict[str, Optional[int]]] = {}   # {"<najemca>": {"ask": 8}, "*": domyślne}
+# najemcy (zespoły): X-API-Key -> nazwa; bez wpisu nagłówek X-Tenant albo skrót klucza
+TENANTS: Dict[str, str] = {}
+TENANT_WEIGHTS: Dict[str, float] = {}   # udział w slotach przy kolejce jobów (WFQ); brak wpisu = 1.0
+JOBS_AGING_S = 300.0       # co tyle sekund czekania job zyskuje jeden poziom priorytetu
+RETRY_AFTER_MAX_S = 300
+RETRY_AFTER_LATENCY_S = 10.0   # zakładana latencja telefonu bez pomiarów (EWMA)
+BATCH_MAX_INFLIGHT = 32    # /ask_batch: maks. elementów w locie (dodatkowo <= sloty sprawnych telefonów)
+# /embed: teksty dzielone na kawałki wg zmierzonej przepustowości telefonu (tokeny/s prefillu)
+EMBED_CHUNK_S = 2.0        # docelowy czas jednego kawałka na telefonie
+EMBED_MIN_CHUNK = 4        # teksty w kawałku: min / maks.
+EMBED_MAX_CHUNK = 256
+EMBED_PRIOR_TPS = 200.0    # tokeny/s telefonu bez pomiarów (pierwsze kawałki)
+EMBED_MAX_INFLIGHT = 32    # maks. kawałków jednego żądania w locie (dodatkowo <= wolne sloty floty)
+EMBED_MAX_ATTEMPTS = 3     # kawałek: pierwsza próba + ponowienia na innych telefonach
+EMBED_CHUNK_TIMEOUT_S = 300.0
+EMBED_MAX_TEXTS = 100_000
+# zapis ruchu (/ask*, /jobs*) do rotowanego JSONL pod bench/replay.py; None -> wyłączony
+CAPTURE_PATH: Optional[Path] = Path(os.environ["GW_CAPTURE"]) if os.environ.get("GW_CAPTURE") else None   # np. DATA_DIR / "traffic.jsonl"
+CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+CAPTURE_BACKUPS = 5
+CAPTURE_FULL_BODY = False  # False: tylko skrót ciała + rozmiar promptu i options (bez treści)
+# tryb współdzielony: kilka procesów bramki (uvicorn --workers N) obsługuje jedną flotę – sloty
+# telefonów, limity, joby i metryki przez wspólny SQLite (core/shared.py); None -> jeden proces
+SHARED_STATE_PATH = Path(os.environ["GW_SHARED_STATE"]) if os.environ.get("GW_SHARED_STATE") else None
+SHARED_SYNC_S = 0.5        # heartbeat + odczyt slotów / limitów pozostałych procesów
+SHARED_DEAD_S = 10.0       # proces bez heartbeatu: jego sloty wracają do puli, joby przejmują pozostali
+SHARED_METRICS_S = 5.0     # publikacja metryk procesu dla zbiorczego /metrics
 
 class AskRequest(BaseModel):
     prompt: str
     system: Optional[str] = None
     model: Optional[str] = None
     options: Dict[str, Any] = Field(default_factory=dict)
+    session_id: Optional[str] = None      # powinowactwo rozmowy do telefonu
+    hedge: Optional[bool] = None          # None = HEDGE_DEFAULT
+    cache: Optional[bool] = None          # None = wg determinizmu (temperature=0 / seed)
+    cache_ttl_s: Optional[float] = None   # TTL wpisu; None = CACHE_TTL_S
+    deadlines: Optional[Dict[str, Optional[float]]] = None   # connect_s / ttft_s / inter_token_s / total_s
+
+    @field_validator("deadlines")
+    @classmethod
+    def _check_deadlines(cls, v): return check_overrides(v)
 
 class AskBatchRequest(BaseModel):
     requests: List[AskRequest]
+    stream: bool = False                  # NDJSON: {"index", "ok", "data"} w kolejności ukończenia
+    max_inflight: Optional[int] = Field(default=None, ge=1)   # None = BATCH_MAX_INFLIGHT
+
+class EmbedRequest(BaseModel):
+    input: List[str] = Field(min_length=1, max_length=EMBED_MAX_TEXTS)
+    model: Optional[str] = None           # model embeddingów (np. nomic-embed-text); None = model telefonu
+    format: Literal["json", "f32"] = "json"   # f32: float32 little-endian wierszami (X-Embedding-Dim)
 
 class HealthPhone(BaseModel):
     host: str; port: int; model: Optional[str]
     healthy: bool; reason: Optional[str] = None; inflight: int
+    circuit: str = CLOSED   # closed | suspect | open | half_open
 
 class HealthResponse(BaseModel):
     phones: List[HealthPhone]
 
-class LRUCache:
-    def __init__(self, max_items: int = 128):
-        self.max = max_items
-        self.store: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
-        self.lock = asyncio.Lock()
-    async def get(self, key: str) -> Optional[Dict[str, Any]]:
-        async with self.lock:
-            val = self.store.get(key)
-            if val is not None: self.store.move_to_end(key)
-            return val
-    async def set(self, key: str, val: Dict[str, Any]):
-        async with self.lock:
-            self.store[key] = val; self.store.move_to_end(key)
-            if len(self.store) > self.max: self.store.popitem(last=False)
-
-def cache_key(req: AskRequest, fallback_model: Optional[str]) -> str:
+def cache_key(req: AskRequest, model: Optional[str]) -> str:
+    # model już rozwiązany (Gateway.resolve_model) – bez pytania schedulera o telefon
     payload = {"prompt": req.prompt, "system": req.system,
-               "model": req.model or fallback_model, "options": req.options}
+               "model": model, "options": req.options}
     return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
 
 @dataclass
@@ -77,121 +160,421 @@ class PhoneConfig:
     max_concurrency: int = 1
     serial: Optional[str] = None
 
-@dataclass
+@dataclass(eq=False)  # tożsamość obiektu = telefon (hashowalny, bez porównań pól)
 class PhoneState:
     cfg: PhoneConfig
     healthy: bool = False; reason: Optional[str] = "unknown"
-    inflight: int = 0; failures: int = 0; open_until: float = 0.0
-    semaphore: asyncio.Semaphore = field(init=False)
-    def __post_init__(self): self.semaphore = asyncio.Semaphore(self.cfg.max_concurrency)
+    inflight: int = 0; open_until: float = 0.0   # open_until: kopia z health (widok / phones.json)
+    queued: int = 0   # czekające na semafor
+    ewma_latency_s: Optional[float] = None; ewma_tps: Optional[float] = None
+    ewma_load_s: Optional[float] = None
+    semaphore: ResizableSemaphore = field(init=False)   # limit = bieżący limit współbieżności
+    pool: Optional[PhoneClient] = field(default=None, init=False)  # tworzony w Gateway.start()
+    models: List[str] = field(default_factory=list)     # /api/tags (znormalizowane nazwy)
+    resident: List[str] = field(default_factory=list)   # /api/ps – modele aktualnie w pamięci
+    health: Optional[PhoneHealth] = field(default=None, init=False)   # automat stanu (Gateway)
+    limiter: Optional[AdaptiveLimit] = field(default=None, init=False)   # None -> stały limit
+    remote: int = 0   # tryb współdzielony: sloty zajęte przez inne procesy bramki
+    leases: List[int] = field(default_factory=list)   # tryb współdzielony: id slotów tego procesu
+    limit_at: float = 0.0   # time.time() ostatniej zmiany limitu (tryb współdzielony: nowsza wygrywa)
+    ewma_embed_tps: Optional[float] = None   # /embed: tokeny/s kawałka (wielkość kolejnych kawałków)
+    def __post_init__(self): self.semaphore = ResizableSemaphore(self.cfg.max_concurrency)
+    @property
+    def limit(self) -> int: return self.semaphore.limit
+
+class HeldSlot:
+    """
+    Slot zarezerwowany przez wołającego (try_acquire_slot – dispatcher jobów) na czas wywołania.
+    release() jest idempotentne: failover w _chat_events oddaje slot od razu po przejściu na inny
+    telefon, a wołający i tak woła release() na końcu. take() – własność slotu przechodzi
+    na kogoś, kto zwolni go sam (Gateway.embed).
+    """
+    def __init__(self, gateway: "Gateway", phone: PhoneState):
+        self.gateway = gateway
+        self.phone = phone
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.gateway.release_slot(self.phone)
+
+    def take(self) -> PhoneState:
+        self.released = True
+        return self.phone
+
+class StreamFailed(RuntimeError):
+    """Wywołanie nie dokończone mimo wznowień; __cause__ = ostatni błąd, partial = tekst wygenerowany dotąd."""
+    def __init__(self, msg: str, partial: str = ""):
+        super().__init__(msg)
+        self.partial = partial
+
+class EmbedFailed(RuntimeError):
+    """Kawałek tekstów bez wektorów po EMBED_MAX_ATTEMPTS telefonach (albo bez innego uprawnionego)."""
 
-def load_phones_config() -> List[PhoneConfig]:
-    p = Path(__file__).parent / "phones.json"
-    raw = json.loads(p.read_text())
+class ModelUnavailable(LookupError):
+    """Żaden telefon nie zgłasza żądanego modelu w /api/tags."""
+    def __init__(self, model: str):
+        super().__init__(f"model '{model}' not available on any phone")
+        self.model = model
+
+def normalize_model(name: Optional[str]) -> Optional[str]:
+    # Ollama traktuje "tinyllama" jako "tinyllama:latest"
+    if not name: return None
+    return name if ":" in name else f"{name}:latest"
+
+def phone_configs(entries: List[Dict[str, Any]]) -> List[PhoneConfig]:
+    """Wpisy phones.json -> PhoneConfig (KeyError/ValueError/TypeError przy złym wpisie)."""
     return [PhoneConfig(host=item["host"],
                         port=int(item.get("port", 11434)),
                         model=item.get("model"),
                         weight=int(item.get("weight", 1)),
                         max_concurrency=int(item.get("max_concurrency", 1)),
                         serial=item.get("serial"))
-            for item in raw]
-
-class Metrics:
-    def __init__(self):
-        self.lock = asyncio.Lock()
-        self.total_requests = 0; self.total_failures = 0
-        self.latency_sum = 0.0; self.phone_hits: Dict[str, int] = {}
-    async def mark(self, phone: Optional["PhoneState"], ok: bool, latency: float):
-        async with self.lock:
-            self.total_requests += 1
-            if ok: self.latency_sum += latency
-            else: self.total_failures += 1
-            if phone:
-                key = f"{phone.cfg.host}:{phone.cfg.port}"
-                self.phone_hits[key] = self.phone_hits.get(key, 0) + 1
-    async def render_prom(self) -> str:
-        async with self.lock:
-            successes = max(1, self.total_requests - self.total_failures)
-            avg = self.latency_sum / successes
-            lines = [
-                "# HELP gw_requests_total Total requests",
-                "# TYPE gw_requests_total counter",
-                f"gw_requests_total {self.total_requests}",
-                "# HELP gw_failures_total Total failed requests",
-                "# TYPE gw_failures_total counter",
-                f"gw_failures_total {self.total_failures}",
-                "# HELP gw_latency_seconds_avg Average success latency",
-                "# TYPE gw_latency_seconds_avg gauge",
-                f"gw_latency_seconds_avg {avg:.6f}",
-            ]
-            for k, v in self.phone_hits.items():
-                lines.append(f'gw_phone_hits_total{{phone=\"{k}\"}} {v}')
-            return "\n".join(lines) + "\n"
+            for item in entries]
 
 class Gateway:
-    def __init__(self, cfgs: List[PhoneConfig], store: Optional[DeviceStore] = None):
-        weighted: List[PhoneState] = []
-        for cfg in cfgs:
-            st = PhoneState(cfg=cfg)
-            weighted.extend([st] * max(1, cfg.weight))
-        self.rr: List[PhoneState] = weighted
-        self._rr_idx = 0; self._rr_lock = asyncio.Lock()
+    def __init__(self, cfgs: List[PhoneConfig], store: Optional[DeviceStore] = None,
+                 shared: Optional[SharedState] = None):
+        self.phones: List[PhoneState] = [PhoneState(cfg=cfg) for cfg in cfgs]
+        self.health_events = HealthEvents()
+        self._probers: Dict[int, asyncio.Task] = {}
+        self._probe_wake: Dict[int, asyncio.Event] = {}
+        self.store = store
+        self.shared = shared
+        for p in self.phones:
+            self._init_health(p)
+            self._init_limit(p)
+        self.scheduler = make_scheduler(SCHEDULER_POLICY, self.phones, alpha=EWMA_ALPHA)
+        self.ring = HashRing()
+        for p in self.phones:
+            self.ring.add(p, self._devkey(p.cfg))
+        self.affinity = AffinityStats(EWMA_ALPHA)
+        self.hedger = Hedger(HEDGE_PERCENTILE, HEDGE_BUDGET_PCT, min_samples=HEDGE_MIN_SAMPLES)
+        self.embed_stats = EmbedStats()
         self._hc_task: Optional[asyncio.Task] = None
+        self._store_task: Optional[asyncio.Task] = None
+        self._cache_task: Optional[asyncio.Task] = None
+        self._shared_task: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()   # drenaż pul, zwalnianie slotów współdzielonych
+        self._reload_lock = asyncio.Lock()
         self.metrics = Metrics()
-        self.cache = LRUCache(LRU_MAX_ITEMS) if ENABLE_LRU_CACHE else None
-        self.store = store
+        self.cache = ResponseCache(CACHE_MEMORY_MAX_BYTES, CACHE_TTL_S, CACHE_DISK_PATH,
+                                   CACHE_DISK_MAX_BYTES, shared=shared is not None) if ENABLE_RESPONSE_CACHE else None
+        self.inflight_asks = SingleFlight()
+        self.model_deadlines = {normalize_model(m): d for m, d in MODEL_DEADLINES.items()}
+        # model -> telefony, odświeżane po każdym przebiegu health-checków
+        self.model_index: Dict[str, List[PhoneState]] = {}
+        self._model_ids: Dict[str, frozenset] = {}
+        # wołane gdy może być wolny slot (zwolnienie, zmiana health) – np. dispatcher jobów
+        self._slot_listeners: List[Callable[[], None]] = []
 
     def _devkey(self, cfg: PhoneConfig) -> str:
         return cfg.serial or f"{cfg.host}:{cfg.port}"
 
+    def _init_health(self, phone: PhoneState):
+        phone.health = PhoneHealth(self._devkey(phone.cfg), HEALTH_POLICY,
+                                   lambda h, old, new, reason, p=phone: self._on_health(p, old, new, reason))
+
+    def _init_limit(self, phone: PhoneState):
+        """Limiter startuje od limitu zapamiętanego w phones.state.json (albo LIMIT_POLICY.initial)."""
+        if not ADAPTIVE_CONCURRENCY:
+            return
+        saved = (self.store.get_entry_by_key(self._devkey(phone.cfg)) or {}).get("limit") if self.store else None
+        phone.limiter = AdaptiveLimit(phone.cfg.max_concurrency, LIMIT_POLICY, saved)
+        phone.semaphore.resize(phone.limiter.limit)
+
+    def _set_limit(self, phone: PhoneState, limit: Optional[int], reason: str, at: Optional[float] = None):
+        """
+        Nowy limit współbieżności (None = bez zmian): semafor, scheduler, phones.state.json, dispatcher;
+        w trybie współdzielonym też pozostałe procesy (reason "shared" = decyzja innego procesu z chwili at).
+        """
+        if limit is None or limit == phone.semaphore.limit:
+            return
+        grew = limit > phone.semaphore.limit
+        phone.semaphore.resize(limit)
+        phone.limit_at = at or time.time()
+        self.scheduler.touch(phone)
+        key = self._devkey(phone.cfg)
+        if self.store and phone in self.phones:
+            self.store.update_dynamic(key, {"limit": limit})
+        if self.shared and reason != "shared":
+            self._spawn(self.shared.set_limit(key, limit))
+        logger.info("[limit] %s -> %d/%d (%s)", key, limit, phone.cfg.max_concurrency, reason)
+        if grew:
+            self._notify_slots()
+
+    def _on_health(self, phone: PhoneState, old: str, new: str, reason: str):
+        """Przejście automatu zdrowia: zdarzenie + metryka, scheduler, phones.json, rytm sond."""
+        key = self._devkey(phone.cfg)
+        self.health_events.record(key, old, new, reason)
+        (logger.warning if new == OPEN else logger.info)("[health] %s %s -> %s (%s)", key, old, new, reason)
+        phone.open_until = phone.health.open_until if new == OPEN else 0.0
+        self.scheduler.touch(phone)
+        if self.store and phone in self.phones:   # usunięty (drain) nie nadpisuje stanu następcy
+            self.store.update_dynamic(key, {"circuit": new, "open_until": phone.open_until})
+        wake = self._probe_wake.get(id(phone))
+        if wake is not None:
+            wake.set()   # nowy rytm sond od razu (np. sonda tuż po open_until)
+        if new in (CLOSED, HALF_OPEN):
+            self._notify_slots()
+
+    def unique_phones(self) -> List[PhoneState]:
+        return list(self.phones)
+
+    def _open_pool(self, phone: PhoneState):
+        if phone.pool is None:
+            phone.pool = PhoneClient(phone.cfg.host, phone.cfg.port, phone.cfg.max_concurrency,
+                                     connect_timeout=CONNECT_TIMEOUT_S, spare=POOL_SPARE_CONNECTIONS)
+
     async def start(self):
-        self._hc_task = asyncio.create_task(self._health_loop())
+        for p in self.unique_phones():
+            self._open_pool(p)
+            self._start_prober(p)
+        if self.store:
+            self._store_task = asyncio.create_task(self.store.run())
+            if PHONES_WATCH_S:
+                self._hc_task = asyncio.create_task(self._watch_loop())
+        if self.shared:
+            self._shared_task = asyncio.create_task(self._shared_loop())
+        if self.cache is not None:
+            self._cache_task = asyncio.create_task(self.cache.run())   # zapisy cache na dysk poza pętlą
+
     async def stop(self):
-        if self._hc_task:
-            self._hc_task.cancel()
+        tasks = [t for t in [self._hc_task, self._store_task, self._shared_task, self._cache_task,
+                             *self._probers.values(), *self._background] if t]
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
             with contextlib.suppress(asyncio.CancelledError):
-                await self._hc_task
+                await t
+        self._probers.clear()
+        for p in self.unique_phones():
+            if p.pool is not None:
+                await p.pool.aclose(); p.pool = None
+        if self.store:
+            await self.store.flush()
+        if self.cache is not None:
+            self.cache.close()
+
+    def pool_prom(self) -> str:
+        return render_pool_prom((self._devkey(p.cfg), p.pool) for p in self.unique_phones())
 
-    async def _health_loop(self):
+    async def _watch_loop(self):
+        """Hot-reload: zmiana mtime phones.json -> reload_config(); zły plik czeka na kolejną zmianę."""
+        seen = self.store.mtime
         while True:
-            unique = {id(x): x for x in self.rr}.values()
-            await asyncio.gather(*(self._health_check(p) for p in unique))
-            if self.store:
-                self.store.flush_if_dirty()
-            await asyncio.sleep(HEALTH_INTERVAL_S)
+            await asyncio.sleep(PHONES_WATCH_S)
+            mtime = await self.store.config_mtime()
+            if mtime is None or mtime in (seen, self.store.mtime):
+                continue
+            seen = mtime
+            try:
+                await self.reload_config()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning("[reload] phones.json rejected, keeping current fleet: %s", e)
+
+    async def _shared_loop(self):
+        """
+        Tryb współdzielony, co SHARED_SYNC_S: heartbeat procesu, sloty zajęte przez inne procesy
+        (phone.remote – widok schedulera) i limity współbieżności ustawione przez ich limitery.
+        """
+        while True:
+            try:
+                await self.shared.heartbeat()
+                usage = await self.shared.usage()
+                limits = await self.shared.limits()
+            except Exception as e:
+                logger.warning("[shared] sync failed: %s", e)
+                await asyncio.sleep(SHARED_SYNC_S)
+                continue
+            freed = False
+            for p in self.phones:
+                key = self._devkey(p.cfg)
+                remote = usage.get(key, 0)
+                if remote != p.remote:
+                    freed = freed or remote < p.remote
+                    p.remote = remote
+                    self.scheduler.touch(p)
+                lim, owner, at = limits.get(key, (None, None, 0.0))
+                if p.limiter is not None and lim is not None and owner != self.shared.owner and at > p.limit_at:
+                    p.limit_at = at
+                    if lim != p.semaphore.limit:
+                        self._set_limit(p, p.limiter.adopt(lim), "shared", at)
+            if freed:
+                self._notify_slots()
+            await asyncio.sleep(SHARED_SYNC_S)
+
+    async def _lease(self, phone: PhoneState) -> Optional[int]:
+        """
+        Slot telefonu we wspólnym stanie (limit liczony łącznie dla wszystkich procesów) albo None.
+        Anulowanie w trakcie nie gubi slotu: wynik zapytania zostanie oddany po jego zakończeniu.
+        """
+        task = asyncio.ensure_future(self.shared.lease(self._devkey(phone.cfg), phone.semaphore.limit))
+        def orphan(t: asyncio.Future):
+            if not t.cancelled() and t.exception() is None and t.result() is not None:
+                self._spawn(self.shared.release(t.result()))
+        try:
+            lease_id = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            task.add_done_callback(orphan)
+            raise
+        if lease_id is not None:
+            phone.leases.append(lease_id)
+        return lease_id
+
+    async def _wait_lease(self, phone: PhoneState):
+        """Czekanie na slot zajęty przez inne procesy: ponawianie z rosnącą przerwą (do SHARED_SYNC_S)."""
+        delay = 0.005
+        while await self._lease(phone) is None:
+            await asyncio.sleep(delay)
+            delay = min(SHARED_SYNC_S, delay * 2)
+
+    async def reload_config(self) -> Dict[str, List[str]]:
+        """Ponowny odczyt phones.json i zastosowanie różnic do działającej bramki (bez restartu)."""
+        async with self._reload_lock:
+            cfgs = await self.store.reload_async(phone_configs)
+            return await self.apply_config(cfgs)
+
+    async def apply_config(self, cfgs: List[PhoneConfig]) -> Dict[str, List[str]]:
+        """
+        Różnica nowej konfiguracji względem floty (po kluczu serial / host:port):
+        - nowe telefony: stan, pula, sonda, scheduler i pierścień powinowactwa
+        - usunięte: znikają z wyboru od razu, rozpoczęte wywołania kończą się (_drain)
+        - zmiana host/port przy tym samym serial = usunięcie + dodanie
+        - max_concurrency: sufit limitu zmieniany w miejscu (_resize), weight / model – w miejscu
+        Joby korzystają z tych samych slotów (try_acquire_slot), więc ich pojemność idzie za flotą.
+        """
+        current = {self._devkey(p.cfg): p for p in self.phones}
+        wanted = {self._devkey(c): c for c in cfgs}
+        diff: Dict[str, List[str]] = {"added": [], "removed": [], "resized": [], "updated": []}
+        for key, p in current.items():
+            cfg = wanted.get(key)
+            if cfg is None or (cfg.host, cfg.port) != (p.cfg.host, p.cfg.port):
+                self._remove_phone(p)
+                diff["removed"].append(key)
+        for key, cfg in wanted.items():
+            p = current.get(key)
+            if p is None or key in diff["removed"]:
+                self._add_phone(cfg)
+                diff["added"].append(key)
+                continue
+            if cfg == p.cfg:
+                continue
+            old, p.cfg = p.cfg, cfg
+            if cfg.max_concurrency != old.max_concurrency:
+                self._resize(p, old.max_concurrency)
+                diff["resized"].append(key)
+            if cfg.weight != old.weight:
+                self.scheduler.remove(p); self.scheduler.add(p)
+            if (cfg.model, cfg.weight, cfg.serial) != (old.model, old.weight, old.serial):
+                diff["updated"].append(key)
+            self.scheduler.touch(p)
+        self._rebuild_model_index()
+        self._notify_slots()
+        moved = {k: v for k, v in diff.items() if v}
+        if moved:
+            logger.info("[reload] phones.json applied: %s (%d phones, %d slots)", moved,
+                        len(self.phones), sum(p.cfg.max_concurrency for p in self.phones))
+        return diff
+
+    def _add_phone(self, cfg: PhoneConfig):
+        p = PhoneState(cfg=cfg)
+        self._init_health(p)
+        self._init_limit(p)
+        self.phones.append(p)
+        self.scheduler.add(p)
+        self.ring.add(p, self._devkey(cfg))
+        self._open_pool(p)
+        self._start_prober(p)
+
+    def _remove_phone(self, phone: PhoneState):
+        """Telefon znika z wyboru; wywołania, które go już mają (inflight/queued), dokańczają się."""
+        self.phones = [p for p in self.phones if p is not phone]
+        self.scheduler.remove(phone)
+        self.ring.remove(phone)
+        prober = self._probers.pop(id(phone), None)
+        if prober is not None:
+            prober.cancel()
+        self._probe_wake.pop(id(phone), None)
+        phone.healthy, phone.reason = False, "removed"
+        if phone.pool is not None:
+            self._spawn(self._drain(phone.pool, phone))
+
+    def _resize(self, phone: PhoneState, old: int):
+        """Nowy sufit (max_concurrency) bez przerywania trwających wywołań."""
+        ceiling = phone.cfg.max_concurrency
+        self._set_limit(phone, phone.limiter.set_ceiling(ceiling) if phone.limiter else ceiling,
+                        f"max_concurrency {old} -> {ceiling}")
+        if ceiling > old and phone.pool is not None:   # pula rośnie z sufitem; stara dokańcza swoje
+            self._spawn(self._drain(phone.pool))
+            phone.pool = None
+            self._open_pool(phone)
+
+    def _spawn(self, coro):
+        t = asyncio.create_task(coro)
+        self._background.add(t)
+        t.add_done_callback(self._background.discard)
+
+    async def _drain(self, pool: PhoneClient, phone: Optional[PhoneState] = None):
+        """Zamyka pulę, gdy nikt jej nie używa (usunięty telefon: inflight + queued == 0), maks. RELOAD_DRAIN_S."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + RELOAD_DRAIN_S
+        try:
+            while loop.time() < deadline:
+                if phone is not None:
+                    busy = phone.inflight + phone.queued
+                else:
+                    busy = pool.stats()["active"]
+                if not busy:
+                    break
+                await asyncio.sleep(1.0)
+        finally:
+            await pool.aclose()
+
+    def _start_prober(self, phone: PhoneState):
+        self._probe_wake[id(phone)] = asyncio.Event()
+        self._probers[id(phone)] = asyncio.create_task(self._probe_loop(phone))
+
+    async def _probe_loop(self, phone: PhoneState):
+        """Sonda jednego telefonu w rytmie z automatu zdrowia (z jitterem – bez synchronizacji telefonów)."""
+        loop = asyncio.get_event_loop()
+        wake = self._probe_wake[id(phone)]
+        while True:
+            await self._health_check(phone)
+            self._rebuild_model_index()
+            self._notify_slots()
+            wake.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wake.wait(), phone.health.probe_in(loop.time()))
 
     async def _health_check(self, phone: PhoneState):
-        now = asyncio.get_event_loop().time()
+        loop = asyncio.get_event_loop()
         key = self._devkey(phone.cfg)
-        if phone.open_until > now:
-            phone.healthy, phone.reason = False, "circuit_open"
-            if self.store:
-                self.store.update_dynamic(key, {
-                    "healthy": False, "reason": "circuit_open",
-                    "inflight": phone.inflight, "open_until": phone.open_until
-                })
-            return
+        if phone.health.state == OPEN and loop.time() < phone.health.open_until:
+            return   # sonda dopiero po open_until
         try:
-            url = f"http://{phone.cfg.host}:{phone.cfg.port}/api/tags"
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                r = await client.get(url)
-                r.raise_for_status()
-                data = r.json()
+            r = await phone.pool.client.get("/api/tags", timeout=phone.pool.timeout(HEALTH_TIMEOUT_S))
+            r.raise_for_status()
+            data = r.json()
             models = [m.get("name") for m in (data.get("models") or []) if m.get("name")]
-            phone.healthy, phone.reason, phone.failures = True, None, 0
+            resident = await self._resident_models(phone)
+            phone.models = sorted({normalize_model(m) for m in models})
+            phone.resident = sorted({normalize_model(m) for m in resident})
+            phone.healthy, phone.reason = True, None
+            phone.health.on_probe(True, loop.time())
             if self.store:
                 self.store.update_dynamic(key, {
                     "healthy": True, "reason": None,
                     "inflight": phone.inflight, "open_until": phone.open_until,
                     "models": sorted(set(models)),
+                    "resident": phone.resident,
                 })
                 self.store.mark_ok(key)
             logger.info("[health] OK %s:%d", phone.cfg.host, phone.cfg.port)
         except Exception as e:
             phone.healthy, phone.reason = False, f"health_fail: {e}"
-            phone.failures += 1
-            if phone.failures >= CB_FAIL_THRESHOLD:
-                phone.open_until = now + CB_OPEN_SECONDS
+            phone.health.on_probe(False, loop.time(), str(e) or type(e).__name__)
             if self.store:
                 self.store.update_dynamic(key, {
                     "healthy": False, "reason": str(e),
@@ -200,38 +583,205 @@ class Gateway:
                 self.store.mark_error(key)
             logger.warning("[health] FAIL %s:%d -> %s", phone.cfg.host, phone.cfg.port, e)
 
-    async def _next_phone(self) -> PhoneState:
+    async def _resident_models(self, phone: PhoneState) -> List[str]:
+        # /api/ps jest opcjonalne (starsze Ollamy) – brak odpowiedzi != awaria telefonu
+        try:
+            r = await phone.pool.client.get("/api/ps", timeout=phone.pool.timeout(HEALTH_TIMEOUT_S))
+            r.raise_for_status()
+            return [m.get("name") or m.get("model") for m in (r.json().get("models") or [])
+                    if m.get("name") or m.get("model")]
+        except Exception:
+            return []
+
+    def _rebuild_model_index(self):
+        index: Dict[str, List[PhoneState]] = {}
+        for p in self.unique_phones():
+            for m in p.models:
+                index.setdefault(m, []).append(p)
+        self.model_index = index
+        self._model_ids = {m: frozenset(id(p) for p in ps) for m, ps in index.items()}
+
+    def eligible_phones(self, model: Optional[str]) -> List[PhoneState]:
+        """
+        Telefony, które mogą obsłużyć model:
+        - brak modelu w żądaniu albo brak jeszcze danych z health-checków -> wszystkie
+        - inaczej tylko te, które mają model w /api/tags (ModelUnavailable gdy żaden)
+        """
+        want = normalize_model(model)
+        if want is None or not self.model_index:
+            return self.unique_phones()
+        phones = self.model_index.get(want)
+        if not phones:
+            raise ModelUnavailable(model)
+        return phones
+
+    def resolve_model(self, model: Optional[str]) -> Optional[str]:
+        """Model, który faktycznie dostanie żądanie: jawny albo wspólny domyślny floty (None gdy różne)."""
+        if model:
+            return normalize_model(model)
+        defaults = {normalize_model(p.cfg.model) for p in self.phones}
+        return defaults.pop() if len(defaults) == 1 else None
+
+    def affinity_key(self, req: Any) -> Optional[str]:
+        if not ENABLE_AFFINITY:
+            return None
+        return affinity_key(getattr(req, "session_id", None), req.system, req.prompt,
+                            min_prefix_chars=AFFINITY_MIN_PREFIX_CHARS)
+
+    def _affinity_candidates(self, akey: str, allowed: Optional[frozenset]):
+        n = 0
+        for st in self.ring.walk(akey):
+            if allowed is not None and id(st) not in allowed:
+                continue
+            yield st
+            n += 1
+            if n >= AFFINITY_CANDIDATES:
+                return
+
+    def _affinity_pick(self, akey: Optional[str], allowed: Optional[frozenset], now: float) -> Optional[PhoneState]:
+        """Pierwszy telefon z pierścienia, który jest sprawny i ma wolny slot; inaczej None (-> scheduler)."""
+        if akey is None:
+            return None
+        for i, st in enumerate(self._affinity_candidates(akey, allowed)):
+            if usable(st, now) and has_free_slot(st):
+                self.affinity.routed["preferred" if i == 0 else "fallback"] += 1
+                return st
+        self.affinity.routed["fallback"] += 1
+        return None
+
+    def note_prompt_eval(self, phone: PhoneState, req: Any, akey: Optional[str], data: Dict[str, Any]):
+        """Statystyka prompt_eval: trafienie = żądanie z kluczem wylądowało na preferowanym telefonie."""
+        hit = False
+        if akey is not None:
+            want = normalize_model(req.model)
+            allowed = self._model_ids.get(want) if want is not None else None
+            hit = next(self._affinity_candidates(akey, allowed), None) is phone
+        chars = len(req.prompt) + len(req.system or "")
+        self.affinity.observe(phone, hit, chars, data or {})
+
+    async def _next_phone(self, model: Optional[str] = None, akey: Optional[str] = None) -> PhoneState:
+        """
+        Bez globalnego locka: scheduler.select() jest synchroniczny.
+        Najpierw powinowactwo (akey), potem scheduler.
+        Fallback: cokolwiek uprawnionego, żeby nie walić wyjątku (np. gdy brak healthy).
+        """
+        eligible = self.eligible_phones(model)
+        want = normalize_model(model)
+        allowed = self._model_ids.get(want) if want is not None else None
+        now = asyncio.get_event_loop().time()
+        st = self._affinity_pick(akey, allowed, now) or self.scheduler.select(allowed, want, now)
+        return st or random.choice(eligible)
+
+    def add_slot_listener(self, cb: Callable[[], None]):
+        self._slot_listeners.append(cb)
+
+    def remove_slot_listener(self, cb: Callable[[], None]):
+        with contextlib.suppress(ValueError):
+            self._slot_listeners.remove(cb)
+
+    def _notify_slots(self):
+        for cb in self._slot_listeners:
+            cb()
+
+    def fleet_throughput(self) -> float:
+        """Żądania/s, które flota obsłuży teraz: sloty sprawnych telefonów / EWMA latencji."""
         now = asyncio.get_event_loop().time()
-        async with self._rr_lock:
-            n = len(self.rr)
-
-            # 1) preferuj zdrowe z wolną przepustowością
-            for _ in range(n):
-                st = self.rr[self._rr_idx]
-                self._rr_idx = (self._rr_idx + 1) % n
-                if (
-                        st.healthy
-                        and st.open_until <= now
-                        and st.inflight < st.cfg.max_concurrency
-                ):
-                    return st
-
-            # 2) jeśli wszystkie pełne, wybierz najmniej obciążony zdrowy
-            best = None
-            best_load = 1e9
-            for st in self.rr:
-                if st.healthy and st.open_until <= now:
-                    load = st.inflight / max(1, st.cfg.max_concurrency)
-                    if load < best_load:
-                        best = st
-                        best_load = load
-            if best:
-                return best
-
-        # 3) fallback: cokolwiek, żeby nie walić wyjątku (np. gdy brak healthy)
-        return random.choice(self.rr)
+        return sum(slots(p) / (p.ewma_latency_s or RETRY_AFTER_LATENCY_S)
+                   for p in self.phones if usable(p, now))
 
+    def fleet_slots(self) -> int:
+        """Łączna liczba slotów sprawnych telefonów (min. 1 – żeby było czym zmierzyć zdrowie)."""
+        now = asyncio.get_event_loop().time()
+        return max(1, sum(slots(p) for p in self.phones if usable(p, now)))
+
+    def retry_after(self, depth: int) -> int:
+        """Retry-After dla 429: czas zejścia pracy przed nami (depth + to, co już na telefonach)."""
+        backlog = sum(p.inflight + p.queued for p in self.phones)
+        return retry_after_s(depth + backlog, self.fleet_throughput(), hi=RETRY_AFTER_MAX_S)
+
+    def has_free_slot(self) -> bool:
+        now = asyncio.get_event_loop().time()
+        return any(usable(p, now) and has_free_slot(p) for p in self.phones)
+
+    async def try_acquire_slot(self, model: Optional[str] = None, akey: Optional[str] = None,
+                               exclude: Optional[Set[int]] = None) -> Optional[PhoneState]:
+        """
+        Rezerwuje wolny slot na uprawnionym telefonie albo zwraca None (bez czekania).
+        exclude: id telefonów pomijanych (np. te, na których kawałek embeddingów już zawiódł).
+        Zwolnienie: release_slot() albo hold(telefon).release(); wywołania z held nie biorą slotu ponownie.
+        """
+        eligible = self.eligible_phones(model)  # ModelUnavailable, gdy żaden telefon nie ma modelu
+        want = normalize_model(model)
+        allowed = self._model_ids.get(want) if want is not None else None
+        if exclude:
+            allowed = frozenset(id(p) for p in eligible if id(p) not in exclude)
+        now = asyncio.get_event_loop().time()
+        st = self._affinity_pick(akey, allowed, now) or self.scheduler.select(allowed, want, now, free_only=True)
+        if st is None or st.semaphore.locked():
+            return None
+        await st.semaphore.acquire()  # nie czeka: semafor nie jest zablokowany
+        if self.shared:
+            try:
+                lease_id = await self._lease(st)
+            except BaseException:
+                st.semaphore.release()
+                raise
+            if lease_id is None:   # ostatni slot wziął w międzyczasie inny proces
+                st.semaphore.release()
+                return None
+        st.inflight += 1; self.scheduler.touch(st)
+        return st
+
+    def hold(self, phone: PhoneState) -> HeldSlot:
+        """Slot z try_acquire_slot() jako HeldSlot – do przekazania wywołaniom (held=...)."""
+        return HeldSlot(self, phone)
 
+    def release_slot(self, phone: PhoneState):
+        phone.inflight -= 1; phone.semaphore.release()
+        if phone.leases:
+            self._spawn(self.shared.release(phone.leases.pop()))
+        self.scheduler.touch(phone)
+        self._notify_slots()
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, phone: PhoneState, held: bool = False, model: Optional[str] = None):
+        """
+        Slot telefonu (semafor) + liczniki queued/inflight widoczne dla schedulera;
+        w trybie współdzielonym dodatkowo slot we wspólnym stanie (_wait_lease).
+        """
+        if held:
+            yield; return
+        phone.queued += 1; self.scheduler.touch(phone)
+        t_wait = time.perf_counter()
+        try:
+            await phone.semaphore.acquire()
+            if self.shared:
+                try:
+                    await self._wait_lease(phone)
+                except BaseException:
+                    phone.semaphore.release()
+                    raise
+        finally:
+            phone.queued -= 1
+        waited = time.perf_counter() - t_wait
+        self.metrics.observe_queue_wait("slot", self._devkey(phone.cfg), model, waited)
+        capture.note_wait(waited)
+        phone.inflight += 1; self.scheduler.touch(phone)
+        try:
+            yield
+        finally:
+            self.release_slot(phone)
+
+    def _observe(self, phone: PhoneState, latency_s: float, data: Optional[Dict[str, Any]] = None,
+                 model: Optional[str] = None, ttft_s: Optional[float] = None):
+        """EWMA dla schedulera + histogramy (latencja, TTFT, tokeny/s, ładowanie modelu)."""
+        data = data or {}
+        tps = None
+        if data.get("eval_count") and data.get("eval_duration"):
+            tps = data["eval_count"] / (data["eval_duration"] / 1e9)
+        load_s = data["load_duration"] / 1e9 if data.get("load_duration") else None
+        self.scheduler.observe(phone, latency_s, tps, load_s)
+        self.metrics.observe_response(self._devkey(phone.cfg), model, latency_s, data, ttft_s)
 
     def _build_payload(self, req: AskRequest, fallback: Optional[str]) -> Dict[str, Any]:
         messages = []
@@ -243,72 +793,383 @@ class Gateway:
         elif fallback: payload["model"] = fallback
         return payload
 
-    async def _post_chat(self, phone: PhoneState, payload: Dict[str, Any]) -> Dict[str, Any]:
-        url = f"http://{phone.cfg.host}:{phone.cfg.port}/api/chat"
+    def _mark_failure(self, phone: PhoneState, kind: str = "error"):
+        phone.health.on_failure(asyncio.get_event_loop().time(), kind)
+        if phone.limiter is not None:
+            self._set_limit(phone, phone.limiter.on_failure(), kind)
+
+    def _sample_limit(self, phone: PhoneState, latency_s: float, final: Dict[str, Any], inflight_start: int):
+        """
+        Próbka dla limitera: tokeny / latencja przy średniej współbieżności z początku i końca wywołania
+        (współbieżność telefonu = sloty tego procesu + innych procesów bramki).
+        """
+        if phone.limiter is not None:
+            tokens = int(final.get("eval_count") or 0)
+            old = phone.semaphore.limit
+            new = phone.limiter.on_sample(tokens, latency_s, (inflight_start + phone.inflight + phone.remote) / 2)
+            if new is not None:
+                self._set_limit(phone, new, f"{phone.limiter.tps:.1f} tok/s at limit {old}")
+
+    def _mark_success(self, phone: PhoneState, final: Dict[str, Any]):
+        """Sygnał bierny z udanego wywołania; tokeny/s dużo poniżej EWMA telefonu = odstające."""
+        tps = None
+        if final.get("eval_count") and final.get("eval_duration"):
+            tps = final["eval_count"] / (final["eval_duration"] / 1e9)
+        phone.health.on_success(asyncio.get_event_loop().time(), tps, phone.ewma_tps)
+
+    def _failover_phone(self, model: Optional[str], failed: List[PhoneState]) -> Optional[PhoneState]:
+        """Inny uprawniony telefon niż te, które już zawiodły; None gdy brak."""
+        try:
+            eligible = self.eligible_phones(model)
+        except ModelUnavailable:
+            return None
+        allowed = frozenset(id(p) for p in eligible if all(p is not f for f in failed))
+        if not allowed:
+            return None
+        return self.scheduler.select(allowed, normalize_model(model), asyncio.get_event_loop().time())
+
+    def deadlines_for(self, req: Any, model: Optional[str]) -> Deadlines:
+        """Limity faz: DEFAULT_DEADLINES -> MODEL_DEADLINES[model] -> req.deadlines."""
+        return resolve_deadlines(DEFAULT_DEADLINES, self.model_deadlines, normalize_model(model),
+                                 getattr(req, "deadlines", None))
+
+    async def _chat_events(self, phone: PhoneState, payload: Dict[str, Any], held: Optional[HeldSlot] = None,
+                           deadlines: Optional[Deadlines] = None,
+                           route: Optional[List[PhoneState]] = None) -> AsyncIterator[Tuple[bytes, Optional[Dict[str, Any]]]]:
+        """
+        Rdzeń wywołania /api/chat – zawsze strumieniowo, z limitami faz i failoverem:
+        - connect / TTFT (do pierwszej linii) / przerwa między liniami / całość (łącznie ze wznowieniami)
+        - zawieszony telefon (przekroczony limit) liczy się jak awaria: slot jest zwalniany,
+          circuit breaker dostaje błąd, a generacja jest wznawiana na innym telefonie
+          z częściową odpowiedzią dopisaną jako wiadomość assistant
+        - po wyczerpaniu prób albo limitu całości: StreamFailed
+        Zwraca pary (linia NDJSON, obiekt | None gdy linia nie jest JSON-em).
+        held: slot pierwszego telefonu zarezerwowany przez wołającego – zwalniany od razu,
+        gdy wywołanie przechodzi na inny telefon (martwy telefon nie wygląda na zajęty).
+        route: dopisywane telefony kolejnych prób – route[-1] to ten, który obsłużył wywołanie.
+        """
+        model = payload.get("model")
+        dl = deadlines or self.deadlines_for(None, model)
+        loop = asyncio.get_event_loop()
+        t_end = None if dl.total_s is None else loop.time() + dl.total_s
+        generated = ""
+        failed: List[PhoneState] = []
         backoff = 0.5; last_exc: Optional[Exception] = None
-        t0 = time.perf_counter()
-        for _ in range(3):
+        first_token = True
+        attempt = 0
+        while attempt < STREAM_MAX_ATTEMPTS:
+            attempt += 1
+            body = {**payload, "stream": True}
+            if generated:
+                body["messages"] = payload["messages"] + [{"role": "assistant", "content": generated}]
+            capture.note_attempt(self._devkey(phone.cfg))
+            if route is not None:
+                route.append(phone)
+            self.hedger.on_request()   # budżet hedge'y liczony od całego ruchu do telefonów
             try:
-                async with phone.semaphore:
-                    phone.inflight += 1
+                async with self._slot(phone, held is not None and not held.released, model):
+                    t_try = time.perf_counter(); ttft = None; final = None
+                    inflight_start = phone.inflight + phone.remote
+                    t_first = None if dl.ttft_s is None else loop.time() + dl.ttft_s
+                    def budget():
+                        now = loop.time()
+                        total_left = None if t_end is None else t_end - now
+                        if ttft is None:
+                            return phase_budget("ttft", None if t_first is None else t_first - now, total_left)
+                        return phase_budget("inter_token", dl.inter_token_s, total_left)
+                    request = phone.pool.client.build_request(
+                        "POST", "/api/chat", json=body, timeout=phone.pool.timeout(None, connect=dl.connect_s))
+                    resp = await within(phone.pool.client.send(request, stream=True), *budget())
                     try:
-                        async with httpx.AsyncClient(timeout=POST_TIMEOUT_S) as client:
-                            resp = await client.post(url, json=payload); resp.raise_for_status()
-                            await self.metrics.mark(phone, True, time.perf_counter()-t0)
-                            phone.failures = 0
-                            return resp.json()
+                        resp.raise_for_status()
+                        lines = resp.aiter_lines()
+                        while True:
+                            try:
+                                line = await within(lines.__anext__(), *budget())
+                            except StopAsyncIteration:
+                                break
+                            if not line.strip():
+                                continue
+                            raw = line.encode() + b"\n"
+                            try:
+                                obj = json.loads(line)
+                            except ValueError:
+                                yield raw, None; continue
+                            if obj.get("error"):
+                                raise RuntimeError(f"phone error: {obj['error']}")
+                            generated += (obj.get("message") or {}).get("content") or ""
+                            if ttft is None:
+                                ttft = time.perf_counter() - t_try
+                            yield raw, obj
+                            if obj.get("done"):
+                                final = obj
                     finally:
-                        phone.inflight -= 1
+                        await resp.aclose()
+                    if final is None:
+                        raise RuntimeError("stream ended before done")
+                    self._mark_success(phone, final)   # przed _observe: porównanie z EWMA sprzed tego wyniku
+                    latency = time.perf_counter() - t_try
+                    self._observe(phone, latency, final, model, ttft if first_token else None)
+                    if first_token and ttft is not None:
+                        self.hedger.observe(model, ttft)
+                    self._sample_limit(phone, latency, final, inflight_start)
+                    capture.note_done(ttft if first_token else None, final)
+                    return
             except Exception as e:
                 last_exc = e
-                await self.metrics.mark(phone, False, time.perf_counter()-t0)
-                phone.failures += 1
-                if phone.failures >= CB_FAIL_THRESHOLD:
-                    phone.open_until = asyncio.get_event_loop().time() + CB_OPEN_SECONDS
-                await asyncio.sleep(backoff); backoff *= 2
-        raise last_exc or RuntimeError("unknown error")
-
-    async def _stream_chat(self, phone: PhoneState, payload: Dict[str, Any]) -> AsyncIterator[bytes]:
-        url = f"http://{phone.cfg.host}:{phone.cfg.port}/api/chat"
-        payload_stream = {**payload, "stream": True}
-        backoff = 0.5
-        for _ in range(3):
-            try:
-                async with phone.semaphore:
-                    phone.inflight += 1
-                    try:
-                        async with httpx.AsyncClient(timeout=STREAM_TIMEOUT_S) as client:
-                            async with client.stream("POST", url, json=payload_stream) as resp:
-                                resp.raise_for_status()
-                                async for chunk in resp.aiter_bytes():
-                                    if chunk: yield chunk
-                                phone.failures = 0
-                                return
-                    finally:
-                        phone.inflight -= 1
-            except Exception:
-                phone.failures += 1
-                if phone.failures >= CB_FAIL_THRESHOLD:
-                    phone.open_until = asyncio.get_event_loop().time() + CB_OPEN_SECONDS
-                await asyncio.sleep(backoff); backoff *= 2
-        return
+                phase = e.phase if isinstance(e, PhaseTimeout) else "connect" if isinstance(e, httpx.ConnectTimeout) else None
+                if phase:
+                    self.metrics.mark_deadline(phase, self._devkey(phone.cfg))
+                self._mark_failure(phone, "stall" if phase in ("ttft", "inter_token") else phase or "error")
+                failed.append(phone)
+                if generated:
+                    first_token = False
+                if phase == "total" or (t_end is not None and loop.time() >= t_end):
+                    logger.warning("[chat] %s:%d total deadline exceeded after %d chars", phone.cfg.host,
+                                   phone.cfg.port, len(generated))
+                    break
+                nxt = self._failover_phone(model, failed)
+                logger.warning("[chat] %s:%d failed after %d chars: %s -> %s", phone.cfg.host, phone.cfg.port,
+                               len(generated), e, f"{nxt.cfg.host}:{nxt.cfg.port}" if nxt else "retry same")
+                if nxt is None:
+                    await asyncio.sleep(backoff if t_end is None else min(backoff, max(0.0, t_end - loop.time())))
+                    backoff *= 2
+                else:
+                    if held is not None:
+                        held.release()
+                    phone = nxt
+        raise StreamFailed(f"chat failed after {attempt} attempts: {last_exc}", generated) from last_exc
+
+    async def _post_chat(self, phone: PhoneState, payload: Dict[str, Any], held: Optional[HeldSlot] = None,
+                         deadlines: Optional[Deadlines] = None,
+                         on_line: Optional[Callable[[bytes], None]] = None) -> Dict[str, Any]:
+        """
+        Odpowiedź w kształcie non-stream złożona ze strumienia (_chat_events), żeby
+        zawieszenie telefonu było wykrywane tak samo jak w /ask_stream.
+        on_line: surowe linie NDJSON na bieżąco (np. podgląd joba na żywo).
+        """
+        t0 = time.perf_counter()
+        parts: List[str] = []; final: Optional[Dict[str, Any]] = None
+        route: List[PhoneState] = []
+        try:
+            async for raw, obj in self._chat_events(phone, payload, held, deadlines, route):
+                if on_line is not None:
+                    on_line(raw)
+                if obj is None:
+                    continue
+                parts.append((obj.get("message") or {}).get("content") or "")
+                if obj.get("done"):
+                    final = obj
+        except Exception:
+            self.metrics.mark(self._devkey((route[-1] if route else phone).cfg), False, time.perf_counter()-t0)
+            raise
+        self.metrics.mark(self._devkey(route[-1].cfg), True, time.perf_counter()-t0)   # po failoverze: ostatni telefon
+        return {**final, "message": {**(final.get("message") or {}), "role": "assistant", "content": "".join(parts)}}
+
+    async def _stream_chat(self, phone: PhoneState, payload: Dict[str, Any], held: Optional[HeldSlot] = None,
+                           raise_on_error: bool = False, deadlines: Optional[Deadlines] = None) -> AsyncIterator[bytes]:
+        """
+        Strumień NDJSON z /api/chat 1:1 dla klienta (wznowienia na innych telefonach są
+        przezroczyste – bez powtórzeń tekstu). Gdy wszystkie próby zawiodą: końcowe zdarzenie
+        {"error":..., "done": true} (a przy raise_on_error dodatkowo StreamFailed).
+        """
+        try:
+            async for line, _ in self._chat_events(phone, payload, held, deadlines):
+                yield line
+        except StreamFailed as e:
+            capture.mark(status="error")
+            err = {"error": str(e), "done": True, "done_reason": "error", "partial": bool(e.partial)}
+            yield (json.dumps(err) + "\n").encode()
+            if raise_on_error:
+                raise
+
+    def hedge_enabled(self, req: Any) -> bool:
+        h = getattr(req, "hedge", None)
+        return HEDGE_DEFAULT if h is None else bool(h)
+
+    def _hedge_phone(self, model: Optional[str], exclude: PhoneState) -> Optional[PhoneState]:
+        eligible = self.eligible_phones(model)
+        allowed = frozenset(id(p) for p in eligible if p is not exclude)
+        return self.scheduler.select(allowed, normalize_model(model), asyncio.get_event_loop().time(),
+                                     free_only=True)
+
+    async def post_chat_hedged(self, phone: PhoneState, req: Any,
+                               held: Optional[HeldSlot] = None) -> Tuple[PhoneState, Dict[str, Any]]:
+        """
+        _post_chat z hedgingiem: gdy pierwszy token nie przyszedł w kwantylu TTFT modelu,
+        duplikat idzie na inny telefon z wolnym slotem (jeśli pozwala budżet). Telefon,
+        który już generuje, nie jest hedge'owany – długa odpowiedź to nie zawieszenie.
+        Wygrywa pierwsza udana odpowiedź, druga jest anulowana (zwalnia slot).
+        Zwraca (telefon-zwycięzca, wynik).
+        """
+        payload = self._build_payload(req, phone.cfg.model)
+        dl = self.deadlines_for(req, payload.get("model"))
+        first = asyncio.Event()
+        primary = asyncio.create_task(self._post_chat(phone, payload, held, dl, on_line=lambda _: first.set()))
+        tasks: Dict[asyncio.Task, PhoneState] = {primary: phone}
+        started = asyncio.create_task(first.wait())
+        try:
+            delay = self.hedger.delay(payload.get("model"))
+            if delay is not None:
+                await asyncio.wait({primary, started}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not primary.done() and not first.is_set():
+                    alt = self._hedge_phone(req.model, phone)
+                    if alt is None:
+                        self.hedger.stats["no_phone"] += 1
+                    elif self.hedger.try_spend():
+                        self.hedger.stats["issued"] += 1
+                        logger.info("[hedge] %s:%d no first token after %.2fs -> %s:%d", phone.cfg.host, phone.cfg.port,
+                                    delay, alt.cfg.host, alt.cfg.port)
+                        hedge = asyncio.create_task(self._post_chat(alt, self._build_payload(req, alt.cfg.model), deadlines=dl))
+                        tasks[hedge] = alt
+            pending = set(tasks)
+            last_exc: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is not primary:
+                            self.hedger.stats["won"] += 1
+                        return tasks[t], t.result()
+                    last_exc = t.exception()
+            raise last_exc or RuntimeError("unknown error")
+        finally:
+            started.cancel()
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+
+    async def embed(self, texts: List[str], model: Optional[str] = None,
+                    held: Optional[PhoneState] = None) -> Dict[str, Any]:
+        """
+        Wektory texts (w kolejności wejścia) liczone równolegle na flocie przez /api/embed:
+        - każdy wolny slot uprawnionego telefonu (try_acquire_slot: scheduler, circuit breaker,
+          adaptacyjny limit) dostaje kolejny kawałek na ~EMBED_CHUNK_S pracy wg zmierzonych
+          tokenów/s tego telefonu – szybkie telefony biorą większe kawałki
+        - kawałek, który zawiódł, idzie na telefon, na którym jeszcze nie próbował; po
+          EMBED_MAX_ATTEMPTS telefonach (albo gdy innego nie ma) -> EmbedFailed
+        held: slot zarezerwowany przez wołającego (dispatcher jobów) – dostaje pierwszy kawałek,
+        zwalnia go embed(). Zwraca {"model", "embeddings", "prompt_eval_count"}.
+        """
+        n = len(texts)
+        out: List[Optional[List[float]]] = [None] * n
+        cursor, tokens, used_model = 0, 0, None
+        retry: Deque[Tuple[int, int, Set[int]]] = deque()   # (od, do, id telefonów, które zawiodły)
+        running: Dict[asyncio.Task, Tuple[PhoneState, int, int, Set[int]]] = {}
+        wake = asyncio.Event()
+        self.add_slot_listener(wake.set)
+        try:
+            eligible = {id(p) for p in self.eligible_phones(model)}   # ModelUnavailable
+            while cursor < n or retry or running:
+                wake.clear()
+                while (cursor < n or retry) and len(running) < EMBED_MAX_INFLIGHT:
+                    # zostały same powtórki: bez telefonów, na których zawiodły wszystkie – inaczej
+                    # wzięty i oddany slot budziłby tę pętlę w kółko, gdy reszta floty jest zajęta
+                    tried = set.intersection(*(r[2] for r in retry)) if cursor >= n else None
+                    phone = held or await self.try_acquire_slot(model, exclude=tried)
+                    held = None   # zarezerwowany slot tylko dla pierwszego kawałka
+                    if phone is None:
+                        break
+                    item = next((r for r in retry if id(phone) not in r[2]), None)
+                    if item is None and cursor >= n:
+                        self.release_slot(phone)   # slot z held, a zostały kawałki, które na nim zawiodły
+                        break
+                    start, stop, failed = item or (cursor, n, set())
+                    end = chunk_end(texts, start, stop, phone.ewma_embed_tps or EMBED_PRIOR_TPS,
+                                    EMBED_CHUNK_S, EMBED_MIN_CHUNK, EMBED_MAX_CHUNK)
+                    if item is None:
+                        cursor = end
+                    else:
+                        retry.remove(item)
+                        if end < stop:
+                            retry.appendleft((end, stop, failed))   # reszta – dla kolejnego slotu
+                    task = asyncio.create_task(self._embed_chunk(phone, texts[start:end], model))
+                    running[task] = (phone, start, end, failed)
+                if not running:
+                    now = asyncio.get_event_loop().time()
+                    for start, stop, failed in [*retry, *([(cursor, n, set())] if cursor < n else [])]:
+                        if not any(usable(p, now) for p in self.phones if id(p) in eligible - failed):
+                            raise EmbedFailed(f"texts {start}..{stop - 1}: no usable phone left to try")
+                    # brak wolnego slotu (ruch /ask, joby) – czekamy na zwolnienie albo zmianę health
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(wake.wait(), timeout=1.0)
+                    continue
+                waiter = asyncio.ensure_future(wake.wait())
+                done, _ = await asyncio.wait([*running, waiter], return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                for t in done:
+                    if t is waiter:
+                        continue
+                    phone, start, end, failed = running.pop(t)
+                    if t.exception() is not None:
+                        e, failed = t.exception(), failed | {id(phone)}
+                        logger.warning("[embed] %s texts %d..%d failed: %s", self._devkey(phone.cfg), start, end - 1, e)
+                        if len(failed) >= EMBED_MAX_ATTEMPTS or eligible <= failed:
+                            raise EmbedFailed(f"texts {start}..{end - 1} failed on {len(failed)} phone(s): {e}") from e
+                        self.embed_stats.retries += 1
+                        retry.append((start, end, failed))
+                        continue
+                    data = t.result()
+                    out[start:end] = data["embeddings"]
+                    tokens += int(data.get("prompt_eval_count") or 0)
+                    used_model = used_model or data.get("model")
+        except EmbedFailed:
+            self.embed_stats.failed += 1
+            raise
+        finally:
+            self.remove_slot_listener(wake.set)
+            for t in running:
+                t.cancel()   # błąd albo rozłączenie klienta – _embed_chunk zwalnia sloty
+            if held is not None:
+                self.release_slot(held)   # nie doszło do pierwszego kawałka (np. ModelUnavailable)
+        return {"model": used_model or model, "embeddings": out, "prompt_eval_count": tokens}
+
+    async def _embed_chunk(self, phone: PhoneState, texts: List[str], model: Optional[str]) -> Dict[str, Any]:
+        """Jeden kawałek /api/embed na zarezerwowanym slocie (zwalnianym tu) + pomiar tokenów/s telefonu."""
+        key = self._devkey(phone.cfg)
+        t0 = time.perf_counter()
+        self.hedger.on_request()
+        try:
+            r = await phone.pool.client.post("/api/embed", json={"model": model or phone.cfg.model, "input": texts},
+                                             timeout=phone.pool.timeout(EMBED_CHUNK_TIMEOUT_S))
+            r.raise_for_status()
+            data = r.json()
+            vectors = data.get("embeddings")
+            if not isinstance(vectors, list) or len(vectors) != len(texts):
+                raise RuntimeError(f"phone returned {len(vectors or [])} embeddings for {len(texts)} texts")
+        except Exception:
+            self._mark_failure(phone)
+            self.embed_stats.chunk(key, False, len(texts))
+            raise
+        finally:
+            self.release_slot(phone)
+        # bez ładowania modelu – do wielkości kawałków liczy się sama praca telefonu
+        busy = time.perf_counter() - t0 - (data.get("load_duration") or 0) / 1e9
+        tps = int(data.get("prompt_eval_count") or sum(est_tokens(t) for t in texts)) / max(busy, 1e-3)
+        a = EWMA_ALPHA
+        phone.ewma_embed_tps = tps if phone.ewma_embed_tps is None else (1 - a) * phone.ewma_embed_tps + a * tps
+        self._mark_success(phone, data)
+        self.embed_stats.chunk(key, True, len(texts))
+        return data
 
     def health_snapshot(self) -> HealthResponse:
         phones = []
-        seen = set()
-        for st in self.rr:
-            if id(st) in seen: continue
-            seen.add(id(st))
+        for st in self.unique_phones():
             phones.append(HealthPhone(
                 host=st.cfg.host, port=st.cfg.port, model=st.cfg.model,
-                healthy=st.healthy, reason=st.reason, inflight=st.inflight))
+                healthy=st.healthy, reason=st.reason, inflight=st.inflight, circuit=st.health.state))
         return HealthResponse(phones=phones)
 
 app = FastAPI(title="Distributed LLM Mobile Gateway", version="2.0.0")
 gateway: Optional[Gateway] = None
 store: Optional[DeviceStore] = None
+admission = Admission(ADMISSION_LIMITS, ADMISSION_KEY_LIMITS, TENANTS)
+traffic = TrafficLog(CAPTURE_PATH, max_bytes=CAPTURE_MAX_BYTES, backups=CAPTURE_BACKUPS,
+                     full_body=CAPTURE_FULL_BODY)
 from typing import Optional
 jobs: Optional[JobsEngine] = None
+shared: Optional[SharedState] = None
+metrics_task: Optional[asyncio.Task] = None
 
 # API
 app.include_router(devices_router)
@@ -318,48 +1179,141 @@ def require_api_key(x_api_key: Optional[str]):
     if API_KEY_REQUIRED and x_api_key != API_KEY_VALUE:
         raise HTTPException(status_code=401, detail="Invalid API key")
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(_, e: Overloaded):
+    return JSONResponse(status_code=429, content={"detail": str(e)},
+                        headers={"Retry-After": str(e.retry_after_s)})
+
+def admit(endpoint: str, tenant: str, n: int = 1):
+    """Admission.hold() z Retry-After liczonym z głębokości kolejki i przepustowości floty."""
+    return admission.hold(endpoint, tenant, n, gateway.retry_after)
+
+class AdmittedStream(StreamingResponse):
+    """
+    StreamingResponse z miejscem zajętym w Admission przed zwróceniem odpowiedzi: release()
+    po wysłaniu albo rozłączeniu klienta – także gdy generator nie ruszył (jego finally by nie zadziałał).
+    """
+    def __init__(self, content: AsyncIterator[bytes], release: Callable[[], None], **kw: Any):
+        super().__init__(content, **kw)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with contextlib.suppress(Exception):
+                await self.body_iterator.aclose()   # finally generatora (sloty telefonu) od razu
+            self._release()
+
+async def next_phone_or_503(model: Optional[str], akey: Optional[str] = None) -> PhoneState:
+    """Brak telefonu z modelem -> 503: model może się pojawić po health-checku albo reloadzie floty."""
+    try:
+        return await gateway._next_phone(model, akey)
+    except ModelUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
 @app.on_event("startup")
 async def startup():
-    global gateway, store, jobs
-    phones_path = Path(__file__).parent / "phones.json"
-    store = DeviceStore(phones_path)
-    cfgs = load_phones_config()
-    gateway = Gateway(cfgs, store=store)
+    global gateway, store, jobs, shared, metrics_task
+    if SHARED_STATE_PATH is not None:
+        # kilka procesów bramki: sloty, limity, joby i metryki przez wspólny stan
+        if JOBS_DB_PATH is None:
+            raise RuntimeError("GW_SHARED_STATE requires JOBS_DB_PATH (jobs are shared through JobStore)")
+        shared = SqliteSharedState(SHARED_STATE_PATH, dead_s=SHARED_DEAD_S)
+        await shared.start()
+    # phones.json – konfiguracja (hot-reload), phones.state.json – stan runtime zapisywany przez bramkę
+    store = DeviceStore(DATA_DIR / "phones.json", DATA_DIR / "phones.state.json")
+    cfgs = phone_configs(store.config())
+    gateway = Gateway(cfgs, store=store, shared=shared)
     await gateway.start()
 
-    # Jobs engine – tylu workerów, ile łącznej przepustowości telefonów (min. 1)
-    total_workers = max(1, sum(c.max_concurrency for c in cfgs))
-    jobs = JobsEngine(gateway)
-    await jobs.start(total_workers)
+    # Jobs engine – dispatcher zdejmuje job dopiero, gdy jest wolny slot telefonu
+    job_store = JobStore(JOBS_DB_PATH, result_ttl_s=JOBS_RESULT_TTL_S, max_finished=JOBS_MAX_FINISHED,
+                         max_result_bytes=JOBS_MAX_RESULT_BYTES,
+                         owner=shared.owner if shared else None) if JOBS_DB_PATH else None
+    jobs = JobsEngine(gateway, store=job_store, admission=admission,
+                      weights=TENANT_WEIGHTS, aging_s=JOBS_AGING_S, traffic=traffic, shared=shared)
+    await jobs.start()
+    await traffic.start()
+    if shared:
+        metrics_task = asyncio.create_task(publish_metrics_loop())
 
     app.state.gateway = gateway
     app.state.store = store
     app.state.jobs = jobs
-    logger.info("Gateway ready with %d weighted entries. Jobs workers=%d", len(gateway.rr), total_workers)
+    app.state.admission = admission
+    logger.info("Gateway ready with %d phones (scheduler=%s). Slots=%d (max %d, adaptive=%s)%s",
+                len(gateway.phones), gateway.scheduler.name, sum(p.limit for p in gateway.phones),
+                sum(c.max_concurrency for c in cfgs), ADAPTIVE_CONCURRENCY,
+                f" shared as {shared.owner} ({SHARED_STATE_PATH})" if shared else "")
 
 
 @app.on_event("shutdown")
 async def shutdown():
     global gateway, jobs
+    if metrics_task:
+        metrics_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await metrics_task
     if jobs: await jobs.stop()
     if gateway: await gateway.stop()
+    await traffic.stop()
+    if shared: await shared.stop()   # sloty tego procesu wracają do puli, joby przejmą pozostali
+
 
+async def publish_metrics_loop():
+    """Tryb współdzielony: metryki procesu do wspólnego stanu – /metrics dowolnego procesu zwraca wszystkie."""
+    while True:
+        try:
+            await shared.publish_metrics(render_metrics())
+        except Exception as e:
+            logger.warning("[shared] metrics publish failed: %s", e)
+        await asyncio.sleep(SHARED_METRICS_S)
 
 @app.get("/metrics")
 async def metrics():
-    text = await gateway.metrics.render_prom()
+    text = render_metrics()
+    if shared:
+        # świeże własne metryki + ostatnio opublikowane pozostałych procesów, z etykietą worker
+        await shared.publish_metrics(text)
+        text = merge_prom(await shared.metrics())
     return PlainTextResponse(text, media_type="text/plain")
 
+def render_metrics() -> str:
+    gauges = [("gw_phone_inflight", "Requests holding a phone slot", {"phone": gateway._devkey(p.cfg)}, p.inflight)
+              for p in gateway.unique_phones()]
+    gauges += [("gw_phone_queued", "Requests waiting for a phone slot", {"phone": gateway._devkey(p.cfg)}, p.queued)
+               for p in gateway.unique_phones()]
+    gauges += [("gw_phone_concurrency_limit", "Current (adaptive) concurrency limit per phone",
+                {"phone": gateway._devkey(p.cfg)}, p.limit) for p in gateway.unique_phones()]
+    gauges += [("gw_phone_concurrency_max", "Configured max_concurrency (ceiling of the adaptive limit)",
+                {"phone": gateway._devkey(p.cfg)}, p.cfg.max_concurrency) for p in gateway.unique_phones()]
+    if shared:
+        gauges += [("gw_phone_remote_inflight", "Phone slots held by other gateway processes",
+                    {"phone": gateway._devkey(p.cfg)}, p.remote) for p in gateway.unique_phones()]
+    if jobs:
+        gauges += jobs.gauges()
+    text = gateway.metrics.render_prom(gauges)
+    text += gateway.pool_prom()
+    text += gateway.affinity.render_prom()
+    text += gateway.hedger.render_prom()
+    text += admission.render_prom()
+    text += gateway.health_events.render_prom({gateway._devkey(p.cfg): p.health.state for p in gateway.unique_phones()})
+    text += traffic.render_prom()
+    if gateway.cache is not None:
+        text += gateway.cache.render_prom()
+    text += gateway.embed_stats.render_prom()
+    text += render_coalesce_prom({"ask": gateway.inflight_asks.hits,
+                                  "jobs": jobs.coalesced if jobs else 0})
+    return text
+
 @app.get("/ping")
 async def ping():
-    unique = {id(x): x for x in gateway.rr}.values()
     out = []
-    for p in unique:
-        url = f"http://{p.cfg.host}:{p.cfg.port}/api/tags"
+    for p in gateway.unique_phones():
         t0 = time.perf_counter()
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                r = await client.get(url)
+            r = await p.pool.client.get("/api/tags", timeout=p.pool.timeout(HEALTH_TIMEOUT_S))
             out.append({
                 "host": p.cfg.host, "port": p.cfg.port,
                 "ok": r.status_code == 200, "status": r.status_code,
@@ -374,30 +1328,42 @@ async def ping():
     return {"results": out}
 
 @app.post("/ask_trace")
-async def ask_trace(req: AskRequest, x_api_key: Optional[str] = Header(default=None)):
+async def ask_trace(req: AskRequest, x_api_key: Optional[str] = Header(default=None),
+                    x_tenant: Optional[str] = Header(default=None)):
     require_api_key(x_api_key)
+    tenant = admission.tenant(x_api_key, x_tenant)
+    admission.enter("ask", tenant, 1, gateway.retry_after)
     async def _gen():
-        unique = list({id(x): x for x in gateway.rr}.values())
+        unique = gateway.unique_phones()
         yield f"# phones={len(unique)}\n".encode()
-        phone = await gateway._next_phone()
+        try:
+            phone = await gateway._next_phone(req.model, gateway.affinity_key(req))
+        except ModelUnavailable as e:
+            yield f"# error: {e}\n".encode(); return
         fallback_model = phone.cfg.model
         payload = gateway._build_payload(req, fallback_model)
         yield f"# selected {phone.cfg.host}:{phone.cfg.port} model={payload.get('model')}\n".encode()
         yield b"# posting to phone (streaming)...\n"
-        async for chunk in gateway._stream_chat(phone, payload):
+        dl = gateway.deadlines_for(req, payload.get("model"))
+        async for chunk in gateway._stream_chat(phone, payload, deadlines=dl):
             if chunk:
                 yield chunk
         yield b"\n# done\n"
-    return StreamingResponse(_gen(), media_type="text/plain")
+    return AdmittedStream(_gen(), lambda: admission.leave("ask", tenant, 1), media_type="text/plain")
 
 @app.get("/health", response_model=HealthResponse)
 async def health():
     return gateway.health_snapshot()
 
+@app.get("/health/events")
+async def health_events(since: int = 0):
+    """Ostatnie przejścia automatu zdrowia telefonów (seq > since)."""
+    return {"events": gateway.health_events.since(since)}
+
 @app.post("/warmup")
 async def warmup(x_api_key: Optional[str] = Header(default=None)):
     require_api_key(x_api_key)
-    unique = {id(x): x for x in gateway.rr}.values()
+    unique = gateway.unique_phones()
     async def _warm(p: PhoneState):
         req = AskRequest(prompt=".", options={"num_predict":16})
         payload = gateway._build_payload(req, p.cfg.model)
@@ -408,64 +1374,173 @@ async def warmup(x_api_key: Optional[str] = Header(default=None)):
     return {"warmed": sum(1 for r in results if r), "total": len(list(unique))}
 
 @app.post("/ask")
-async def ask(req: AskRequest, x_api_key: Optional[str] = Header(default=None)):
+async def ask(req: AskRequest, x_api_key: Optional[str] = Header(default=None),
+              x_tenant: Optional[str] = Header(default=None)):
     require_api_key(x_api_key)
-    if ENABLE_LRU_CACHE:
-        tmp_phone = await gateway._next_phone()
-        key = cache_key(req, tmp_phone.cfg.model)
-        cached = await gateway.cache.get(key)
-        if cached: return cached
-        fallback_phone = tmp_phone
-    else:
-        fallback_phone = None
-
-    unique = {id(x): x for x in gateway.rr}.values()
+    tenant = admission.tenant(x_api_key, x_tenant)
+    with traffic.request("ask", req.model_dump(exclude_none=True), tenant):
+        key = cache_key(req, gateway.resolve_model(req.model))
+        use_cache = gateway.cache is not None and should_cache(req.options, req.cache)
+        if use_cache:
+            cached = await gateway.cache.get(key)
+            if cached is not None:
+                capture.mark(status="cached")
+                return cached
+
+        store_key = key if use_cache else None
+        with admit("ask", tenant):
+            if ENABLE_COALESCING:
+                return await gateway.inflight_asks.do(key, lambda: _ask_uncached(req, store_key))
+            return await _ask_uncached(req, store_key)
+
+async def _ask_uncached(req: AskRequest, store_key: Optional[str]) -> Dict[str, Any]:
+    """store_key != None -> wynik trafia do cache."""
+    try:
+        attempts = len(gateway.eligible_phones(req.model))
+    except ModelUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    akey = gateway.affinity_key(req)
     last_error: Optional[Exception] = None
-    for _ in range(len(list(unique))):
-        phone = await gateway._next_phone()
+    for _ in range(attempts):
+        phone = await next_phone_or_503(req.model, akey)
         payload = gateway._build_payload(req, phone.cfg.model)
         logger.info(f"[ask] trying phone={phone.cfg.host}:{phone.cfg.port} "
                     f"model={payload.get('model')} healthy={phone.healthy} inflight={phone.inflight}")
         try:
-            result = await gateway._post_chat(phone, payload)
+            if gateway.hedge_enabled(req):
+                phone, result = await gateway.post_chat_hedged(phone, req)
+                capture.mark(phone=gateway._devkey(phone.cfg))
+            else:
+                result = await gateway._post_chat(phone, payload, deadlines=gateway.deadlines_for(req, payload.get("model")))
             logger.info(f"[ask] success phone={phone.cfg.host}:{phone.cfg.port}")
-            if ENABLE_LRU_CACHE and fallback_phone:
-                k2 = cache_key(req, fallback_phone.cfg.model)
-                await gateway.cache.set(k2, result)
+            gateway.note_prompt_eval(phone, req, akey, result)
+            if store_key is not None:
+                gateway.cache.set(store_key, result, req.cache_ttl_s)
             return result
         except Exception as e:
             logger.warning(f"[ask] failed phone={phone.cfg.host}:{phone.cfg.port}: {e}")
             last_error = e
+            if isinstance(e.__cause__, PhaseTimeout) and e.__cause__.phase == "total":
+                break   # limit całego żądania wyczerpany – bez kolejnych telefonów
             continue
 
     states = [{"host": p.cfg.host, "port": p.cfg.port, "healthy": p.healthy, "reason": p.reason,
-               "inflight": p.inflight, "open_until": p.open_until}
-              for p in {id(x): x for x in gateway.rr}.values()]
+               "inflight": p.inflight, "open_until": p.open_until, "circuit": p.health.state}
+              for p in gateway.unique_phones()]
     raise HTTPException(
         status_code=503,
         detail=f"No phones responded. last_error={last_error!s}; states={states}"
     )
 
 @app.post("/ask_stream")
-async def ask_stream(req: AskRequest, x_api_key: Optional[str] = Header(default=None)):
+async def ask_stream(req: AskRequest, x_api_key: Optional[str] = Header(default=None),
+                     x_tenant: Optional[str] = Header(default=None)):
     require_api_key(x_api_key)
-    phone = await gateway._next_phone()
-    payload = gateway._build_payload(req, phone.cfg.model)
+    tenant = admission.tenant(x_api_key, x_tenant)
+    rec = traffic.begin("ask_stream", req.model_dump(exclude_none=True), tenant)
+    try:
+        phone = await next_phone_or_503(req.model, gateway.affinity_key(req))
+        payload = gateway._build_payload(req, phone.cfg.model)
+        dl = gateway.deadlines_for(req, payload.get("model"))
+        admission.enter("ask", tenant, 1, gateway.retry_after)   # zwalniane po końcu strumienia
+    except Exception as e:
+        traffic.finish(rec, capture.status_of(e))
+        raise
     async def _gen():
-        async for chunk in gateway._stream_chat(phone, payload):
-            if chunk: yield chunk
-    return StreamingResponse(_gen(), media_type="application/octet-stream")
+        with traffic.active(rec):
+            async for chunk in gateway._stream_chat(phone, payload, deadlines=dl):
+                if chunk: yield chunk
+    def _release():
+        admission.leave("ask", tenant, 1)
+        traffic.finish(rec)
+    return AdmittedStream(_gen(), _release, media_type="application/octet-stream")
+
+@app.post("/embed")
+async def embed(req: EmbedRequest, x_api_key: Optional[str] = Header(default=None),
+                x_tenant: Optional[str] = Header(default=None), accept: Optional[str] = Header(default=None)):
+    """
+    Embeddingi listy tekstów, w kawałkach rozdzielonych po flocie (Gateway.embed), w kolejności wejścia.
+    format=f32 (albo Accept: application/octet-stream): surowe float32 zamiast list liczb w JSON-ie.
+    Limit admission liczy teksty.
+    """
+    require_api_key(x_api_key)
+    tenant = admission.tenant(x_api_key, x_tenant)
+    with admit("embed", tenant, len(req.input)):
+        try:
+            result = await gateway.embed(req.input, req.model)
+        except ModelUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except EmbedFailed as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    if req.format == "f32" or F32_MEDIA_TYPE in (accept or ""):
+        try:
+            body, headers = f32_body(result)
+        except ValueError as e:   # telefony z różnymi wersjami modelu pod tą samą nazwą
+            raise HTTPException(status_code=502, detail=str(e))
+        return Response(body, media_type=F32_MEDIA_TYPE, headers=headers)
+    return result
+
+async def as_completed_bounded(items: List[Any], width: int,
+                               fn: Callable[[Any], Any]) -> AsyncIterator[Tuple[int, Any]]:
+    """(indeks, wynik fn(item)) w kolejności ukończenia; najwyżej width zadań naraz."""
+    pending: Dict[asyncio.Task, int] = {}
+    it = iter(enumerate(items))
+    try:
+        while True:
+            for i, item in it:
+                pending[asyncio.create_task(fn(item))] = i
+                if len(pending) >= width:
+                    break
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                yield pending.pop(t), t.result()
+    finally:
+        for t in pending:   # klient się rozłączył – reszta nie jest już potrzebna
+            t.cancel()
 
 @app.post("/ask_batch")
-async def ask_batch(req: AskBatchRequest, x_api_key: Optional[str] = Header(default=None)):
+async def ask_batch(req: AskBatchRequest, x_api_key: Optional[str] = Header(default=None),
+                    x_tenant: Optional[str] = Header(default=None)):
+    """
+    Fan-out ograniczony do min(max_inflight, BATCH_MAX_INFLIGHT, sloty floty).
+    stream=true: każdy wynik od razu jako linia NDJSON z indeksem wejścia; błąd
+    elementu nie przerywa batcha. Limit admission liczy wtedy elementy w locie,
+    a nie rozmiar batcha.
+    """
     require_api_key(x_api_key)
+    tenant = admission.tenant(x_api_key, x_tenant)
+    t_arrival, batch_id = time.time(), uuid.uuid4().hex[:12]
     async def _do(single: AskRequest):
-        try:
-            phone = await gateway._next_phone()
-            payload = gateway._build_payload(single, phone.cfg.model)
-            result = await gateway._post_chat(phone, payload)
-            return True, result
-        except Exception as e:
-            return False, str(e)
-    results = await asyncio.gather(*(_do(r) for r in req.requests))
+        # rekord na element (task z as_completed_bounded ma własny kontekst); przybycie = batcha
+        with traffic.request("ask_batch", single.model_dump(exclude_none=True), tenant, t=t_arrival,
+                             batch=batch_id, batch_size=len(req.requests)):
+            try:
+                akey = gateway.affinity_key(single)
+                phone = await gateway._next_phone(single.model, akey)
+                payload = gateway._build_payload(single, phone.cfg.model)
+                result = await gateway._post_chat(phone, payload, deadlines=gateway.deadlines_for(single, payload.get("model")))
+                gateway.note_prompt_eval(phone, single, akey, result)
+                return True, result
+            except Exception as e:
+                capture.mark(status=capture.status_of(e))
+                return False, str(e)
+    width = max(1, min(req.max_inflight or BATCH_MAX_INFLIGHT, BATCH_MAX_INFLIGHT,
+                       gateway.fleet_slots(), len(req.requests)))
+    if req.stream:
+        admission.enter("ask_batch", tenant, width, gateway.retry_after)
+        async def _gen():
+            async for i, (ok, data) in as_completed_bounded(req.requests, width, _do):
+                yield (json.dumps({"index": i, "ok": ok, "data": data}) + "\n").encode()
+        return AdmittedStream(_gen(), lambda: admission.leave("ask_batch", tenant, width),
+                              media_type="application/x-ndjson")
+
+    lim = admission.limit("ask_batch")
+    if lim is not None and len(req.requests) > lim:
+        raise HTTPException(status_code=413, detail=f"batch of {len(req.requests)} exceeds limit {lim}; use stream=true")
+    results: List[Any] = [None] * len(req.requests)
+    with admit("ask_batch", tenant, len(req.requests)):
+        async for i, res in as_completed_bounded(req.requests, width, _do):
+            results[i] = res
     return {"results": [{"ok": ok, "data": data} for ok, data in results]}
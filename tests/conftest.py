@@ -0,0 +1,36 @@
+import os, tempfile
+
+# server.py przy imporcie ustala DATA_DIR (cache.db, jobs.db) – testy nie piszą do repo
+os.environ.setdefault("GW_DATA_DIR", tempfile.mkdtemp(prefix="gw-test-"))
+
+import pytest
+
+from tests.fakes import MockPool
+
+@pytest.fixture
+def make_gateway(monkeypatch):
+    """Gateway z n zdrowymi telefonami (model m:latest) bez sieci; handlery przez MockPool."""
+    import server
+    monkeypatch.setattr(server, "ENABLE_RESPONSE_CACHE", False)
+
+    def make(n: int = 2, max_concurrency: int = 2, handler=None):
+        gw = server.Gateway([server.PhoneConfig(host="127.0.0.1", port=11434 + i, model="m:latest",
+                                                max_concurrency=max_concurrency, serial=f"p{i}") for i in range(n)])
+        for p in gw.phones:
+            p.healthy, p.reason, p.models = True, None, ["m:latest"]
+            if handler is not None:
+                p.pool = MockPool(lambda request, p=p: handler(p, request))
+        gw._rebuild_model_index()
+        return gw
+    return make
+
+@pytest.fixture
+def api(monkeypatch):
+    """api(gw) -> klient HTTP aplikacji (bez lifespan) na danym Gateway, ze świeżym Admission."""
+    import httpx, server
+    monkeypatch.setattr(server, "admission", server.Admission(server.ADMISSION_LIMITS))
+
+    def client(gw):
+        monkeypatch.setattr(server, "gateway", gw)
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://gw")
+    return client
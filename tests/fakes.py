@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+import httpx
+
+def chat_body(text: str = "hello world", eval_count: int = 16) -> bytes:
+    """Odpowiedź /api/chat (stream) jak z Ollamy: linia na słowo + końcowa z done."""
+    lines = [{"message": {"role": "assistant", "content": w + " "}, "done": False} for w in text.split()]
+    lines.append({"message": {"role": "assistant", "content": ""}, "done": True, "model": "m:latest",
+                  "eval_count": eval_count, "eval_duration": 1_000_000_000, "prompt_eval_count": 4})
+    return b"".join(json.dumps(o).encode() + b"\n" for o in lines)
+
+class MockPool:
+    """Zamiast PhoneClient: httpx z MockTransport (handler(request) -> httpx.Response, też async)."""
+    def __init__(self, handler):
+        self.client = httpx.AsyncClient(base_url="http://phone", transport=httpx.MockTransport(handler))
+
+    def timeout(self, read, connect=None):
+        return httpx.Timeout(read, connect=connect)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+def prompt_of(request: httpx.Request) -> str:
+    """Treść ostatniej wiadomości user z żądania /api/chat."""
+    return [m for m in json.loads(request.content)["messages"] if m["role"] == "user"][-1]["content"]
+
+async def wait_finished(engine, job_ids, timeout_s: float = 5.0):
+    """Czeka, aż joby się zakończą; zwraca ich statusy (Job) w kolejności job_ids."""
+    loop = asyncio.get_event_loop()
+    end = loop.time() + timeout_s
+    while True:
+        jobs = [await engine.get_status(j) for j in job_ids]
+        if all(j.status in ("done", "error", "cancelled") for j in jobs) or loop.time() > end:
+            return jobs
+        await asyncio.sleep(0.01)
@@ -0,0 +1,95 @@
+import pytest
+
+from core.admission import DEFAULT_TENANT, Admission, Overloaded, retry_after_s, tenant_of
+
+def test_retry_after_from_depth_and_throughput():
+    assert retry_after_s(9, 2.0) == 5
+    assert retry_after_s(0, 100.0) == 1
+    assert retry_after_s(10_000, 1.0, hi=300) == 300
+    assert retry_after_s(3, 0.0, hi=60) == 60
+
+def test_tenant_resolution():
+    names = {"k1": "team-a"}
+    assert tenant_of("k1", "x", names) == "team-a"
+    assert tenant_of("k2", "hdr", names) == "hdr"
+    assert tenant_of("k2", None, names).startswith("key:") and "k2" not in tenant_of("k2", None, names)
+    assert tenant_of(None, None, names) == DEFAULT_TENANT
+
+def test_endpoint_limit_and_release():
+    a = Admission({"ask": 2})
+    with a.hold("ask", None, 2, lambda depth: 7):
+        with pytest.raises(Overloaded) as e:
+            a.enter("ask", None, 1, lambda depth: 7)
+        assert e.value.scope == "endpoint" and e.value.retry_after_s == 7
+    assert a.inflight["ask"] == 0
+    a.enter("ask", None, 2, lambda depth: 1)
+    assert a.rejected == {("ask", "endpoint"): 1}
+
+def test_key_limit_retry_after_counts_only_that_tenant():
+    a = Admission({"ask": 100}, key_limits={"*": {"ask": 2}})
+    a.enter("ask", "a", 2, lambda d: 0)
+    a.enter("ask", "b", 1, lambda d: 0)
+    a.enter("ask", "b", 1, lambda d: 0)
+    seen = []
+    with pytest.raises(Overloaded) as e:
+        a.enter("ask", "a", 1, lambda depth: seen.append(depth) or depth)
+    assert e.value.scope == "key" and e.value.limit == 2
+    assert seen == [2]    # zajęte przez najemcę, nie 4 na całym endpoincie
+    assert a.inflight["ask"] == 4
+    a.leave("ask", "a", 2)
+    a.enter("ask", "a", 1, lambda d: 0)
+
+def test_job_queue_sheds_least_urgent_with_counted_depth(make_gateway):
+    import asyncio
+    from core.jobs import JobsEngine
+
+    async def main():
+        adm = Admission({"jobs": 3}, key_limits={"*": {"jobs": 2}})
+        engine = JobsEngine(make_gateway(n=1), admission=adm)   # bez dispatchera – joby czekają
+        a5 = await engine.enqueue({"prompt": "a5"}, priority=5, tenant="a")
+        a7 = await engine.enqueue({"prompt": "a7"}, priority=7, tenant="a")
+        a3 = await engine.enqueue({"prompt": "a3"}, priority=3, tenant="a")   # limit klucza: zrzut a7
+        assert engine.jobs[a7].status == "error" and "key limit" in engine.jobs[a7].error
+        b5 = await engine.enqueue({"prompt": "b5"}, priority=5, tenant="b")
+        with pytest.raises(Overloaded) as e:
+            await engine.enqueue({"prompt": "b9"}, priority=9, tenant="b")
+        assert e.value.scope == "endpoint"
+        await engine.enqueue({"prompt": "b1"}, priority=1, tenant="b")        # zrzut najnowszego z priority 5
+        assert engine.jobs[b5].status == "error" and engine.jobs[a5].status == "queued"
+        await engine.enqueue({"prompt": "a3"}, priority=1, tenant="a")        # duplikat – bez miejsca w kolejce
+        assert engine.queue_depth() == 3 and engine._waiting == {"a": 2, "b": 1}
+        await engine.cancel(a3)                                               # duplikat przejmuje kolejkę
+        assert engine.queue_depth() == 3
+        await engine.cancel(a5)
+        depth = {labels["tenant"]: v for name, _, labels, v in engine.gauges() if name == "gw_jobs_tenant_queue_depth"}
+        assert engine.queue_depth() == 2 and depth == {"a": 1, "b": 1}
+        assert adm.shed == 2
+    asyncio.run(main())
+
+@pytest.mark.parametrize("path,body,endpoint", [
+    ("/ask_stream", {"prompt": "hi"}, "ask"),
+    ("/ask_trace", {"prompt": "hi"}, "ask"),
+    ("/ask_batch", {"requests": [{"prompt": "a"}, {"prompt": "b"}], "stream": True}, "ask_batch"),
+])
+def test_stream_released_when_client_leaves_before_body(make_gateway, api, path, body, endpoint):
+    import asyncio, json, server
+
+    async def main():
+        api(make_gateway(n=1))
+        scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+                 "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+                 "query_string": b"", "headers": [(b"content-type", b"application/json")],
+                 "client": ("127.0.0.1", 1), "server": ("gw", 80)}
+        msgs = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+
+        async def receive():
+            return msgs.pop(0) if msgs else {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                raise OSError("client gone")   # rozłączenie przed pierwszym bajtem ciała
+
+        with pytest.raises(Exception):
+            await server.app(scope, receive, send)
+        assert server.admission.inflight[endpoint] == 0
+    asyncio.run(main())
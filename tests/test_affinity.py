@@ -0,0 +1,48 @@
+from core.affinity import HashRing, affinity_key
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+
+def ring_of(n, vnodes=64):
+    ring, nodes = HashRing(vnodes), [Node(f"p{i}") for i in range(n)]
+    for node in nodes:
+        ring.add(node, node.name)
+    return ring, nodes
+
+def test_walk_visits_every_node_once_and_is_stable():
+    ring, nodes = ring_of(5)
+    order = list(ring.walk("s:abc"))
+    assert sorted(n.name for n in order) == sorted(n.name for n in nodes)
+    assert list(ring.walk("s:abc")) == order
+    assert list(HashRing().walk("x")) == []
+
+def test_removing_a_node_moves_only_its_keys():
+    ring, nodes = ring_of(8)
+    keys = [f"s:{i}" for i in range(2000)]
+    before = {k: list(ring.walk(k))[:2] for k in keys}
+    ring.remove(nodes[3])
+    after = {k: next(ring.walk(k)) for k in keys}
+    moved = [k for k in keys if before[k][0] is not after[k]]
+    assert all(before[k][0] is nodes[3] for k in moved)
+    # klucze usuniętego idą do kolejnego telefonu z ich ścieżki (failover powinowactwa)
+    assert all(after[k] is before[k][1] for k in moved)
+    assert 0 < len(moved) < len(keys) / 4
+
+def test_adding_a_node_takes_roughly_its_share():
+    ring, nodes = ring_of(4)
+    keys = [f"p:{i}" for i in range(4000)]
+    before = {k: next(ring.walk(k)) for k in keys}
+    new = Node("p9")
+    ring.add(new, new.name)
+    moved = [k for k in keys if next(ring.walk(k)) is not before[k]]
+    assert all(next(ring.walk(k)) is new for k in moved)
+    assert len(keys) / 10 < len(moved) < len(keys) / 3   # ~1/5
+
+def test_affinity_key_sources():
+    assert affinity_key("sess", "sys", "p") == "s:sess"
+    assert affinity_key(None, "sys", "p").startswith("p:")
+    assert affinity_key(None, "sys", "a") == affinity_key(None, "sys", "b")
+    assert affinity_key(None, None, "short") is None
+    long_a, long_b = "x" * 2000 + "a", "x" * 2000 + "b"
+    assert affinity_key(None, None, long_a) == affinity_key(None, None, long_b)   # wspólny prefiks
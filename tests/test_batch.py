@@ -0,0 +1,73 @@
+import asyncio, json
+
+import httpx
+
+from tests.fakes import chat_body, prompt_of
+
+def test_bounded_fan_out_yields_in_completion_order():
+    import server
+    running, peak = 0, 0
+
+    async def fn(delay):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(delay)
+        running -= 1
+        return delay
+
+    async def main():
+        out = [(i, r) async for i, r in server.as_completed_bounded([0.2, 0.02, 0.06, 0.0], 2, fn)]
+        assert [i for i, _ in out] == [1, 2, 3, 0]   # kolejny element startuje, gdy zwolni się miejsce
+        assert out[0] == (1, 0.02) and peak == 2
+    asyncio.run(main())
+
+def test_closing_early_cancels_the_rest():
+    import server
+    started, cancelled = [], []
+
+    async def fn(i):
+        started.append(i)
+        try:
+            await asyncio.sleep(0 if i == 0 else 10)
+        except asyncio.CancelledError:
+            cancelled.append(i)
+            raise
+        return i
+
+    async def main():
+        gen = server.as_completed_bounded(list(range(10)), 3, fn)
+        assert await gen.__anext__() == (0, 0)
+        await gen.aclose()                    # klient się rozłączył
+        await asyncio.sleep(0)
+        assert sorted(cancelled) == [1, 2] and started == [0, 1, 2]   # dobrany 4. anulowany przed startem
+        assert all(t.done() for t in asyncio.all_tasks() if t is not asyncio.current_task())
+    asyncio.run(main())
+
+def test_ask_batch_stream_reports_item_errors_without_stopping(make_gateway, api):
+    running, peak = 0, 0
+
+    async def handler(phone, request):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05 if prompt_of(request) == "slow" else 0.01)
+        running -= 1
+        return httpx.Response(200, content=chat_body(prompt_of(request)))
+
+    gw = make_gateway(n=2, max_concurrency=4, handler=handler)
+    items = [{"prompt": "slow"}, {"prompt": "x", "model": "nope"}] + [{"prompt": f"p{i}"} for i in range(6)]
+
+    async def main():
+        async with api(gw) as c:
+            r = await c.post("/ask_batch", json={"requests": items, "stream": True, "max_inflight": 3})
+            assert r.status_code == 200 and r.headers["content-type"] == "application/x-ndjson"
+            return [json.loads(line) for line in r.text.splitlines()]
+    lines = asyncio.run(main())
+    assert sorted(o["index"] for o in lines) == list(range(len(items)))
+    assert lines[-1]["index"] == 0                       # najwolniejszy na końcu, nie w kolejności wejścia
+    bad = next(o for o in lines if o["index"] == 1)
+    assert bad["ok"] is False and "nope" in bad["data"]
+    assert all(o["ok"] for o in lines if o["index"] != 1)
+    assert next(o for o in lines if o["index"] == 2)["data"]["message"]["content"].strip() == "p0"
+    assert peak <= 3
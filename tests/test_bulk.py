@@ -0,0 +1,69 @@
+import asyncio, json
+
+import httpx
+import pytest
+
+from core.admission import Admission
+from core.jobs import JobsEngine
+from tests.fakes import chat_body, prompt_of, wait_finished
+
+@pytest.fixture
+def bulk_api(make_gateway, api, monkeypatch):
+    """bulk_api(admission) -> (klient HTTP, JobsEngine bez dispatchera) jako app.state.jobs."""
+    import server
+
+    def make(admission=None):
+        gw = make_gateway(n=1, handler=lambda phone, request: httpx.Response(200, content=chat_body(prompt_of(request))))
+        engine = JobsEngine(gw, admission=admission)
+        monkeypatch.setattr(server.app.state, "jobs", engine, raising=False)
+        monkeypatch.setattr(server.app.state, "admission", admission, raising=False)
+        return api(gw), engine
+    return make
+
+def _jsonl(*objs) -> bytes:
+    return b"".join((o if isinstance(o, str) else json.dumps(o)).encode() + b"\n" for o in objs)
+
+def test_bulk_ingest_status_and_results(bulk_api):
+    async def main():
+        client, engine = bulk_api()
+        async with client as c:
+            body = _jsonl({"prompt": "a"}, "", "{not json", {"prompt": "b", "custom_id": "mine"}, [1], {"prompt": "c"})
+            r = await c.post("/jobs/bulk?priority=2", content=body)
+            assert r.status_code == 200
+            out = r.json()
+            assert (out["accepted"], out["rejected"]) == (3, 2)
+            assert [e["line"] for e in out["errors"]] == [2, 4]
+            group = out["group_id"]
+            assert {j.priority for j in engine.jobs.values()} == {2}
+            await engine.start()
+            await wait_finished(engine, list(engine.jobs))
+            r = await c.get(f"/jobs/groups/{group}")
+            assert r.json() == {"group_id": group, "queued": 0, "running": 0, "done": 3, "error": 0, "total": 3}
+            r = await c.get(f"/jobs/groups/{group}/results")
+            assert r.headers["content-type"] == "application/x-ndjson"
+            rows = [json.loads(line) for line in r.text.splitlines()]
+            assert sorted(row["custom_id"] for row in rows) == ["0", "5", "mine"]
+            by_id = {row["custom_id"]: row for row in rows}
+            assert by_id["5"]["status"] == "done" and by_id["5"]["result"]["message"]["content"].strip() == "c"
+            assert (await c.get("/jobs/groups/nope")).status_code == 404
+        await engine.stop()
+    asyncio.run(main())
+
+def test_bulk_429_then_resume_keeps_line_numbers(bulk_api):
+    async def main():
+        client, engine = bulk_api(Admission({"jobs": 2}))
+        lines = [{"prompt": f"p{i}"} for i in range(4)]
+        async with client as c:
+            r = await c.post("/jobs/bulk", content=_jsonl(*lines))
+            assert r.status_code == 429 and int(r.headers["Retry-After"]) >= 1
+            out = r.json()
+            assert out["accepted"] == 2 and out["resume_from_line"] == 2
+            group, start = out["group_id"], out["resume_from_line"]
+            engine.admission = Admission({"jobs": 10})   # kolejka się zwolniła
+            r = await c.post(f"/jobs/bulk?group={group}&start_line={start}", content=_jsonl(*lines[start:]))
+            assert r.status_code == 200 and r.json()["group_id"] == group and r.json()["accepted"] == 2
+            assert sorted((j.req["custom_id"], j.req["prompt"]) for j in engine.jobs.values()) == [
+                ("0", "p0"), ("1", "p1"), ("2", "p2"), ("3", "p3")]
+            assert (await c.get(f"/jobs/groups/{group}")).json()["queued"] == 4
+            assert (await c.post("/jobs/bulk?start_line=-1", content=b"")).status_code == 422
+    asyncio.run(main())
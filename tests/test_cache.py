@@ -0,0 +1,69 @@
+import asyncio, time
+
+import pytest
+
+from core.cache import ResponseCache, is_deterministic, should_cache
+
+@pytest.mark.parametrize("options, expected", [
+    ({}, False),
+    ({"temperature": 0}, True),
+    ({"temperature": "0.0"}, True),
+    ({"temperature": 0.7}, False),
+    ({"temperature": 0.7, "seed": 1}, True),
+    ({"temperature": "hot"}, False),
+    ({"temperature": [0]}, False),
+])
+def test_is_deterministic(options, expected):
+    assert is_deterministic(options) is expected
+
+def test_should_cache_override():
+    assert should_cache({}, True) and not should_cache({"temperature": 0}, False)
+
+def test_memory_ttl_and_lru_budget():
+    async def main():
+        c = ResponseCache(max_bytes=40, ttl_s=60)
+        c.set("a", {"v": "a" * 5})          # 15 B
+        c.set("b", {"v": "b" * 5}, ttl_s=-1)  # już wygasły
+        assert await c.get("a") == {"v": "aaaaa"}
+        assert await c.get("b") is None and c.stats["expired"] == 1
+        c.set("c", {"v": "c" * 5}); c.set("d", {"v": "d" * 5})   # 45 B > 40 -> wypada najdawniej użyty
+        assert await c.get("a") is None and c.stats["evictions_memory"] == 1
+        assert await c.get("d") == {"v": "ddddd"}
+    asyncio.run(main())
+
+def test_disk_tier_written_off_loop_and_survives_restart(tmp_path):
+    async def main():
+        c = ResponseCache(max_bytes=1024, ttl_s=60, disk_path=tmp_path / "cache.db", flush_s=0.01)
+        writer = asyncio.create_task(c.run())
+        c.set("k", {"v": 1})
+        c.set("old", {"v": 2}, ttl_s=0.05)
+        for _ in range(100):
+            if not c._pending:
+                break
+            await asyncio.sleep(0.01)
+        assert not c._pending and c._disk_bytes > 0
+        writer.cancel()
+        c.close()
+
+        c = ResponseCache(max_bytes=1024, ttl_s=60, disk_path=tmp_path / "cache.db")
+        assert await c.get("k") == {"v": 1} and c.stats["hits_disk"] == 1
+        assert await c.get("k") == {"v": 1} and c.stats["hits_memory"] == 1   # promowany do pamięci
+        await asyncio.sleep(0.06)
+        assert await c.get("old") is None and c.stats["expired"] == 1
+        c.close()
+    asyncio.run(main())
+
+def test_close_writes_pending_and_disk_budget_evicts_oldest(tmp_path):
+    async def main():
+        c = ResponseCache(max_bytes=0, disk_path=tmp_path / "cache.db", disk_max_bytes=30)
+        c.set("a", {"v": "a" * 5})
+        assert await c.get("a") == {"v": "aaaaa"}   # jeszcze niezapisany – z kolejki zapisu
+        c.close()
+        c = ResponseCache(max_bytes=0, disk_path=tmp_path / "cache.db", disk_max_bytes=30)
+        time.sleep(0.01)
+        c.set("b", {"v": "b" * 5}); c.set("c", {"v": "c" * 5})
+        c.close()   # 45 B > 30 -> wypada a (najstarszy atime)
+        c = ResponseCache(max_bytes=0, disk_path=tmp_path / "cache.db", disk_max_bytes=30)
+        assert await c.get("a") is None and await c.get("c") == {"v": "ccccc"}
+        c.close()
+    asyncio.run(main())
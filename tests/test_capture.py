@@ -0,0 +1,74 @@
+import asyncio, json
+
+import httpx
+
+from bench.replay import load_records, schedule
+from core.capture import TrafficLog, body_sha, log_files
+from tests.fakes import chat_body
+
+def _read(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+def test_ask_record_fields_hash_or_full_body(make_gateway, api, monkeypatch, tmp_path):
+    import server
+    traffic = TrafficLog(tmp_path / "traffic.jsonl")
+    monkeypatch.setattr(server, "traffic", traffic)
+    gw = make_gateway(n=1, handler=lambda phone, request: httpx.Response(200, content=chat_body(eval_count=9)))
+    body = {"prompt": "hello", "options": {"temperature": 0}, "cache": False}
+
+    async def main():
+        async with api(gw) as c:
+            assert (await c.post("/ask", json=body, headers={"X-Tenant": "team-a"})).status_code == 200
+            traffic.full_body = True
+            assert (await c.post("/ask", json=body)).status_code == 200
+        await traffic.flush()
+    asyncio.run(main())
+    short, full = _read(traffic.path)
+    assert short["ep"] == "ask" and short["tenant"] == "team-a" and short["status"] == "ok"
+    assert short["sha"] == body_sha(server.AskRequest(**body).model_dump(exclude_none=True))
+    assert "body" not in short and short["prompt_chars"] == 5 and short["options"] == {"temperature": 0}
+    assert short["phone"] == "p0" and short["attempts"] == 1 and short["wait_s"] >= 0
+    assert (short["prompt_tokens"], short["eval_tokens"]) == (4, 9)
+    assert short["latency_s"] >= 0 and "ttft_s" in short
+    assert full["body"]["prompt"] == "hello" and full["sha"] == short["sha"]
+    assert traffic.written == 2 and traffic.dropped == 0
+
+def test_rotation_keeps_backups_and_replay_reads_them_in_order(tmp_path):
+    path = tmp_path / "traffic.jsonl"
+    traffic = TrafficLog(path, max_bytes=300, backups=2)
+
+    async def main():
+        for i in range(20):
+            traffic.finish(traffic.begin("ask", {"prompt": "x" * 40}, "t", t=1000.0 + i, i=i))
+            await traffic.flush()
+    asyncio.run(main())
+    files = log_files(path)
+    assert [f.name for f in files][:2] == ["traffic.jsonl.2", "traffic.jsonl.1"]
+    assert not path.with_name("traffic.jsonl.3").exists()
+    kept = [r["i"] for f in files for r in _read(f)]
+    assert kept == sorted(kept) and kept[-1] == 19 and len(kept) < 20   # najstarsze odpadły z rotacji
+    assert [r["i"] for r in load_records(str(path))] == kept
+    assert [r["i"] for r in load_records(str(path), since=1000.0 + kept[1], limit=2)] == kept[1:3]
+
+def test_writer_behind_drops_instead_of_blocking(tmp_path):
+    traffic = TrafficLog(tmp_path / "traffic.jsonl", max_pending=2)
+    for _ in range(3):
+        traffic.finish(traffic.begin("ask", {"prompt": "x"}, None))
+    assert traffic.dropped == 1 and len(traffic._pending) == 2
+    assert TrafficLog(None).begin("ask", {"prompt": "x"}, None) is None   # zapis wyłączony
+
+def test_schedule_regroups_batch_items():
+    recs = [
+        {"ep": "ask", "t": 1.0},
+        {"ep": "ask_batch", "t": 2.0, "batch": "x", "tenant": "a", "i": 0},
+        {"ep": "ask_batch", "t": 2.0, "batch": "y", "tenant": "b", "i": 0},
+        {"ep": "ask", "t": 2.5},
+        {"ep": "ask_batch", "t": 2.0, "batch": "x", "tenant": "a", "i": 1},
+        {"ep": "ask_batch", "t": 3.0},                     # bez id batcha – osobno
+    ]
+    out = schedule(recs)
+    assert [o["ep"] for o in out] == ["ask", "ask_batch", "ask_batch", "ask", "ask_batch"]
+    x, y = out[1], out[2]
+    assert (x["t"], x["tenant"], [r["i"] for r in x["items"]]) == (2.0, "a", [0, 1])
+    assert len(y["items"]) == 1 and y["tenant"] == "b"
+    assert out[4] is recs[5]
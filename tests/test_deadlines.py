@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+
+from core.deadlines import Deadlines, PhaseTimeout, check_overrides, phase_budget, resolve_deadlines, within
+from tests.fakes import chat_body
+
+def test_resolve_layers_default_model_request():
+    base = Deadlines(ttft_s=10.0, total_s=100.0)
+    dl = resolve_deadlines(base, {"m:latest": {"ttft_s": 60}}, "m:latest", {"total_s": None})
+    assert dl.ttft_s == 60.0 and dl.total_s is None and dl.connect_s == base.connect_s
+    assert resolve_deadlines(base, {"m:latest": {"ttft_s": 60}}, "other", None) is base
+
+def test_unknown_override_is_rejected():
+    with pytest.raises(ValueError, match="ttf_s"):
+        check_overrides({"ttf_s": 1})
+    assert check_overrides(None) is None
+
+def test_phase_budget_is_clipped_by_total():
+    assert phase_budget("ttft", 5.0, None) == (5.0, "ttft")
+    assert phase_budget("ttft", 5.0, 2.0) == (2.0, "total")
+    assert phase_budget("inter_token", None, 3.0) == (3.0, "total")
+    assert phase_budget("inter_token", None, None) == (None, "inter_token")
+    assert phase_budget("ttft", -1.0, None) == (0.0, "ttft")
+
+def test_within_raises_phase_timeout():
+    async def main():
+        assert await within(asyncio.sleep(0, "ok"), None, "ttft") == "ok"
+        with pytest.raises(PhaseTimeout) as e:
+            await within(asyncio.sleep(1), 0.01, "inter_token")
+        assert e.value.phase == "inter_token"
+    asyncio.run(main())
+
+def test_stalled_first_token_fails_over(make_gateway):
+    async def stalled():
+        await asyncio.sleep(5)
+        yield b""
+
+    def handler(phone, request):
+        if phone.cfg.serial == "p0":
+            return httpx.Response(200, content=stalled())
+        return httpx.Response(200, content=chat_body())
+
+    gw = make_gateway(n=2, handler=handler)
+
+    async def main():
+        result = await gw._post_chat(gw.phones[0], {"model": "m:latest", "messages": []},
+                                     deadlines=Deadlines(ttft_s=0.05))
+        assert result["message"]["content"].strip() == "hello world"
+        assert gw.phones[0].inflight == 0
+    asyncio.run(main())
+    assert gw.metrics.deadline_exceeded == {("ttft", gw._devkey(gw.phones[0].cfg)): 1}
@@ -0,0 +1,85 @@
+import asyncio
+
+import httpx
+
+from tests.fakes import chat_body
+
+def test_try_acquire_slot_respects_limit_and_notifies_on_release(make_gateway):
+    async def main():
+        gw = make_gateway(n=1, max_concurrency=2)
+        phone = gw.phones[0]
+        woken = []
+        gw.add_slot_listener(lambda: woken.append(1))
+        a = await gw.try_acquire_slot("m")
+        b = await gw.try_acquire_slot("m")
+        assert a is phone and b is phone and phone.inflight == 2
+        assert await gw.try_acquire_slot("m") is None
+        assert not gw.has_free_slot()
+        gw.release_slot(a)
+        assert woken and phone.inflight == 1 and gw.has_free_slot()
+        gw.release_slot(b)
+        assert phone.inflight == 0 and phone.semaphore.held == 0
+    asyncio.run(main())
+
+def test_held_slot_release_is_idempotent(make_gateway):
+    async def main():
+        gw = make_gateway(n=1)
+        held = gw.hold(await gw.try_acquire_slot("m"))
+        held.release(); held.release()
+        assert gw.phones[0].inflight == 0 and gw.phones[0].semaphore.held == 0
+        taken = gw.hold(await gw.try_acquire_slot("m"))
+        assert taken.take() is gw.phones[0]
+        taken.release()   # własność przeszła na tego, kto wziął – release() nic nie robi
+        assert gw.phones[0].inflight == 1
+    asyncio.run(main())
+
+def test_failover_releases_held_slot_on_primary(make_gateway):
+    seen = {}
+
+    def handler(phone, request):
+        if phone.cfg.serial == "p0":
+            return httpx.Response(500)
+        seen["primary_inflight"] = gw.phones[0].inflight   # w trakcie wywołania na drugim telefonie
+        return httpx.Response(200, content=chat_body())
+
+    gw = make_gateway(n=2, handler=handler)
+    primary = gw.phones[0]
+
+    async def main():
+        held = gw.hold(await gw.try_acquire_slot("m"))
+        assert held.phone is primary
+        result = await gw._post_chat(primary, {"model": "m:latest", "messages": []}, held=held)
+        assert result["message"]["content"].strip() == "hello world"
+        assert held.released
+        held.release()   # jak finally w JobsEngine._run
+        assert seen["primary_inflight"] == 0
+        assert [p.inflight for p in gw.phones] == [0, 0]
+    asyncio.run(main())
+
+def test_dispatcher_never_exceeds_phone_slots(make_gateway):
+    from core.jobs import JobsEngine
+    active, peak = {}, {}
+
+    async def handler(phone, request):
+        key = phone.cfg.serial
+        active[key] = active.get(key, 0) + 1
+        peak[key] = max(peak.get(key, 0), active[key])
+        await asyncio.sleep(0.01)
+        active[key] -= 1
+        return httpx.Response(200, content=chat_body())
+
+    async def main():
+        gw = make_gateway(n=2, max_concurrency=1, handler=handler)
+        engine = JobsEngine(gw)
+        await engine.start()
+        ids = [await engine.enqueue({"prompt": f"q{i}", "model": "m"}) for i in range(8)]
+        for _ in range(200):
+            if all(engine.jobs[i].status == "done" for i in ids):
+                break
+            await asyncio.sleep(0.01)
+        await engine.stop()
+        assert all(engine.jobs[i].status == "done" for i in ids)
+        assert max(peak.values()) == 1
+        assert [p.inflight for p in gw.phones] == [0, 0]
+        assert all(p.semaphore.held == 0 for p in gw.phones)
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+
+from core.jobs import Job, JobsEngine
+from tests.fakes import chat_body, prompt_of, wait_finished
+
+def _recording_gateway(make_gateway, order, stall=()):
+    def handler(phone, request):
+        p = prompt_of(request)
+        order.append(p)
+        if p in stall:
+            async def never():
+                await asyncio.sleep(30)
+                yield b""
+            return httpx.Response(200, content=never())
+        return httpx.Response(200, content=chat_body())
+    return make_gateway(n=1, max_concurrency=1, handler=handler)
+
+def test_priority_then_earliest_deadline_first(make_gateway):
+    order = []
+
+    async def main():
+        engine = JobsEngine(_recording_gateway(make_gateway, order))
+        ids = [await engine.enqueue({"prompt": "a", "model": "m"}),
+               await engine.enqueue({"prompt": "b", "model": "m"}, deadline_s=60),
+               await engine.enqueue({"prompt": "c", "model": "m"}, deadline_s=30),
+               await engine.enqueue({"prompt": "d", "model": "m"}, priority=3),
+               await engine.enqueue({"prompt": "e", "model": "m"}, deadline_s=-1)]
+        await engine.start()
+        jobs = await wait_finished(engine, ids)
+        await engine.stop()
+        assert order == ["d", "c", "b", "a"]
+        assert jobs[-1].status == "error" and "deadline" in jobs[-1].error
+    asyncio.run(main())
+
+def test_cancel_queued_and_running(make_gateway):
+    order = []
+
+    async def main():
+        gw = _recording_gateway(make_gateway, order, stall={"slow"})
+        engine = JobsEngine(gw)
+        await engine.start()
+        slow = await engine.enqueue({"prompt": "slow", "model": "m"})
+        queued = await engine.enqueue({"prompt": "queued", "model": "m"})
+        last = await engine.enqueue({"prompt": "last", "model": "m"})
+        while order != ["slow"]:
+            await asyncio.sleep(0.01)
+        assert (await engine.cancel(queued)).status == "cancelled"
+        assert (await engine.cancel(slow)).status == "cancelled"
+        jobs = await wait_finished(engine, [slow, queued, last])
+        assert [j.status for j in jobs] == ["cancelled", "cancelled", "done"]
+        assert order == ["slow", "last"]           # anulowany w kolejce nie dotarł do telefonu
+        assert await engine.cancel(last) is None   # już zakończony
+        assert gw.phones[0].inflight == 0
+        await engine.stop()
+    asyncio.run(main())
+
+def test_edf_holds_across_aging_window_boundary(make_gateway):
+    engine = JobsEngine(make_gateway(n=1), aging_s=60)
+    edge = (datetime.now(timezone.utc).timestamp() // 60) * 60   # granica minutowego okna
+
+    def job(name, seq, at, deadline_s=None):
+        return Job(id=name, req={}, priority=5, seq=seq, enqueued_at=datetime.fromtimestamp(at, timezone.utc).isoformat(),
+                   deadline=None if deadline_s is None else at + deadline_s)
+    plain = job("plain", 1, edge - 0.1)
+    late = job("late", 2, edge - 0.1, deadline_s=30)
+    early = job("early", 3, edge + 0.1, deadline_s=10)      # zgłoszony w następnym oknie, deadline wcześniej
+    far = job("far", 4, edge + 0.1, deadline_s=3600)         # deadline za daleko, by był pilny
+    order = sorted([plain, late, early, far], key=engine._entry)
+    assert [j.id for j in order] == ["early", "late", "plain", "far"]
+    aged = job("aged", 5, edge - 600)                        # 10 minut czekania wyprzedza deadline'y priority 5
+    aged.priority = 9
+    assert engine._entry(aged) < engine._entry(early)
@@ -0,0 +1,79 @@
+import asyncio, json
+
+import httpx
+import pytest
+
+from core.embed import chunk_end, est_tokens, f32_body, pack_f32, unpack_f32
+
+def test_chunk_end_sized_by_throughput_within_bounds():
+    texts = ["x" * 40] * 100          # 10 tokenów na tekst
+    assert chunk_end(texts, 0, 100, tokens_per_s=100, target_s=1.0, lo=1, hi=64) == 10
+    assert chunk_end(texts, 0, 100, tokens_per_s=1000, target_s=1.0, lo=1, hi=64) == 64   # sufit hi
+    assert chunk_end(texts, 0, 100, tokens_per_s=1, target_s=1.0, lo=4, hi=64) == 4       # minimum lo
+    assert chunk_end(texts, 95, 100, tokens_per_s=100, target_s=1.0, lo=1, hi=64) == 100  # nie za stop
+    assert chunk_end(texts, 20, 30, tokens_per_s=45, target_s=1.0, lo=1, hi=64) == 24
+    assert est_tokens("") == 1
+
+def test_pack_f32_roundtrip_and_dimension_check():
+    vectors = [[0.5, -1.0, 2.0], [0.0, 0.25, 3.5]]
+    body, dim = pack_f32(vectors)
+    assert dim == 3 and len(body) == 2 * 3 * 4
+    assert body[:4] == b"\x00\x00\x00\x3f"    # 0.5 jako float32 little-endian
+    assert unpack_f32(body, dim) == vectors
+    assert pack_f32([]) == (b"", 0) and unpack_f32(b"", 0) == []
+    with pytest.raises(ValueError):
+        pack_f32([[1.0, 2.0], [1.0]])
+    _, headers = f32_body({"model": "e:latest", "embeddings": vectors})
+    assert headers == {"X-Embedding-Count": "2", "X-Embedding-Dim": "3", "X-Model": "e:latest"}
+
+def test_embed_keeps_input_order_across_phones_and_uses_held_slot(make_gateway):
+    calls = []
+
+    def handler(phone, request):
+        texts = json.loads(request.content)["input"]
+        calls.append((phone.cfg.serial, len(texts)))
+        return httpx.Response(200, json={"model": "m:latest", "prompt_eval_count": len(texts),
+                                         "embeddings": [[float(t.split(":")[0]), 0.0] for t in texts]})
+
+    gw = make_gateway(n=2, handler=handler)
+
+    async def main():
+        held = await gw.try_acquire_slot("m")
+        texts = [f"{i}:" + "x" * 40 for i in range(200)]   # ~40 tekstów na kawałek przy EMBED_PRIOR_TPS
+        result = await gw.embed(texts, "m", held=held)
+        assert [v[0] for v in result["embeddings"]] == list(range(200))
+        assert result["prompt_eval_count"] == 200
+        assert calls[0][0] == held.cfg.serial and {s for s, _ in calls} == {"p0", "p1"}
+        assert [p.inflight for p in gw.phones] == [0, 0]
+    asyncio.run(main())
+
+def test_retry_waits_for_untried_phone_instead_of_spinning(make_gateway, monkeypatch):
+    """p0 psuje kawałek, p1 zajęty: embed czeka na slot p1, nie bierze i oddaje w kółko slotu p0."""
+    def handler(phone, request):
+        texts = json.loads(request.content)["input"]
+        if phone.cfg.serial == "p0":
+            return httpx.Response(500, text="boom")
+        return httpx.Response(200, json={"model": "m:latest", "embeddings": [[1.0]] * len(texts)})
+
+    gw = make_gateway(n=2, handler=handler)
+    calls = []
+    acquire = gw.try_acquire_slot
+
+    async def counting(*args, **kw):
+        calls.append(kw.get("exclude"))
+        return await acquire(*args, **kw)
+    monkeypatch.setattr(gw, "try_acquire_slot", counting)
+
+    async def main():
+        p0, p1 = gw.phones
+        busy = 0
+        while not p1.semaphore.locked():   # sloty p1 zajęte przez inny ruch
+            await p1.semaphore.acquire()
+            p1.inflight += 1; busy += 1
+        release = asyncio.get_running_loop().call_later(0.3, lambda: [gw.release_slot(p1) for _ in range(busy)])
+        result = await gw.embed(["a", "b"], "m")
+        release.cancel()
+        assert result["embeddings"] == [[1.0], [1.0]]
+        assert len(calls) < 10 and {id(p0)} in calls
+        assert [p.inflight for p in gw.phones] == [0, 0]
+    asyncio.run(main())
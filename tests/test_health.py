@@ -0,0 +1,62 @@
+import random
+
+from core.health import CLOSED, HALF_OPEN, OPEN, SUSPECT, HealthEvents, HealthPolicy, PhoneHealth
+
+def fsm(**kw):
+    events = HealthEvents()
+    h = PhoneHealth("p0", HealthPolicy(**kw), on_transition=lambda h, old, new, why: events.record(h.key, old, new, why))
+    return h, events
+
+def test_failures_open_then_probe_half_open_then_close():
+    h, events = fsm(fail_threshold=3, open_s=5.0, half_open_successes=2)
+    h.on_failure(1.0, "error")
+    assert h.state == SUSPECT
+    h.on_failure(2.0, "stall"); h.on_failure(3.0, "error")
+    assert h.state == OPEN and h.open_until == 8.0 and not h.admits(0, 4.0)
+    h.on_probe(True, 7.0)                      # przed open_until – bez zmian
+    assert h.state == OPEN
+    h.on_probe(True, 8.0)
+    assert h.state == HALF_OPEN and h.admits(0, 8.0) and not h.admits(1, 8.0)
+    h.on_success(9.0); h.on_success(10.0)
+    assert h.state == CLOSED and h.failures == 0
+    assert [(e["from"], e["to"]) for e in events.since()] == [
+        (CLOSED, SUSPECT), (SUSPECT, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+
+def test_half_open_failure_doubles_open_time_up_to_max():
+    h, _ = fsm(fail_threshold=1, open_s=5.0, open_max_s=15.0)
+    h.on_failure(0.0, "error")
+    h.on_probe(True, 5.0)
+    h.on_failure(6.0, "error")
+    assert h.state == OPEN and h.open_s == 10.0 and h.open_until == 16.0
+    h.on_probe(False, 16.0, "timeout")
+    assert h.open_s == 15.0 and h.open_until == 31.0
+    h.on_probe(True, 31.0); h.on_success(32.0); h.on_success(33.0)
+    assert h.state == CLOSED and h.open_s == 5.0
+
+def test_suspect_clears_after_successes_or_quiet_probe():
+    h, _ = fsm(suspect_clear=2, suspect_quiet_s=30.0)
+    h.on_failure(0.0, "error")
+    h.on_success(1.0); h.on_success(2.0)
+    assert h.state == CLOSED
+    h.on_failure(10.0, "error")
+    h.on_probe(True, 20.0)
+    assert h.state == SUSPECT
+    h.on_probe(True, 40.0)
+    assert h.state == CLOSED
+
+def test_slow_output_marks_suspect_and_success_in_open_is_ignored():
+    h, _ = fsm(outlier_factor=3.0, fail_threshold=1)
+    h.on_success(1.0, tps=2.0, ewma_tps=10.0)
+    assert h.state == SUSPECT and h.last_signal == 1.0
+    h.on_failure(2.0, "error")
+    h.on_success(3.0)
+    assert h.state == OPEN
+
+def test_probe_interval_by_state():
+    rng = random.Random(0)
+    h, _ = fsm(probe_fast_s=1.0, probe_s=10.0, probe_slow_s=30.0, stable_after_s=120.0, probe_jitter=0.0)
+    h.since = 0.0
+    assert h.probe_in(50.0, rng) == 10.0
+    assert h.probe_in(500.0, rng) == 30.0
+    h.on_failure(500.0, "error")
+    assert h.probe_in(501.0, rng) == 1.0
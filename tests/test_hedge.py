@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+
+from core.hedge import Hedger
+from tests.fakes import chat_body
+
+def test_budget_refills_per_request_and_caps_at_burst():
+    h = Hedger(budget_pct=0.25, burst=2.0)
+    assert h.try_spend()            # startowy żeton
+    assert not h.try_spend() and h.stats["denied"] == 1
+    for _ in range(3):
+        h.on_request()
+    assert not h.try_spend()        # 0.75 < 1
+    h.on_request()
+    assert h.try_spend()
+    for _ in range(100):
+        h.on_request()
+    assert h._tokens == 2.0
+
+def test_delay_uses_ttft_quantile_after_min_samples():
+    h = Hedger(percentile=0.5, min_samples=4, default_delay_s=1.5, min_delay_s=0.05)
+    assert h.delay("m") == 1.5
+    for v in (0.2, 0.2, 0.2, 0.2):
+        h.observe("m", v)
+    assert 0.1 <= h.delay("m") <= 0.25
+    assert h.delay("other") == 1.5
+    h2 = Hedger(min_samples=1)
+    h2.observe("m", 0.001)
+    assert h2.delay("m") == h2.min_delay_s
+
+def _stream(first_after: float, gap: float = 0.0):
+    async def body():
+        await asyncio.sleep(first_after)
+        for line in chat_body().splitlines(keepends=True):
+            yield line
+            await asyncio.sleep(gap)
+    return body()
+
+def _gateway(make_gateway, primary_stream):
+    def handler(phone, request):
+        if phone.cfg.serial == "p0":
+            return httpx.Response(200, content=primary_stream())
+        return httpx.Response(200, content=_stream(0.0))
+    gw = make_gateway(n=2, handler=handler)
+    gw.hedger = Hedger(min_samples=1, default_delay_s=0.05, burst=5.0)
+    return gw
+
+def test_hedges_when_first_token_is_late(make_gateway):
+    import server
+    gw = _gateway(make_gateway, lambda: _stream(5.0))
+
+    async def main():
+        phone, result = await gw.post_chat_hedged(gw.phones[0], server.AskRequest(prompt="hi"))
+        assert phone is gw.phones[1]
+        assert result["message"]["content"].strip() == "hello world"
+        assert gw.hedger.stats["issued"] == 1 and gw.hedger.stats["won"] == 1
+    asyncio.run(main())
+
+def test_no_hedge_once_primary_is_streaming(make_gateway):
+    import server
+    gw = _gateway(make_gateway, lambda: _stream(0.0, gap=0.05))   # długa odpowiedź, ale tokeny płyną
+
+    async def main():
+        phone, _ = await gw.post_chat_hedged(gw.phones[0], server.AskRequest(prompt="hi"))
+        assert phone is gw.phones[0]
+        assert gw.hedger.stats["issued"] == 0
+    asyncio.run(main())
+
+def test_every_phone_call_feeds_budget(make_gateway):
+    gw = _gateway(make_gateway, lambda: _stream(0.0))
+    gw.hedger = Hedger(budget_pct=0.5)
+    gw.hedger._tokens = 0.0
+
+    async def main():
+        for _ in range(2):   # zwykłe wywołania bez hedgingu
+            await gw._post_chat(gw.phones[0], {"model": "m:latest", "messages": []})
+        assert gw.hedger.try_spend()
+        assert gw.hedger._latency["m:latest"].count == 2   # TTFT ze strumienia
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+import asyncio, time
+
+from core.jobs import Job
+from core.jobstore import JobStore
+
+def job(i, **kw):
+    return Job(id=f"j{i}", req={"prompt": f"q{i}"}, seq=i, **kw)
+
+def test_save_is_deferred_but_readable(tmp_path):
+    async def main():
+        store = JobStore(tmp_path / "jobs.db", flush_s=0.01)
+        writer = asyncio.create_task(store.run())
+        j = job(1, status="done", result={"message": {"content": "ok"}})
+        store.save(j, j.seq)
+        assert store.writes == 0
+        assert (await store.load("j1"))["status"] == "done"          # z pamięci, przed zapisem
+        assert await store.load_result("j1") == {"message": {"content": "ok"}}
+        for _ in range(100):
+            if store.writes:
+                break
+            await asyncio.sleep(0.01)
+        assert store.writes == 1 and not store._pending
+        assert await store.load_result("j1") == {"message": {"content": "ok"}}   # już z bazy
+        writer.cancel()
+        store.close()
+    asyncio.run(main())
+
+def test_recover_returns_unfinished_in_seq_order_with_updated_priority(tmp_path):
+    async def main():
+        store = JobStore(tmp_path / "jobs.db")
+        a, b, c = job(2, priority=5), job(1, priority=5, status="running"), job(3, status="done")
+        for j in (a, b, c):
+            store.save(j, j.seq)
+        await store.flush()
+        a.priority, a.deadline = 1, 123.0   # duplikat / promocja podnosi priorytet
+        store.save(a, a.seq)
+        store.close()   # zapisuje zaległe
+
+        store = JobStore(tmp_path / "jobs.db")
+        rows = await store.recover()
+        assert [r["id"] for r in rows] == ["j1", "j2"]
+        assert rows[1]["priority"] == 1 and rows[1]["deadline"] == 123.0
+        assert rows[0]["status"] == "running"
+        store.close()
+    asyncio.run(main())
+
+def test_evict_ttl_count_and_size(tmp_path):
+    async def main():
+        store = JobStore(tmp_path / "jobs.db", result_ttl_s=100, max_finished=3, max_result_bytes=10 ** 9)
+        for i in range(5):
+            store.save(job(i, status="done", result={"x": "y" * 10}), i)
+        store.save(job(9, status="queued"), 9)
+        now = time.time()
+        assert await store.evict(now) == 2            # limit liczby: zostają 3 zakończone
+        assert store.stats()["finished"] == 3
+        assert await store.evict(now + 101) == 3      # TTL
+        assert (await store.load("j9"))["status"] == "queued"   # niezakończone nie wygasają
+        store.max_finished = 10 ** 6
+        for i in range(10, 14):
+            store.save(job(i, status="done", result={"x": "y" * 100}), i)
+        store.max_result_bytes = 250            # ~110 B na wynik -> zostają 2 najnowsze
+        assert await store.evict() == 2
+        assert await store.load("j10") is None and await store.load("j13") is not None
+        assert store.stats()["evicted"] == 7
+        store.close()
+    asyncio.run(main())
+
+def test_cancel_requests_and_claim_orphans(tmp_path):
+    async def main():
+        store = JobStore(tmp_path / "jobs.db", owner="dead")
+        store.save(job(1), 1)
+        store.save(job(2, status="done"), 2)
+        await store.flush()
+        other = JobStore(tmp_path / "jobs.db", owner="alive")
+        assert [r["id"] for r in await other.claim_orphans(["alive"])] == ["j1"]
+        assert await other.claim_orphans(["alive"]) == []
+        assert await store.request_cancel("j1") and not await store.request_cancel("j2")
+        assert await other.cancel_requests() == ["j1"] and await other.cancel_requests() == []
+        store.close(); other.close()
+    asyncio.run(main())
+
+def test_queries_wait_for_write_in_progress(tmp_path):
+    async def main():
+        store = JobStore(tmp_path / "jobs.db")
+        for i in range(50):
+            store.save(job(i, status="done", group="g", finished_at=f"t{i:03d}"), i)
+        writing = asyncio.create_task(store.flush())   # zapis w wątku w toku ...
+        await asyncio.sleep(0)
+        assert store._writing and not store._pending
+        assert await store.group_counts("g") == {"done": 50}   # ... zapytanie widzi jego wiersze
+        assert len(await store.group_finished("g")) == 50
+        await writing
+        store.close()
+    asyncio.run(main())
+
+def test_engine_reads_finished_job_before_it_is_written(tmp_path, make_gateway):
+    import httpx
+    from core.jobs import JobsEngine
+    from tests.fakes import chat_body
+
+    async def main():
+        gw = make_gateway(n=1, handler=lambda phone, request: httpx.Response(200, content=chat_body()))
+        store = JobStore(tmp_path / "jobs.db", flush_s=60)
+        engine = JobsEngine(gw, store=store)
+        await engine.start()
+        job_id = await engine.enqueue({"prompt": "q", "model": "m"})
+        for _ in range(200):
+            status = await engine.get_status(job_id)
+            if status.status == "done":
+                break
+            await asyncio.sleep(0.01)
+        assert status.status == "done" and job_id not in engine.jobs
+        assert (await engine.get_result(job_id))["message"]["content"].strip() == "hello world"
+        await engine.stop()   # close() zapisuje zaległe
+        again = JobStore(tmp_path / "jobs.db")
+        assert (await again.load(job_id))["status"] == "done" and await again.recover() == []
+        again.close()
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+import asyncio
+
+from core.limiter import AdaptiveLimit, LimitPolicy, ResizableSemaphore
+
+def _window(lim: AdaptiveLimit, phone_tps: float):
+    """Okno próbek przy współbieżności == limit; telefon daje łącznie phone_tps tokenów/s."""
+    out = None
+    for _ in range(max(lim.policy.window, 2 * lim.limit)):
+        r = lim.on_sample(100, 100 * lim.limit / phone_tps, lim.limit)
+        out = r if r is not None else out
+    return out
+
+def test_aimd_climbs_to_knee_and_stays_near_it():
+    lim = AdaptiveLimit(ceiling=8, policy=LimitPolicy(initial=1, hold_windows=2))
+    seen = []
+    for _ in range(40):
+        _window(lim, 10.0 * min(lim.limit, 3))   # kolano przy 3
+        seen.append(lim.limit)
+    assert max(seen) <= 4 and 3 in seen[-10:]
+    assert all(l in (2, 3, 4) for l in seen[-10:])
+
+def test_samples_below_limit_or_short_do_not_count():
+    lim = AdaptiveLimit(ceiling=8, policy=LimitPolicy(initial=2))
+    for _ in range(50):
+        assert lim.on_sample(100, 1.0, 1.0) is None   # telefon nienasycony
+        assert lim.on_sample(3, 1.0, 2.0) is None     # za krótka odpowiedź
+    assert lim.limit == 2 and lim._n == 0
+
+def test_failure_backs_off_once_until_next_success():
+    lim = AdaptiveLimit(ceiling=10, policy=LimitPolicy(initial=10, backoff=0.7))
+    assert lim.on_failure() == 7
+    assert lim.on_failure() is None           # ta sama awaria z równoległych wywołań
+    lim.on_sample(100, 1.0, 1.0)
+    assert lim.on_failure() == 4
+    lim.on_sample(100, 1.0, 1.0)
+    lim.limit = 1
+    assert lim.on_failure() is None
+
+def test_ceiling_clamps_limit():
+    lim = AdaptiveLimit(ceiling=6, policy=LimitPolicy(initial=5))
+    assert lim.set_ceiling(3) == 3 and lim.limit == 3
+    assert lim.set_ceiling(8) == 3
+    assert lim.adopt(20) == 8
+
+def test_semaphore_resize_wakes_and_drains():
+    async def main():
+        sem = ResizableSemaphore(1)
+        await sem.acquire()
+        waiters = [asyncio.create_task(sem.acquire()) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert sem.locked() and not any(w.done() for w in waiters)
+        sem.resize(3)
+        await asyncio.sleep(0)
+        assert [w.done() for w in waiters] == [True, True, False] and sem.held == 3
+        sem.resize(1)                              # trwające zostają
+        sem.release(); sem.release()
+        assert sem.held == 1 and not waiters[2].done()
+        sem.release()
+        await asyncio.sleep(0)
+        assert waiters[2].done() and sem.held == 1
+    asyncio.run(main())
+
+def test_cancelled_waiter_does_not_leak_permit():
+    async def main():
+        sem = ResizableSemaphore(1)
+        await sem.acquire()
+        w = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0)
+        sem.release()          # permit przydzielony czekającemu ...
+        w.cancel()             # ... który zostaje anulowany, zanim się obudzi
+        await asyncio.gather(w, return_exceptions=True)
+        assert sem.held == 0 and not sem.locked()
+    asyncio.run(main())
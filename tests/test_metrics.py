@@ -0,0 +1,61 @@
+import asyncio
+
+import httpx
+import pytest
+
+from core.metrics import Histogram, HistogramFamily, Metrics
+from tests.fakes import chat_body
+
+def test_bucket_boundaries_are_le():
+    h = Histogram((1.0, 2.0, 5.0))
+    for v in (0.5, 1.0, 1.5, 2.0, 5.0, 7.0):
+        h.observe(v)
+    assert h.counts == [2, 2, 1, 1]   # v == granica trafia do kubełka le=granica; ostatni = +Inf
+    assert h.count == 6 and h.sum == pytest.approx(17.0)
+
+def test_render_is_cumulative_with_inf():
+    fam = HistogramFamily("x_seconds", "help", ("phone",), (1.0, 2.0))
+    for v in (0.5, 1.5, 3.0):
+        fam.observe(("p0",), v)
+    lines = fam.render()
+    assert 'x_seconds_bucket{phone="p0",le="1.0"} 1' in lines
+    assert 'x_seconds_bucket{phone="p0",le="2.0"} 2' in lines
+    assert 'x_seconds_bucket{phone="p0",le="+Inf"} 3' in lines
+    assert 'x_seconds_count{phone="p0"} 3' in lines
+    assert fam.get(("p1",)) is None
+
+def test_quantile_interpolates_within_bucket():
+    h = Histogram((1.0, 2.0))
+    assert h.quantile(0.5) is None
+    for _ in range(10):
+        h.observe(1.5)
+    assert h.quantile(0.5) == pytest.approx(1.5)
+    assert h.quantile(1.0) == pytest.approx(2.0)
+
+def test_observe_response_splits_ollama_telemetry():
+    m = Metrics()
+    data = {"model": "m:latest", "prompt_eval_count": 100, "prompt_eval_duration": 500_000_000,
+            "eval_count": 40, "eval_duration": 2_000_000_000, "load_duration": 250_000_000}
+    m.observe_response("p0", None, 3.0, data)
+    key = ("p0", "m:latest")
+    assert m.prompt_tps.get(key).sum == pytest.approx(200.0)
+    assert m.gen_tps.get(key).sum == pytest.approx(20.0)
+    assert m.load.get(key).sum == pytest.approx(0.25)
+    assert m.ttft.get(key).sum == pytest.approx(0.75)   # non-stream: ładowanie + prompt
+    assert m.prompt_tokens[key] == 100 and m.gen_tokens[key] == 40
+    text = m.render_prom([("gw_g", "gauge", {"phone": "p0"}, 1)])
+    assert 'gw_generated_tokens_total{phone="p0",model="m:latest"} 40' in text
+    assert 'gw_g{phone="p0"} 1' in text
+
+def test_request_attributed_to_phone_that_served_it(make_gateway):
+    def handler(phone, request):
+        if phone.cfg.serial == "p0":
+            return httpx.Response(500)
+        return httpx.Response(200, content=chat_body())
+
+    gw = make_gateway(n=2, handler=handler)
+    asyncio.run(gw._post_chat(gw.phones[0], {"model": "m:latest", "messages": []}))
+    assert gw.metrics.phone_hits == {"p1": 1}
+    text = gw.metrics.render_prom()
+    for name in ("gw_prompt_tokens_total", "gw_generated_tokens_total"):
+        assert f"# HELP {name} " in text and f"# TYPE {name} counter" in text
@@ -0,0 +1,73 @@
+import asyncio, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from core.pool import PhoneClient, render_pool_prom
+from tests.fakes import chat_body
+
+class _Phone(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive – połączenie wraca do puli
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        body = chat_body()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def phone_port():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Phone)
+    t = threading.Thread(target=srv.serve_forever, daemon=True)
+    t.start()
+    yield srv.server_address[1]
+    srv.shutdown(); srv.server_close()
+
+def test_connection_reused_across_calls(phone_port):
+    async def main():
+        pool = PhoneClient("127.0.0.1", phone_port, max_concurrency=2, spare=1)
+        for _ in range(3):
+            r = await pool.client.post("/api/chat", json={})
+            assert r.status_code == 200
+        s = pool.stats()
+        assert s == {"active": 0, "max": 3, "requests": 3, "new_connections": 1, "reused": 2}
+        async with pool.client.stream("POST", "/api/chat", json={}) as r:
+            assert pool.stats()["active"] == 1    # odpowiedź otwarta = połączenie zajęte
+            await r.aread()
+        assert pool.stats()["active"] == 0
+        assert 'gw_pool_connections_reused_total{phone="p0"} 3' in render_pool_prom([("p0", pool)])
+        await pool.aclose()
+        assert pool.client.is_closed
+    asyncio.run(main())
+
+def test_gateway_keeps_one_client_and_rebuilds_on_resize(make_gateway, phone_port, monkeypatch):
+    import server
+
+    async def main():
+        gw = make_gateway(n=1)
+        monkeypatch.setattr(gw, "_start_prober", lambda phone: None)
+        phone = gw.phones[0]
+        phone.cfg = server.PhoneConfig(host="127.0.0.1", port=phone_port, model="m:latest",
+                                       max_concurrency=2, serial="p0")
+        gw._open_pool(phone)
+        pool = phone.pool
+        for _ in range(2):
+            await gw._post_chat(phone, {"model": "m:latest", "messages": []})
+        assert phone.pool is pool and pool.stats()["new_connections"] == 1
+        await gw.apply_config([server.PhoneConfig(host="127.0.0.1", port=phone_port, model="m:latest",
+                                                  max_concurrency=4, serial="p0")])
+        assert phone.pool is not pool and phone.pool.max_connections == 4 + server.POOL_SPARE_CONNECTIONS
+        await asyncio.sleep(0.05)   # _drain: stara pula bez żądań -> zamknięta
+        assert pool.client.is_closed
+        await gw.apply_config([])
+        old = phone.pool
+        await asyncio.sleep(0.05)   # usunięty telefon bez wywołań w toku
+        assert old.client.is_closed
+        await gw.stop()
+    asyncio.run(main())
@@ -0,0 +1,46 @@
+import asyncio
+
+import httpx
+
+from tests.fakes import chat_body
+
+def _cfg(server, i, **kw):
+    return server.PhoneConfig(**{"host": "127.0.0.1", "port": 11434 + i, "model": "m:latest",
+                                 "max_concurrency": 2, "serial": f"p{i}", **kw})
+
+def test_apply_config_diff(make_gateway, monkeypatch):
+    import server
+
+    async def main():
+        gw = make_gateway(n=3, handler=lambda phone, request: httpx.Response(200, content=chat_body()))
+        monkeypatch.setattr(gw, "_start_prober", lambda phone: None)   # bez sond po sieci
+        p0, p1, p2 = gw.phones
+        p2.inflight = 1   # usunięty w trakcie wywołania – pula dokańcza
+        diff = await gw.apply_config([
+            _cfg(server, 0),
+            _cfg(server, 1, max_concurrency=4, weight=3),
+            _cfg(server, 3),
+        ])
+        assert diff == {"added": ["p3"], "removed": ["p2"], "resized": ["p1"], "updated": ["p1"]}
+        assert [gw._devkey(p.cfg) for p in gw.phones] == ["p0", "p1", "p3"]
+        assert gw.phones[0] is p0 and gw.phones[1] is p1         # bez zmian – ten sam stan
+        assert p1.cfg.max_concurrency == 4 and p1.limiter.ceiling == 4
+        assert p2.reason == "removed" and not p2.pool.client.is_closed   # zamknie ją _drain
+        assert p2 not in set(gw.ring.walk("any-key"))
+        assert await gw.apply_config([p.cfg for p in gw.phones]) == {
+            "added": [], "removed": [], "resized": [], "updated": []}
+        await gw.stop()
+    asyncio.run(main())
+
+def test_moved_phone_is_replaced(make_gateway, monkeypatch):
+    import server
+
+    async def main():
+        gw = make_gateway(n=1)
+        monkeypatch.setattr(gw, "_start_prober", lambda phone: None)
+        old = gw.phones[0]
+        diff = await gw.apply_config([_cfg(server, 0, port=9999)])
+        assert diff["removed"] == ["p0"] and diff["added"] == ["p0"]
+        assert gw.phones[0] is not old and gw.phones[0].cfg.port == 9999
+        await gw.stop()
+    asyncio.run(main())
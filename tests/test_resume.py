@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import httpx
+
+from tests.fakes import chat_body
+
+def _line(content: str, done: bool = False) -> bytes:
+    return json.dumps({"message": {"role": "assistant", "content": content}, "done": done}).encode() + b"\n"
+
+def _broken(after: bytes):
+    async def body():
+        yield after
+        raise httpx.ReadError("connection reset")
+    return body()
+
+def test_resume_continues_on_other_phone_without_repeating(make_gateway):
+    bodies = []
+
+    def handler(phone, request):
+        bodies.append((phone.cfg.serial, json.loads(request.content)))
+        if phone.cfg.serial == "p0":
+            return httpx.Response(200, content=_broken(_line("hello ")))
+        return httpx.Response(200, content=chat_body("world"))
+
+    gw = make_gateway(n=2, handler=handler)
+
+    async def main():
+        lines = [json.loads(l) async for l in gw._stream_chat(gw.phones[0], {"model": "m:latest",
+                 "messages": [{"role": "user", "content": "hi"}]})]
+        text = "".join((o.get("message") or {}).get("content") or "" for o in lines)
+        assert text.split() == ["hello", "world"]
+        assert lines[-1]["done"] and "error" not in lines[-1]
+        assert [s for s, _ in bodies] == ["p0", "p1"]
+        resumed = bodies[1][1]["messages"]
+        assert resumed[-1] == {"role": "assistant", "content": "hello "}
+        assert resumed[:-1] == [{"role": "user", "content": "hi"}]
+        assert gw.phones[0].inflight == gw.phones[1].inflight == 0
+    asyncio.run(main())
+
+def test_post_chat_assembles_resumed_answer_once(make_gateway):
+    def handler(phone, request):
+        if phone.cfg.serial == "p0":
+            return httpx.Response(200, content=_broken(_line("one ")))
+        return httpx.Response(200, content=chat_body("two three"))
+
+    gw = make_gateway(n=2, handler=handler)
+
+    async def main():
+        result = await gw._post_chat(gw.phones[0], {"model": "m:latest", "messages": []})
+        assert result["message"]["content"].split() == ["one", "two", "three"]
+    asyncio.run(main())
+
+def test_stream_ends_with_error_event_when_all_attempts_fail(make_gateway, monkeypatch):
+    import server
+    monkeypatch.setattr(server, "STREAM_MAX_ATTEMPTS", 2)
+    gw = make_gateway(n=2, handler=lambda phone, request: httpx.Response(200, content=_broken(_line("x "))))
+
+    async def main():
+        lines = [json.loads(l) async for l in gw._stream_chat(gw.phones[0], {"model": "m:latest", "messages": []})]
+        assert lines[-1]["done"] and lines[-1]["done_reason"] == "error" and lines[-1]["partial"]
+        assert "".join((o.get("message") or {}).get("content") or "" for o in lines[:-1]) == "x x "
+    asyncio.run(main())
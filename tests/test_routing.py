@@ -0,0 +1,76 @@
+import asyncio, json
+
+import httpx
+import pytest
+
+from tests.fakes import chat_body
+
+def _fleet(make_gateway, models, seen):
+    """Telefon i ma modele models[i]; seen: (serial, model z żądania)."""
+    def handler(phone, request):
+        seen.append((phone.cfg.serial, json.loads(request.content).get("model")))
+        return httpx.Response(200, content=chat_body())
+    gw = make_gateway(n=len(models), handler=handler)
+    for p, ms in zip(gw.phones, models):
+        p.models = ms
+    gw._rebuild_model_index()
+    return gw
+
+def test_phone_without_model_is_skipped(make_gateway, api):
+    seen = []
+    gw = _fleet(make_gateway, [["other:latest"], ["m:latest"]], seen)
+
+    async def main():
+        async with api(gw) as c:
+            for _ in range(4):
+                r = await c.post("/ask", json={"prompt": "hi", "model": "m", "cache": False})
+                assert r.status_code == 200
+    asyncio.run(main())
+    assert [s for s, _ in seen] == ["p1"] * 4
+    assert [p.cfg.serial for p in gw.eligible_phones("m")] == ["p1"]
+    assert len(gw.eligible_phones(None)) == 2
+
+def test_unknown_model_is_503(make_gateway, api):
+    seen = []
+    gw = _fleet(make_gateway, [["m:latest"], ["m:latest"]], seen)
+
+    async def main():
+        async with api(gw) as c:
+            for path in ("/ask", "/ask_stream"):
+                r = await c.post(path, json={"prompt": "hi", "model": "nope"})
+                assert r.status_code == 503 and "nope" in r.json()["detail"]
+    asyncio.run(main())
+    assert seen == []
+
+def test_default_model_fallback(make_gateway, api):
+    seen = []
+    gw = _fleet(make_gateway, [["m:latest"], ["m:latest"]], seen)
+    assert gw.resolve_model(None) == "m:latest"      # wspólny domyślny floty (klucz cache)
+    gw.phones[1].cfg.model = "x:latest"
+    assert gw.resolve_model(None) is None
+
+    async def main():
+        async with api(gw) as c:
+            for _ in range(4):
+                r = await c.post("/ask", json={"prompt": "hi", "cache": False})
+                assert r.status_code == 200
+    asyncio.run(main())
+    # żądanie bez modelu dostaje model z phones.json wybranego telefonu
+    defaults = {p.cfg.serial: p.cfg.model for p in gw.phones}
+    assert len(seen) == 4 and all(m == defaults[s] for s, m in seen)
+
+def test_resident_model_preferred(make_gateway):
+    gw = _fleet(make_gateway, [["m:latest"], ["m:latest"]], [])
+    gw.phones[1].resident = ["m:latest"]
+
+    async def main():
+        assert await gw._next_phone("m") is gw.phones[1]
+    asyncio.run(main())
+
+def test_model_index_empty_before_health_checks(make_gateway):
+    gw = _fleet(make_gateway, [[], []], [])
+    assert len(gw.eligible_phones("anything")) == 2    # bez danych z /api/tags – wszystkie
+    gw.phones[0].models = ["m:latest"]
+    gw._rebuild_model_index()
+    with pytest.raises(Exception, match="not available"):
+        gw.eligible_phones("anything")
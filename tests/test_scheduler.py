@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+from core.scheduler import LeastExpectedTimeScheduler, RoundRobinScheduler, make_scheduler
+
+def phone(port, max_concurrency=2, weight=1, resident=(), latency=None):
+    return SimpleNamespace(cfg=SimpleNamespace(port=port, max_concurrency=max_concurrency, weight=weight),
+                           healthy=True, open_until=0.0, inflight=0, queued=0, resident=list(resident),
+                           ewma_latency_s=latency, ewma_tps=None, ewma_load_s=None)
+
+def test_make_scheduler_policies():
+    phones = [phone(1)]
+    assert isinstance(make_scheduler("lect", phones), LeastExpectedTimeScheduler)
+    assert isinstance(make_scheduler("rr", phones), RoundRobinScheduler)
+    with pytest.raises(ValueError, match="unknown scheduler policy"):
+        make_scheduler("random", phones)
+
+def test_lect_picks_lowest_expected_time():
+    fast, slow = phone(1, latency=1.0), phone(2, latency=3.0)
+    s = LeastExpectedTimeScheduler([fast, slow])
+    assert s.select(None, None, 0.0) is fast
+    # fast nasycony: 2 w toku + 2 w kolejce przy limicie 2 -> 1.0 * (1 + 3/2) = 2.5 < 3.0
+    fast.inflight, fast.queued = 2, 2
+    s.touch(fast)
+    assert s.select(None, None, 0.0) is fast
+    fast.queued = 4   # 1.0 * (1 + 5/2) = 3.5 > 3.0
+    s.touch(fast)
+    assert s.select(None, None, 0.0) is slow
+
+def test_lect_lazy_invalidation_drops_stale_entries():
+    a, b = phone(1, latency=1.0), phone(2, latency=2.0)
+    s = LeastExpectedTimeScheduler([a, b])
+    a.ewma_latency_s = 5.0
+    s.touch(a)   # stary wpis a (1.0) zostaje w kopcu, ale z nieaktualną wersją
+    assert s.select(None, None, 0.0) is b
+    assert s.select(None, None, 0.0) is b   # select() odkłada zdjęte wpisy z powrotem
+    for _ in range(200):
+        s.touch(a)
+    assert len(s._heap) <= 4 * len(s.phones) + 64 + 1   # kompaktowanie
+
+def test_lect_skips_disallowed_unhealthy_and_removed():
+    a, b, c = phone(1, latency=1.0), phone(2, latency=2.0), phone(3, latency=3.0)
+    s = LeastExpectedTimeScheduler([a, b, c])
+    assert s.select(frozenset({id(b), id(c)}), None, 0.0) is b
+    b.healthy = False
+    s.touch(b)
+    assert s.select(frozenset({id(b), id(c)}), None, 0.0) is c
+    s.remove(c)
+    assert s.select(frozenset({id(b), id(c)}), None, 0.0) is None
+    assert s.select(None, None, 0.0) is a
+
+def test_lect_adds_load_time_when_model_not_resident():
+    cold, warm = phone(1, latency=1.0), phone(2, latency=2.0, resident=["m:latest"])
+    s = LeastExpectedTimeScheduler([cold, warm], load_prior_s=5.0)
+    assert s.select(None, "m:latest", 0.0) is warm
+    assert s.select(None, None, 0.0) is cold
+
+def test_lect_optimistic_prior_for_new_phones():
+    old, new = phone(1), phone(2)
+    s = LeastExpectedTimeScheduler([old, new], prior_s=1.0)
+    s.observe(old, latency_s=4.0)
+    assert s.select(None, None, 0.0) is new
+    s.observe(old, latency_s=0.5)   # prior spada do najlepszej widzianej latencji
+    assert s.prior_s == 0.5
+
+def test_rr_follows_weights():
+    a, b = phone(1, weight=2), phone(2, weight=1)
+    s = RoundRobinScheduler([a, b])
+    picks = [s.select(None, None, 0.0) for _ in range(6)]
+    assert picks.count(a) == 4 and picks.count(b) == 2
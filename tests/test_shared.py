@@ -0,0 +1,48 @@
+import asyncio, time
+
+from core.shared import SqliteSharedState, merge_prom
+
+def test_leases_are_shared_across_processes(tmp_path):
+    async def main():
+        a = SqliteSharedState(tmp_path / "shared.db", owner="a")
+        b = SqliteSharedState(tmp_path / "shared.db", owner="b")
+        await a.start(); await b.start()
+        la = await a.lease("p0", 2)
+        lb = await b.lease("p0", 2)
+        assert la is not None and lb is not None
+        assert await a.lease("p0", 2) is None and await b.lease("p0", 2) is None
+        assert await a.lease("p1", 1) is not None     # limit per telefon
+        assert await a.usage() == {"p0": 1} and await b.usage() == {"p0": 1, "p1": 1}
+        await b.release(lb)
+        assert await a.lease("p0", 2) is not None
+        await a.stop(); await b.stop()
+    asyncio.run(main())
+
+def test_dead_process_slots_are_not_counted(tmp_path):
+    async def main():
+        a = SqliteSharedState(tmp_path / "shared.db", owner="a", dead_s=10)
+        b = SqliteSharedState(tmp_path / "shared.db", owner="b", dead_s=10)
+        await a.start(); await b.start()
+        assert await b.lease("p0", 1) is not None
+        assert await a.lease("p0", 1) is None
+        b.db.execute("UPDATE workers SET seen=? WHERE owner='b'", (time.time() - 60,))
+        assert await a.alive() == ["a"]
+        assert await a.lease("p0", 1) is not None
+        await a.heartbeat()                            # sprzątanie po martwym
+        assert a.db.execute("SELECT COUNT(*) FROM leases WHERE owner='b'").fetchone()[0] == 0
+        await a.set_limit("p0", 3)
+        assert (await b.limits())["p0"][:2] == (3, "a")
+        await a.stop(); await b.stop()
+    asyncio.run(main())
+
+def test_merge_prom_labels_and_dedups_families():
+    texts = {
+        "w1": "# HELP gw_x Things\n# TYPE gw_x counter\ngw_x 1\n# TYPE gw_y gauge\ngw_y{phone=\"p0\"} 2\n",
+        "w2": "# HELP gw_x Things\n# TYPE gw_x counter\ngw_x 3\n\ngw_z{} 4\n",
+    }
+    out = merge_prom(texts).splitlines()
+    assert out.count("# HELP gw_x Things") == 1 and out.count("# TYPE gw_x counter") == 1
+    assert 'gw_x{worker="w1"} 1' in out and 'gw_x{worker="w2"} 3' in out
+    # próbki rodziny razem, mimo że procesy się przeplatają
+    assert out.index('gw_x{worker="w2"} 3') < out.index('gw_y{worker="w1",phone="p0"} 2')
+    assert 'gw_z{worker="w2"} 4' in out
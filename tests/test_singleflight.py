@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from core.jobs import request_key
+from core.singleflight import SingleFlight, render_coalesce_prom
+
+def test_duplicates_share_one_call():
+    async def main():
+        sf, calls = SingleFlight(), []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "r"
+        results = await asyncio.gather(*(sf.do("k", fn) for _ in range(5)))
+        assert results == ["r"] * 5 and len(calls) == 1
+        assert (sf.leaders, sf.hits, sf.inflight()) == (1, 4, 0)
+        assert await sf.do("k", fn) == "r" and len(calls) == 2   # po zakończeniu – nowe wywołanie
+    asyncio.run(main())
+
+def test_duplicates_share_the_exception():
+    async def main():
+        sf = SingleFlight()
+
+        async def boom():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("phone down")
+        results = await asyncio.gather(sf.do("k", boom), sf.do("k", boom), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert sf.inflight() == 0
+    asyncio.run(main())
+
+def test_leader_disconnect_does_not_cancel_followers():
+    async def main():
+        sf = SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.02)
+            return 42
+        leader = asyncio.create_task(sf.do("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(sf.do("k", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == 42
+    asyncio.run(main())
+
+def test_request_key_and_prom():
+    a = {"prompt": "p", "model": "m", "options": {}, "priority": 1}
+    assert request_key(a) == request_key({"prompt": "p", "model": "m", "priority": 9})
+    assert request_key(a) != request_key({**a, "system": "s"})
+    assert request_key({"kind": "embed", "input": ["p"], "model": "m"}) != request_key(a)
+    assert 'gw_coalesced_total{kind="ask"} 3' in render_coalesce_prom({"ask": 3})
@@ -0,0 +1,52 @@
+import asyncio
+
+import httpx
+
+from core.jobs import JobsEngine
+from core.streambuf import ChunkBuffer
+from tests.fakes import chat_body
+
+async def _collect(buf: ChunkBuffer, offset: int = 0) -> bytes:
+    return b"".join([chunk async for _, chunk in buf.follow(offset)])
+
+def test_replay_from_offset_after_close():
+    async def main():
+        buf = ChunkBuffer()
+        buf.append(b"abc"); buf.append(b""); buf.append(b"def")
+        buf.close()
+        buf.append(b"ignored")
+        assert await _collect(buf) == b"abcdef"
+        assert await _collect(buf, 4) == b"ef"
+        assert await _collect(buf, 100) == b""
+        assert [pos async for pos, _ in buf.follow(1)] == [6]
+        assert buf.subscribers == 0
+    asyncio.run(main())
+
+def test_live_subscribers_see_same_bytes():
+    async def main():
+        buf = ChunkBuffer()
+        buf.append(b"1")
+        early = asyncio.create_task(_collect(buf))
+        await asyncio.sleep(0)
+        assert buf.subscribers == 1
+        buf.append(b"2")
+        late = asyncio.create_task(_collect(buf, 1))
+        await asyncio.sleep(0)
+        buf.append(b"3")
+        buf.close()
+        assert await early == b"123" and await late == b"23"
+        assert buf.subscribers == 0
+    asyncio.run(main())
+
+def test_job_output_replays_to_late_follower(make_gateway):
+    async def main():
+        gw = make_gateway(n=1, handler=lambda phone, request: httpx.Response(200, content=chat_body()))
+        engine = JobsEngine(gw)
+        await engine.start()
+        job_id = await engine.enqueue({"prompt": "q", "model": "m"})
+        live = b"".join([c async for _, c in engine.follow(job_id)])
+        again = b"".join([c async for _, c in engine.follow(job_id)])
+        tail = b"".join([c async for _, c in engine.follow(job_id, offset=len(live) - 10)])
+        await engine.stop()
+        assert live == again == chat_body() and tail == live[-10:]
+    asyncio.run(main())
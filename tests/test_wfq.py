@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from core.jobs import Job, JobsEngine
+from tests.fakes import chat_body, prompt_of, wait_finished
+
+def test_slots_split_by_tenant_weight(make_gateway):
+    order = []
+
+    def handler(phone, request):
+        order.append(prompt_of(request)[0])
+        return httpx.Response(200, content=chat_body())
+
+    async def main():
+        engine = JobsEngine(make_gateway(n=1, max_concurrency=1, handler=handler), weights={"a": 3.0})
+        ids = []
+        for i in range(8):   # b wrzuca pilniejsze joby – u innego najemcy to nie pomaga
+            ids.append(await engine.enqueue({"prompt": f"a{i}", "model": "m"}, priority=5, tenant="a"))
+            ids.append(await engine.enqueue({"prompt": f"b{i}", "model": "m"}, priority=0, tenant="b"))
+        await engine.start()
+        await wait_finished(engine, ids)
+        await engine.stop()
+        assert order[:8].count("a") == 6
+        assert len(order) == 16
+    asyncio.run(main())
+
+def test_returning_tenant_gets_no_idle_credit(make_gateway):
+    engine = JobsEngine(make_gateway(n=1))
+    engine._vtime = 10.0
+    engine._enheap(Job(id="x", req={}, tenant="late", seq=1))
+    assert engine._vt["late"] == 10.0
+
+def test_aging_promotes_long_waiting_job(make_gateway):
+    engine = JobsEngine(make_gateway(n=1), aging_s=60)
+    now = datetime.now(timezone.utc)
+    old = Job(id="old", req={}, priority=7, seq=1, enqueued_at=(now - timedelta(minutes=5)).isoformat())
+    new = Job(id="new", req={}, priority=5, seq=2, enqueued_at=now.isoformat())
+    assert engine._entry(old) < engine._entry(new)   # 5 minut czekania = 5 poziomów
+    fresh = Job(id="fresh", req={}, priority=7, seq=3, enqueued_at=now.isoformat())
+    assert engine._entry(new) < engine._entry(fresh)
+    assert JobsEngine(make_gateway(n=1))._entry(old)[0] == 7   # bez aging_s – sam priorytet
+
+def test_skipped_tenant_does_not_block_other_models(make_gateway):
+    """Najemca a z najmniejszym czasem wirtualnym ma na czele joby modelu bez wolnego slotu."""
+    seen = []
+
+    def handler(phone, request):
+        seen.append(prompt_of(request))
+        return httpx.Response(200, content=chat_body())
+
+    async def round_with(gw, n_busy):
+        seen.clear()
+        engine = JobsEngine(gw)
+        busy = [await engine.enqueue({"prompt": f"a{i}", "model": "m1"}, tenant="a") for i in range(n_busy)]
+        a_m2 = await engine.enqueue({"prompt": "a-m2", "model": "m2"}, tenant="a")
+        b_m2 = await engine.enqueue({"prompt": "b-m2", "model": "m2"}, tenant="b")
+        await engine._dispatch_ready()
+        await wait_finished(engine, [b_m2])
+        assert all(engine.jobs[j].status == "queued" for j in busy)
+        left = engine.jobs[a_m2].status == "queued"
+        assert len(engine._queues["a"]) == n_busy + left   # pominięte wracają do kopca
+        if not left:
+            await wait_finished(engine, [a_m2])
+        await engine.stop()
+
+    async def main():
+        gw = make_gateway(n=2, handler=handler)
+        gw.phones[0].models, gw.phones[1].models = ["m1:latest"], ["m2:latest"]
+        gw._rebuild_model_index()
+        while await gw.try_acquire_slot("m1") is not None:   # m1 zajęty do końca testu
+            pass
+        await round_with(gw, JobsEngine.SCAN_LIMIT + 6)
+        assert seen == ["b-m2"]              # a-m2 dalej niż SCAN_LIMIT – czeka na kolejną rundę
+        await round_with(gw, 3)
+        assert seen == ["b-m2", "a-m2"]      # najpierw drugi najemca, potem skan za blokadą u a
+    asyncio.run(main())